@@ -0,0 +1,168 @@
+-- Migration for a tournament database created before the player stats
+-- table.
+--
+-- Adds the player stats table and the triggers that keep it up to date,
+-- fills it in from the matches already played, and points the standings
+-- view at it. The old standings view is kept as standings_full.
+--
+-- Run it with: psql -d tournament -f migrations/001_player_stats.sql
+
+BEGIN;
+
+DROP VIEW possible_pairings;
+ALTER VIEW standings RENAME TO standings_full;
+
+
+-- Create player stats table.
+-- Holds running totals of each player's results, so that the standings can
+-- be read without aggregating the whole match history.
+-- The table is kept up to date by the triggers on the players and matches
+-- tables below. The standings_full view recomputes the same totals from
+-- the match history, and can be used to check or rebuild the table.
+CREATE TABLE player_stats (
+	id integer PRIMARY KEY REFERENCES players (id) ON DELETE CASCADE,
+	wins integer NOT NULL DEFAULT 0,
+	draws integer NOT NULL DEFAULT 0,
+	played integer NOT NULL DEFAULT 0,
+	byes integer NOT NULL DEFAULT 0,
+	opponent_wins integer NOT NULL DEFAULT 0,
+	rank float NOT NULL DEFAULT 0
+);
+
+CREATE INDEX player_stats_rank ON player_stats (rank, opponent_wins DESC);
+
+
+-- Create a stats row for each new player.
+CREATE FUNCTION player_stats_add_player() RETURNS trigger AS $$
+BEGIN
+	INSERT INTO player_stats (id) VALUES (NEW.id);
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER player_stats_add_player AFTER INSERT ON players
+	FOR EACH ROW EXECUTE PROCEDURE player_stats_add_player();
+
+
+-- Add (change = 1) or remove (change = -1) the result of a match
+-- from the player stats.
+-- When a player's wins change, the opponent wins of each of the player's
+-- opponents change too. When two players meet for the first time, each
+-- player's opponent wins go up by the other player's wins, so this link
+-- is made before the match's win is counted, and undone after it is
+-- removed.
+-- The match row itself is left out of the opponent lookup, since it is
+-- not yet in the table when it is added, but is when it is removed.
+CREATE FUNCTION player_stats_apply_match(
+	p1 integer, p2 integer, w integer, change integer) RETURNS void AS $$
+BEGIN
+	IF change > 0 AND p1 != p2 THEN
+		UPDATE player_stats AS s
+		SET opponent_wins = s.opponent_wins + change * o.wins
+		FROM player_stats AS o
+		WHERE (s.id = p1 AND o.id = p2) OR (s.id = p2 AND o.id = p1);
+	END IF;
+
+	UPDATE player_stats SET
+		played = played + change,
+		wins = wins + CASE WHEN id = w THEN change ELSE 0 END,
+		draws = draws + CASE WHEN w IS NULL THEN change ELSE 0 END,
+		byes = byes + CASE WHEN p1 = p2 THEN change ELSE 0 END,
+		rank = rank + change
+			- CASE WHEN id = w THEN change ELSE 0 END
+			- CASE WHEN w IS NULL THEN change::float / 2 ELSE 0 END
+	WHERE id IN (p1, p2);
+
+	IF w IS NOT NULL THEN
+		UPDATE player_stats
+		SET opponent_wins = opponent_wins + change * o.times
+		FROM (
+			SELECT opponent_id, COUNT(*) AS times FROM (
+				SELECT player2 AS opponent_id FROM matches
+				WHERE player1 = w AND player2 != w
+				AND NOT (player1 = p1 AND player2 = p2)
+				UNION ALL
+				SELECT player1 FROM matches
+				WHERE player2 = w AND player1 != w
+				AND NOT (player1 = p1 AND player2 = p2)
+			) AS opponents
+			GROUP BY opponent_id
+		) AS o
+		WHERE player_stats.id = o.opponent_id;
+
+		IF p1 != p2 THEN
+			UPDATE player_stats SET opponent_wins = opponent_wins + change
+			WHERE id = CASE WHEN w = p1 THEN p2 ELSE p1 END;
+		END IF;
+	END IF;
+
+	IF change < 0 AND p1 != p2 THEN
+		UPDATE player_stats AS s
+		SET opponent_wins = s.opponent_wins + change * o.wins
+		FROM player_stats AS o
+		WHERE (s.id = p1 AND o.id = p2) OR (s.id = p2 AND o.id = p1);
+	END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Keep the player stats up to date as matches are added, changed and removed.
+-- This is a BEFORE trigger so that, within a statement that writes several
+-- matches, each call sees the matches table exactly as the player stats
+-- describe it.
+-- The players of a match cannot be changed, only its winner.
+CREATE FUNCTION player_stats_update_match() RETURNS trigger AS $$
+BEGIN
+	IF TG_OP = 'UPDATE' AND (NEW.player1 != OLD.player1
+			OR NEW.player2 != OLD.player2) THEN
+		RAISE EXCEPTION 'The players of a match cannot be changed';
+	END IF;
+	IF TG_OP IN ('UPDATE', 'DELETE') THEN
+		PERFORM player_stats_apply_match(
+			OLD.player1, OLD.player2, OLD.winner, -1);
+	END IF;
+	IF TG_OP = 'DELETE' THEN
+		RETURN OLD;
+	END IF;
+	PERFORM player_stats_apply_match(NEW.player1, NEW.player2, NEW.winner, 1);
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER player_stats_update_match
+	BEFORE INSERT OR UPDATE OR DELETE ON matches
+	FOR EACH ROW EXECUTE PROCEDURE player_stats_update_match();
+
+
+-- Fill in the stats of the players already registered, as
+-- rebuildPlayerStats() does. Creating the triggers above locks out
+-- writes to the players and matches tables until the migration commits,
+-- so no result can be missed.
+INSERT INTO player_stats
+	(id, wins, draws, played, byes, opponent_wins, rank)
+	SELECT id, wins, draws, played, byes, opponent_wins, rank
+	FROM standings_full;
+
+
+-- Create player standings view.
+-- Reads the running totals from the player stats table.
+CREATE VIEW standings AS
+	SELECT players.id, players.name,
+	player_stats.wins, player_stats.draws, player_stats.opponent_wins,
+	player_stats.played, player_stats.byes, player_stats.rank
+	FROM players
+	JOIN player_stats ON players.id = player_stats.id;
+
+
+-- Create possible pairings view.
+-- Only return pairings that have not already played each other.
+CREATE VIEW possible_pairings AS
+	SELECT a.id AS id1, a.name AS name1, a.rank AS rank1, a.opponent_wins AS opponent_wins1,
+	b.id AS id2, b.name AS name2, b.rank AS rank2, b.opponent_wins AS opponent_wins2
+	FROM standings a 
+	CROSS JOIN standings b 
+	WHERE a.id != b.id
+	AND b.id NOT IN (SELECT matches.player2 FROM matches WHERE matches.player1 = a.id)
+	AND b.id NOT IN (SELECT matches.player1 FROM matches WHERE matches.player2 = a.id);
+
+COMMIT;
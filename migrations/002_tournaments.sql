@@ -0,0 +1,276 @@
+-- Migration for a tournament database created before one database could
+-- hold many tournaments.
+--
+-- Adds the tournaments table, with the default tournament, and a
+-- tournament_id column to the players, matches and player stats tables.
+-- Every existing player and match is put in the default tournament. The
+-- players of a match must then belong to the match's tournament, and the
+-- player stats functions and the views are replaced with ones that keep
+-- each tournament apart.
+--
+-- Run it with: psql -d tournament -f migrations/002_tournaments.sql
+
+BEGIN;
+
+DROP VIEW possible_pairings;
+DROP VIEW standings;
+DROP VIEW standings_full;
+DROP VIEW player_byes;
+DROP VIEW player_opponent_wins;
+DROP VIEW player_opponents;
+DROP VIEW player_matches;
+DROP VIEW player_draws;
+DROP VIEW player_wins;
+
+
+-- Create tournaments table.
+-- Each tournament has its own players and matches, so one database can
+-- hold many tournaments at once.
+CREATE TABLE tournaments (
+	id serial PRIMARY KEY,
+	name text
+);
+
+-- Create the default tournament, used when no tournament is given.
+INSERT INTO tournaments (name) VALUES ('Default');
+
+
+-- The column default puts every existing row in the default tournament.
+ALTER TABLE players
+	ADD COLUMN tournament_id integer NOT NULL DEFAULT 1
+		CONSTRAINT players_tournament_id_fkey
+		REFERENCES tournaments (id) ON DELETE CASCADE,
+	ADD CONSTRAINT players_tournament_id_id_key UNIQUE (tournament_id, id);
+
+-- The players of a match must belong to the match's tournament.
+ALTER TABLE matches
+	DROP CONSTRAINT matches_pkey,
+	DROP CONSTRAINT matches_player1_fkey,
+	DROP CONSTRAINT matches_player2_fkey,
+	DROP CONSTRAINT matches_winner_fkey,
+	ADD COLUMN tournament_id integer NOT NULL DEFAULT 1
+		CONSTRAINT matches_tournament_id_fkey
+		REFERENCES tournaments (id) ON DELETE CASCADE,
+	ADD CONSTRAINT matches_pkey PRIMARY KEY (tournament_id, player1, player2),
+	ADD CONSTRAINT matches_tournament_id_player1_fkey
+		FOREIGN KEY (tournament_id, player1)
+		REFERENCES players (tournament_id, id),
+	ADD CONSTRAINT matches_tournament_id_player2_fkey
+		FOREIGN KEY (tournament_id, player2)
+		REFERENCES players (tournament_id, id),
+	ADD CONSTRAINT matches_tournament_id_winner_fkey
+		FOREIGN KEY (tournament_id, winner)
+		REFERENCES players (tournament_id, id);
+
+-- New stats rows are given their player's tournament by the trigger, so
+-- the column only has a default while the existing rows are filled in.
+ALTER TABLE player_stats ADD COLUMN tournament_id integer NOT NULL DEFAULT 1;
+ALTER TABLE player_stats ALTER COLUMN tournament_id DROP DEFAULT;
+
+DROP INDEX player_stats_rank;
+CREATE INDEX player_stats_rank
+	ON player_stats (tournament_id, rank, opponent_wins DESC, id);
+
+
+-- Create a stats row for each new player.
+CREATE OR REPLACE FUNCTION player_stats_add_player() RETURNS trigger AS $$
+BEGIN
+	INSERT INTO player_stats (id, tournament_id)
+	VALUES (NEW.id, NEW.tournament_id);
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP FUNCTION player_stats_apply_match(integer, integer, integer, integer);
+
+-- Add (change = 1) or remove (change = -1) the result of a match
+-- from the player stats.
+-- When a player's wins change, the opponent wins of each of the player's
+-- opponents change too. When two players meet for the first time, each
+-- player's opponent wins go up by the other player's wins, so this link
+-- is made before the match's win is counted, and undone after it is
+-- removed.
+-- The match row itself is left out of the opponent lookup, since it is
+-- not yet in the table when it is added, but is when it is removed.
+CREATE FUNCTION player_stats_apply_match(t integer,
+	p1 integer, p2 integer, w integer, change integer) RETURNS void AS $$
+BEGIN
+	IF change > 0 AND p1 != p2 THEN
+		UPDATE player_stats AS s
+		SET opponent_wins = s.opponent_wins + change * o.wins
+		FROM player_stats AS o
+		WHERE (s.id = p1 AND o.id = p2) OR (s.id = p2 AND o.id = p1);
+	END IF;
+
+	UPDATE player_stats SET
+		played = played + change,
+		wins = wins + CASE WHEN id = w THEN change ELSE 0 END,
+		draws = draws + CASE WHEN w IS NULL THEN change ELSE 0 END,
+		byes = byes + CASE WHEN p1 = p2 THEN change ELSE 0 END,
+		rank = rank + change
+			- CASE WHEN id = w THEN change ELSE 0 END
+			- CASE WHEN w IS NULL THEN change::float / 2 ELSE 0 END
+	WHERE id IN (p1, p2);
+
+	IF w IS NOT NULL THEN
+		UPDATE player_stats
+		SET opponent_wins = opponent_wins + change * o.times
+		FROM (
+			SELECT opponent_id, COUNT(*) AS times FROM (
+				SELECT player2 AS opponent_id FROM matches
+				WHERE tournament_id = t AND player1 = w AND player2 != w
+				AND NOT (player1 = p1 AND player2 = p2)
+				UNION ALL
+				SELECT player1 FROM matches
+				WHERE tournament_id = t AND player2 = w AND player1 != w
+				AND NOT (player1 = p1 AND player2 = p2)
+			) AS opponents
+			GROUP BY opponent_id
+		) AS o
+		WHERE player_stats.id = o.opponent_id;
+
+		IF p1 != p2 THEN
+			UPDATE player_stats SET opponent_wins = opponent_wins + change
+			WHERE id = CASE WHEN w = p1 THEN p2 ELSE p1 END;
+		END IF;
+	END IF;
+
+	IF change < 0 AND p1 != p2 THEN
+		UPDATE player_stats AS s
+		SET opponent_wins = s.opponent_wins + change * o.wins
+		FROM player_stats AS o
+		WHERE (s.id = p1 AND o.id = p2) OR (s.id = p2 AND o.id = p1);
+	END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Keep the player stats up to date as matches are added, changed and removed.
+-- This is a BEFORE trigger so that, within a statement that writes several
+-- matches, each call sees the matches table exactly as the player stats
+-- describe it.
+-- The tournament and players of a match cannot be changed, only its winner.
+CREATE OR REPLACE FUNCTION player_stats_update_match() RETURNS trigger AS $$
+BEGIN
+	IF TG_OP = 'UPDATE' AND (NEW.tournament_id != OLD.tournament_id
+			OR NEW.player1 != OLD.player1 OR NEW.player2 != OLD.player2) THEN
+		RAISE EXCEPTION 'The players of a match cannot be changed';
+	END IF;
+	IF TG_OP IN ('UPDATE', 'DELETE') THEN
+		PERFORM player_stats_apply_match(OLD.tournament_id,
+			OLD.player1, OLD.player2, OLD.winner, -1);
+	END IF;
+	IF TG_OP = 'DELETE' THEN
+		RETURN OLD;
+	END IF;
+	PERFORM player_stats_apply_match(NEW.tournament_id,
+		NEW.player1, NEW.player2, NEW.winner, 1);
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Create player win count view.
+CREATE VIEW player_wins AS
+	SELECT players.tournament_id, players.id, players.name,
+	COUNT(matches.winner) AS wins
+	FROM players 
+	LEFT OUTER JOIN matches ON players.id = matches.winner
+	GROUP BY players.tournament_id, players.id;
+
+
+-- Create player draw count view.
+-- A draw is recorded in the matches tables by setting winner = null.
+CREATE VIEW player_draws AS
+	SELECT players.tournament_id, players.id, players.name,
+	COUNT(matches.player1) AS draws
+	FROM players 
+	LEFT OUTER JOIN matches 
+	ON (players.id = matches.player1 OR players.id = matches.player2) AND matches.winner IS NULL
+	GROUP BY players.tournament_id, players.id;
+
+
+-- Create player match count view.
+CREATE VIEW player_matches AS
+	SELECT players.tournament_id, players.id, players.name,
+	COUNT(matches.player1 + matches.player2) AS played
+	FROM players 
+	LEFT OUTER JOIN matches ON players.id = matches.player1 OR players.id = matches.player2
+	GROUP BY players.tournament_id, players.id;
+
+
+-- Create player opponents view.
+-- Ignore bye rows.
+CREATE VIEW player_opponents AS
+	SELECT players.tournament_id, players.id, players.name, 
+	CASE WHEN players.id = matches.player1 THEN matches.player2 ELSE matches.player1 END AS opponent_id
+	FROM players 
+	JOIN matches 
+	ON players.id = matches.player1 OR players.id = matches.player2
+	WHERE matches.player1 != matches.player2;
+
+
+-- Create player opponent win count view.
+CREATE VIEW player_opponent_wins AS
+	SELECT players.tournament_id, players.id, players.name, 
+	SUM(CASE WHEN player_wins.wins IS NULL THEN 0 ELSE player_wins.wins END) AS opponent_wins
+	FROM players 
+	LEFT OUTER JOIN player_opponents ON players.id = player_opponents.id
+	LEFT OUTER JOIN player_wins ON player_opponents.opponent_id = player_wins.id
+	GROUP BY players.tournament_id, players.id;
+
+	
+-- Create player bye count view.
+-- A player bye is recorded in the matches table as
+-- player = player1 = player2 = winner.
+CREATE VIEW player_byes AS
+	SELECT players.tournament_id, players.id, players.name,
+	COUNT(matches.player1) AS byes
+	FROM players 
+	LEFT OUTER JOIN matches ON players.id = matches.player1 AND players.id = matches.player2
+	GROUP BY players.tournament_id, players.id;
+
+
+-- Create full player standings view.
+-- Recomputes every player's standing from the whole match history.
+-- Player rank is defined as 
+-- matches played by player - player wins - player draws / 2,
+-- so 0 is the highest rank.
+CREATE VIEW standings_full AS
+	SELECT players.tournament_id, players.id, players.name, 
+	player_wins.wins, player_draws.draws, player_opponent_wins.opponent_wins,
+	player_matches.played, player_byes.byes,
+	(player_matches.played - player_wins.wins - player_draws.draws::float / 2) AS rank
+	FROM players 
+	JOIN player_wins ON players.id = player_wins.id
+	JOIN player_draws ON players.id = player_draws.id
+	JOIN player_opponent_wins ON players.id = player_opponent_wins.id
+	JOIN player_matches ON players.id = player_matches.id
+	JOIN player_byes ON players.id = player_byes.id;
+
+
+-- Create player standings view.
+-- Reads the running totals from the player stats table.
+CREATE VIEW standings AS
+	SELECT player_stats.tournament_id, players.id, players.name,
+	player_stats.wins, player_stats.draws, player_stats.opponent_wins,
+	player_stats.played, player_stats.byes, player_stats.rank
+	FROM players
+	JOIN player_stats ON players.id = player_stats.id;
+
+
+-- Create possible pairings view.
+-- Only return pairings of players in the same tournament,
+-- that have not already played each other.
+CREATE VIEW possible_pairings AS
+	SELECT a.tournament_id,
+	a.id AS id1, a.name AS name1, a.rank AS rank1, a.opponent_wins AS opponent_wins1,
+	b.id AS id2, b.name AS name2, b.rank AS rank2, b.opponent_wins AS opponent_wins2
+	FROM standings a 
+	JOIN standings b ON a.tournament_id = b.tournament_id
+	WHERE a.id != b.id
+	AND b.id NOT IN (SELECT matches.player2 FROM matches WHERE matches.player1 = a.id)
+	AND b.id NOT IN (SELECT matches.player1 FROM matches WHERE matches.player2 = a.id);
+
+COMMIT;
@@ -0,0 +1,108 @@
+-- Migration for a tournament database created before the standings views
+-- were rewritten to avoid OR joins.
+--
+-- Adds indexes for looking up a player's matches as player2 and as winner,
+-- replaces the per-statistic aggregate views with views that count every
+-- player's totals in a single pass over the matches, and rewrites the
+-- possible_pairings rematch checks as index lookups.
+--
+-- Run it with: psql -d tournament -f migrations/003_index_friendly_views.sql
+
+BEGIN;
+
+CREATE INDEX matches_player2 ON matches (tournament_id, player2);
+CREATE INDEX matches_winner ON matches (tournament_id, winner);
+
+DROP VIEW standings_full;
+DROP VIEW player_opponent_wins;
+DROP VIEW player_opponents;
+DROP VIEW player_byes;
+DROP VIEW player_matches;
+DROP VIEW player_draws;
+DROP VIEW player_wins;
+
+
+-- Create match perspectives view.
+-- Each match is seen once from each player's side, giving the player,
+-- their opponent and the winner, so that each player's totals can be
+-- counted in a single pass over the matches, without OR joins.
+-- A bye is only seen once, with no opponent.
+CREATE VIEW match_perspectives AS
+	SELECT tournament_id, player1 AS id,
+	NULLIF(player2, player1) AS opponent_id, winner
+	FROM matches
+	UNION ALL
+	SELECT tournament_id, player2, player1, winner
+	FROM matches
+	WHERE player1 != player2;
+
+
+-- Create player totals view.
+-- Counts each player's wins, draws, matches played and byes.
+-- A draw is recorded in the matches tables by setting winner = null.
+-- A player bye is recorded in the matches table as
+-- player = player1 = player2 = winner.
+CREATE VIEW player_totals AS
+	SELECT players.tournament_id, players.id, players.name,
+	COUNT(match_perspectives.id) AS played,
+	COUNT(CASE WHEN match_perspectives.winner = players.id THEN 1 END) AS wins,
+	COUNT(CASE WHEN match_perspectives.id IS NOT NULL
+		AND match_perspectives.winner IS NULL THEN 1 END) AS draws,
+	COUNT(CASE WHEN match_perspectives.id IS NOT NULL
+		AND match_perspectives.opponent_id IS NULL THEN 1 END) AS byes
+	FROM players
+	LEFT OUTER JOIN match_perspectives
+	ON players.tournament_id = match_perspectives.tournament_id
+	AND players.id = match_perspectives.id
+	GROUP BY players.tournament_id, players.id;
+
+
+-- Create player opponent win count view.
+-- Ignore bye rows.
+CREATE VIEW player_opponent_wins AS
+	SELECT players.tournament_id, players.id, players.name,
+	COALESCE(SUM(opponents.wins), 0) AS opponent_wins
+	FROM players
+	LEFT OUTER JOIN match_perspectives
+	ON players.tournament_id = match_perspectives.tournament_id
+	AND players.id = match_perspectives.id
+	LEFT OUTER JOIN player_totals opponents
+	ON match_perspectives.tournament_id = opponents.tournament_id
+	AND match_perspectives.opponent_id = opponents.id
+	GROUP BY players.tournament_id, players.id;
+
+
+-- Create full player standings view.
+-- Recomputes every player's standing from the whole match history.
+-- Player rank is defined as 
+-- matches played by player - player wins - player draws / 2,
+-- so 0 is the highest rank.
+CREATE VIEW standings_full AS
+	SELECT player_totals.tournament_id, player_totals.id, player_totals.name,
+	player_totals.wins, player_totals.draws,
+	player_opponent_wins.opponent_wins,
+	player_totals.played, player_totals.byes,
+	(player_totals.played - player_totals.wins - player_totals.draws::float / 2) AS rank
+	FROM player_totals
+	JOIN player_opponent_wins
+	ON player_totals.tournament_id = player_opponent_wins.tournament_id
+	AND player_totals.id = player_opponent_wins.id;
+
+
+CREATE OR REPLACE VIEW possible_pairings AS
+	SELECT a.tournament_id,
+	a.id AS id1, a.name AS name1, a.rank AS rank1, a.opponent_wins AS opponent_wins1,
+	b.id AS id2, b.name AS name2, b.rank AS rank2, b.opponent_wins AS opponent_wins2
+	FROM standings a 
+	JOIN standings b ON a.tournament_id = b.tournament_id
+	WHERE a.id != b.id
+	AND NOT EXISTS (SELECT 1 FROM matches
+		WHERE matches.tournament_id = a.tournament_id
+		AND matches.player1 = a.id AND matches.player2 = b.id)
+	AND NOT EXISTS (SELECT 1 FROM matches
+		WHERE matches.tournament_id = a.tournament_id
+		AND matches.player1 = b.id AND matches.player2 = a.id);
+
+ANALYZE matches;
+
+COMMIT;
@@ -0,0 +1,40 @@
+-- Migration for a tournament database created before tournaments had
+-- versions.
+--
+-- Adds the version column to the tournaments table, and the triggers
+-- that give a tournament a new version each time its players or matches
+-- change. Needs PostgreSQL 10 or later, for transition tables.
+--
+-- Run it with: psql -d tournament -f migrations/004_tournament_versions.sql
+
+BEGIN;
+
+ALTER TABLE tournaments ADD COLUMN version bigint NOT NULL DEFAULT 0;
+
+CREATE SEQUENCE tournament_versions;
+
+CREATE FUNCTION tournaments_bump_version() RETURNS trigger AS $$
+BEGIN
+	UPDATE tournaments SET version = nextval('tournament_versions')
+	WHERE id IN (SELECT DISTINCT tournament_id FROM changed_rows);
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER players_insert_version AFTER INSERT ON players
+	REFERENCING NEW TABLE AS changed_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE tournaments_bump_version();
+CREATE TRIGGER players_delete_version AFTER DELETE ON players
+	REFERENCING OLD TABLE AS changed_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE tournaments_bump_version();
+CREATE TRIGGER matches_insert_version AFTER INSERT ON matches
+	REFERENCING NEW TABLE AS changed_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE tournaments_bump_version();
+CREATE TRIGGER matches_update_version AFTER UPDATE ON matches
+	REFERENCING NEW TABLE AS changed_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE tournaments_bump_version();
+CREATE TRIGGER matches_delete_version AFTER DELETE ON matches
+	REFERENCING OLD TABLE AS changed_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE tournaments_bump_version();
+
+COMMIT;
@@ -0,0 +1,50 @@
+-- Migration for a tournament database created before matches were
+-- recorded by round.
+--
+-- Adds the current round to the tournaments table, the round to the
+-- matches table, the trigger that records new matches in the current
+-- round, and the round standings table. Matches already recorded are put
+-- in round 1, since the rounds they were played in are not known.
+--
+-- Run it with: psql -d tournament -f migrations/005_rounds.sql
+
+BEGIN;
+
+ALTER TABLE tournaments ADD COLUMN current_round integer NOT NULL DEFAULT 1;
+
+-- Adding the column with a default fills it in without updating the rows,
+-- so the player stats triggers do not run.
+ALTER TABLE matches ADD COLUMN round integer NOT NULL DEFAULT 1;
+ALTER TABLE matches ALTER COLUMN round DROP DEFAULT;
+
+CREATE FUNCTION matches_set_round() RETURNS trigger AS $$
+BEGIN
+	IF NEW.round IS NULL THEN
+		SELECT current_round INTO NEW.round FROM tournaments
+		WHERE id = NEW.tournament_id FOR NO KEY UPDATE;
+	END IF;
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER matches_set_round BEFORE INSERT ON matches
+	FOR EACH ROW EXECUTE PROCEDURE matches_set_round();
+
+CREATE TABLE round_standings (
+	tournament_id integer NOT NULL
+		REFERENCES tournaments (id) ON DELETE CASCADE,
+	round integer NOT NULL,
+	id integer NOT NULL REFERENCES players (id) ON DELETE CASCADE,
+	wins integer NOT NULL,
+	draws integer NOT NULL,
+	played integer NOT NULL,
+	byes integer NOT NULL,
+	opponent_wins integer NOT NULL,
+	rank float NOT NULL,
+	PRIMARY KEY (tournament_id, round, id)
+);
+
+CREATE INDEX round_standings_rank
+	ON round_standings (tournament_id, round, rank, opponent_wins DESC, id);
+
+COMMIT;
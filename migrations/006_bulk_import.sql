@@ -0,0 +1,39 @@
+-- Migration for a tournament database created before tournaments could
+-- be imported in bulk.
+--
+-- Makes the player checks on the matches table deferrable, and lets the
+-- player stats trigger leave imported matches to be counted at the end.
+--
+-- Run it with: psql -d tournament -f migrations/006_bulk_import.sql
+
+BEGIN;
+
+ALTER TABLE matches
+	ALTER CONSTRAINT matches_tournament_id_player1_fkey DEFERRABLE,
+	ALTER CONSTRAINT matches_tournament_id_player2_fkey DEFERRABLE,
+	ALTER CONSTRAINT matches_tournament_id_winner_fkey DEFERRABLE;
+
+CREATE OR REPLACE FUNCTION player_stats_update_match() RETURNS trigger AS $$
+BEGIN
+	IF TG_OP = 'INSERT'
+			AND current_setting('tournament.importing', true) = 'on' THEN
+		RETURN NEW;
+	END IF;
+	IF TG_OP = 'UPDATE' AND (NEW.tournament_id != OLD.tournament_id
+			OR NEW.player1 != OLD.player1 OR NEW.player2 != OLD.player2) THEN
+		RAISE EXCEPTION 'The players of a match cannot be changed';
+	END IF;
+	IF TG_OP IN ('UPDATE', 'DELETE') THEN
+		PERFORM player_stats_apply_match(OLD.tournament_id,
+			OLD.player1, OLD.player2, OLD.winner, -1);
+	END IF;
+	IF TG_OP = 'DELETE' THEN
+		RETURN OLD;
+	END IF;
+	PERFORM player_stats_apply_match(NEW.tournament_id,
+		NEW.player1, NEW.player2, NEW.winner, 1);
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+COMMIT;
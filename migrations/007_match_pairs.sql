@@ -0,0 +1,14 @@
+-- Migration for a tournament database created before a pair of players
+-- was limited to one match, whichever order the players are given in.
+--
+-- Fails if a pair of players already has two matches, one with the
+-- players each way round. One of them has to be deleted first.
+--
+-- Run it with: psql -d tournament -f migrations/007_match_pairs.sql
+
+BEGIN;
+
+CREATE UNIQUE INDEX matches_pair ON matches
+	(tournament_id, LEAST(player1, player2), GREATEST(player1, player2));
+
+COMMIT;
@@ -0,0 +1,85 @@
+-- Migration for a tournament database in which recording a match locked
+-- the tournament's row until the match was committed.
+--
+-- Replaces the trigger function that records new matches in the current
+-- round with one that reads the round without locking the row, and the
+-- version triggers with ones that only write a tournament's new version
+-- to its row as the transaction commits.
+--
+-- Run it with: psql -d tournament -f migrations/008_unlocked_writes.sql
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION matches_set_round() RETURNS trigger AS $$
+BEGIN
+	IF NEW.round IS NULL THEN
+		SELECT current_round INTO NEW.round FROM tournaments
+		WHERE id = NEW.tournament_id;
+	END IF;
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Take a new version for a tournament that the current transaction has
+-- changed. The version is kept in a setting local to the transaction, and
+-- is only written to the tournament row as the transaction commits, see
+-- tournaments_publish_version(). While the setting is set, the
+-- transaction's own reads are not cached. Returns the new version.
+CREATE FUNCTION tournaments_new_version(t integer) RETURNS bigint AS $$
+DECLARE
+	v bigint := nextval('tournament_versions');
+BEGIN
+	PERFORM set_config('tournament.version_' || t, v::text, true);
+	RETURN v;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Give a tournament a new version after each statement that changes its
+-- players or matches. Statement triggers with transition tables take a
+-- version for each tournament once per statement, however many rows the
+-- statement writes. No rows are locked, so concurrent writers to one
+-- tournament do not wait for each other.
+CREATE OR REPLACE FUNCTION tournaments_bump_version() RETURNS trigger AS $$
+BEGIN
+	PERFORM tournaments_new_version(t)
+	FROM (SELECT DISTINCT tournament_id AS t FROM changed_rows) AS changed;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Write the latest version the transaction took for a tournament to the
+-- tournament row. A deferred trigger runs as the transaction commits, so
+-- the row is only locked for the commit itself. Only the first changed
+-- row of each tournament updates it, the rest find it up to date.
+CREATE FUNCTION tournaments_publish_version() RETURNS trigger AS $$
+DECLARE
+	t integer;
+	v bigint;
+BEGIN
+	IF TG_OP = 'DELETE' THEN
+		t := OLD.tournament_id;
+	ELSE
+		t := NEW.tournament_id;
+	END IF;
+	v := NULLIF(current_setting('tournament.version_' || t, true), '');
+	IF v IS NOT NULL THEN
+		UPDATE tournaments SET version = v
+		WHERE id = t AND version IS DISTINCT FROM v;
+	END IF;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE CONSTRAINT TRIGGER players_publish_version
+	AFTER INSERT OR DELETE ON players
+	DEFERRABLE INITIALLY DEFERRED
+	FOR EACH ROW EXECUTE PROCEDURE tournaments_publish_version();
+CREATE CONSTRAINT TRIGGER matches_publish_version
+	AFTER INSERT OR UPDATE OR DELETE ON matches
+	DEFERRABLE INITIALLY DEFERRED
+	FOR EACH ROW EXECUTE PROCEDURE tournaments_publish_version();
+
+COMMIT;
@@ -3,67 +3,1445 @@
 # tournament.py -- implementation of a Swiss-system tournament
 #
 
+import bisect
+import collections
+import copy
+import functools
+import itertools
+import json
 import logging
 import math
+import os
+import random
+import re
+import sys
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+from matching import maxWeightMatching
+import tournament_tiebreaks
+
+
+# Database connection settings.
+# Each setting can be overridden with an environment variable,
+# or at runtime by calling configure().
+DSN = os.environ.get("TOURNAMENT_DSN", "dbname=tournament")
+POOL_MIN = int(os.environ.get("TOURNAMENT_POOL_MIN", "1"))
+POOL_MAX = int(os.environ.get("TOURNAMENT_POOL_MAX", "10"))
+# Number of seconds a pooled connection can sit idle before it is
+# health checked, the next time it is taken from the pool.
+HEALTH_CHECK_INTERVAL = float(
+    os.environ.get("TOURNAMENT_HEALTH_CHECK_INTERVAL", "30"))
+# The connection string of a database to send reads to, such as a streaming
+# replica of DSN, or None to send everything to DSN.
+READ_DSN = os.environ.get("TOURNAMENT_READ_DSN") or None
+# Whether reads only go to READ_DSN once it has caught up with the writes
+# this process has made, and how many seconds they wait for it to catch up
+# before they go to DSN instead. Set TOURNAMENT_READ_YOUR_WRITES to 0 to
+# read from READ_DSN however far behind it is.
+READ_YOUR_WRITES = os.environ.get("TOURNAMENT_READ_YOUR_WRITES", "1") != "0"
+READ_WAIT = float(os.environ.get("TOURNAMENT_READ_WAIT", "0.1"))
+
+# Where the tournament data is kept, "postgresql" or "memory".
+# Can be changed at runtime by calling useBackend().
+BACKEND = os.environ.get("TOURNAMENT_BACKEND", "postgresql")
+
+# The id of the tournament used when no tournament is given.
+DEFAULT_TOURNAMENT = 1
+# Where swissPairings() gets its possible pairings from, "memory" or "view".
+PAIRING_CANDIDATES = "memory"
+# How swissPairings() chooses pairs, "backtrack" or "matching".
+PAIRING_ENGINE = "backtrack"
+# How many places apart in the standings swissPairings() first looks for
+# pairs, or None to consider every pair. The window is doubled until a
+# complete set of pairs can be made within it.
+PAIRING_WINDOW = None
+# How many standings rows iterStandings() fetches from the database at once.
+STANDINGS_FETCH_SIZE = 1000
+# How players with the same rank are ordered in the standings, and so in
+# the pairings, as a list of tiebreaks from tournament_tiebreaks.TIEBREAKS,
+# most important first. Players still tied are ordered by id.
+TIEBREAKS = ("opponent_wins",)
+# How many times submitResult() tries a result whose transaction is rolled
+# back by a serialization failure or a deadlock, and how many seconds it
+# waits before the first retry, doubling before each retry after that.
+SUBMIT_ATTEMPTS = 5
+SUBMIT_RETRY_DELAY = 0.01
+
+_backend = None
+_cache = None
+_cursor_ids = itertools.count(1)
+_metrics = None
+_pool = None
+_pool_lock = threading.Lock()
+_read_pool = None
+_speculator = None
+
+
+def _timed(function):
+    """Decorator that records the latency of a public function
+    while metrics are enabled, see enableMetrics().
+    """
+    name = function.__name__
+
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        if _metrics is None:
+            return function(*args, **kwargs)
+        started = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _metrics.record("functions", name, time.time() - started)
+    return timed
 
 
 def connect():
     """Connect to the PostgreSQL database.  Returns a database connection."""
-    return psycopg2.connect("dbname=tournament")
+    return psycopg2.connect(DSN)
+
+
+def configure(dsn=None, minconn=None, maxconn=None,
+              health_check_interval=None, read_dsn=None):
+    """Change the database connection settings.
+
+    New pools are created with the new settings the next time a connection
+    is needed. Sessions already open keep the connections they took from
+    the old pools, and the old pools are closed once the last of them is
+    returned, see ConnectionPool.retire().
+
+    Args:
+      dsn: the libpq connection string for the tournament database.
+      minconn: the number of connections the pool keeps open.
+      maxconn: the maximum number of connections the pool will open.
+      health_check_interval: seconds a connection can be idle before
+        it is checked.
+      read_dsn: the libpq connection string for the database reads are
+        sent to, or "" to send reads to the tournament database.
+    """
+    global DSN, POOL_MIN, POOL_MAX, HEALTH_CHECK_INTERVAL, READ_DSN
+    global _pool, _read_pool
+    with _pool_lock:
+        if dsn is not None:
+            DSN = dsn
+        if read_dsn is not None:
+            READ_DSN = read_dsn or None
+        if minconn is not None:
+            POOL_MIN = minconn
+        if maxconn is not None:
+            POOL_MAX = maxconn
+        if health_check_interval is not None:
+            HEALTH_CHECK_INTERVAL = health_check_interval
+        if _pool is not None:
+            _pool.retire()
+            _pool = None
+        if _read_pool is not None:
+            _read_pool.retire()
+            _read_pool = None
+        if _cache is not None:
+            _cache.clear()
+
+
+def getPool():
+    """Returns the shared connection pool, creating it if needed.
+
+    A pool inherited from a parent process is not reused, since its
+    connections belong to the parent.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(
+                DSN, POOL_MIN, POOL_MAX, HEALTH_CHECK_INTERVAL)
+        return _pool
+
+
+def getReadPool():
+    """Returns the shared connection pool for reads, creating it if needed,
+    or None if reads are not sent to a database of their own.
+    """
+    global _read_pool
+    with _pool_lock:
+        if READ_DSN is None:
+            return None
+        if _read_pool is None or _read_pool.pid != os.getpid():
+            _read_pool = ConnectionPool(
+                READ_DSN, POOL_MIN, POOL_MAX, HEALTH_CHECK_INTERVAL)
+        return _read_pool
+
+
+def useBackend(backend):
+    """Change where the module functions keep the tournament data.
+
+    Args:
+      backend: "postgresql" to use the tournament database, "memory" to use
+        a new, empty in-memory store, or a backend object, such as a
+        PostgresBackend or a tournament_memory.MemoryBackend.
+
+    Returns:
+      The backend object now in use.
+    """
+    global BACKEND, _backend
+    if backend == "postgresql":
+        backend = PostgresBackend()
+    elif backend == "memory":
+        import tournament_memory
+        backend = tournament_memory.MemoryBackend()
+    elif not hasattr(backend, "session"):
+        raise ValueError("Unknown backend %r" % (backend,))
+    with _pool_lock:
+        BACKEND = backend.name
+        _backend = backend
+    return backend
+
+
+def getBackend():
+    """Returns the backend used by the module functions, creating it
+    from the BACKEND setting if needed.
+    """
+    if _backend is None:
+        useBackend(BACKEND)
+    return _backend
+
+
+class PostgresBackend(object):
+    """Keeps the tournament data in the PostgreSQL tournament database.
+
+    A backend hands out sessions, which do the work. Every backend has the
+    same session interface, see BaseSession.
+    """
+
+    name = "postgresql"
+
+    def __init__(self, pool=None, read_pool=None):
+        # Use the shared pools, as they are when each session starts,
+        # unless the backend is given pools of its own.
+        self.pool = pool
+        self.read_pool = read_pool
+
+    def session(self, tournament=None, read_only=False, consistent=None):
+        """Returns a new Session on the backend's connection pool, or on
+        its read pool if the session only reads.
+
+        A consistent read session only uses the read pool once the read
+        database has replayed this process's writes. Defaults to
+        READ_YOUR_WRITES.
+        """
+        read_pool = None
+        if read_only:
+            read_pool = self.read_pool
+            if read_pool is None and self.pool is None:
+                read_pool = getReadPool()
+        if consistent is None:
+            consistent = READ_YOUR_WRITES
+        return Session(self.pool or getPool(), tournament, read_pool,
+                       consistent)
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """A database connection that remembers the names of the statements
+    prepared on it, see Session.statements.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class ConnectionPool(object):
+    """A thread safe pool of connections to the tournament database.
+
+    Taking a connection blocks while all maxconn connections are in use.
+    A connection that has been idle for longer than the health check
+    interval is tested before it is handed out, and is replaced
+    if the test fails.
+
+    A pool that is no longer wanted is retired rather than closed, so the
+    sessions using it can finish.
+    """
+
+    def __init__(self, dsn, minconn, maxconn, health_check_interval):
+        self.dsn = dsn
+        self.health_check_interval = health_check_interval
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn, dsn, connection_factory=PreparingConnection)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        # The WAL position of the latest write committed through the pool,
+        # as text, and as a number to compare positions with.
+        self.last_write_lsn = None
+        self._last_write = -1
+        # The number of connections taken from the pool and not yet
+        # returned, and whether the pool closes once there are none.
+        self._in_use = 0
+        self.retired = False
+        # Whether the pool's database is a streaming replica, or None
+        # until a connection has been asked, see isReplica().
+        self.replica = None
+
+    def getconn(self):
+        """Take a healthy connection from the pool."""
+        self._slots.acquire()
+        with self._lock:
+            self._in_use += 1
+        try:
+            conn = self._pool.getconn()
+            last_used = self._last_used.pop(id(conn), None)
+            if (last_used is not None and
+                    time.time() - last_used > self.health_check_interval and
+                    not self._healthy(conn)):
+                logging.info("Replacing a broken database connection")
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+            return conn
+        except Exception:
+            self._release()
+            raise
+
+    def putconn(self, conn):
+        """Return a connection to the pool.
+
+        Any open transaction is rolled back, and a broken connection, or
+        one returned to a retired pool, is closed rather than reused.
+        """
+        close = bool(conn.closed) or self.retired
+        if (not close and conn.get_transaction_status() !=
+                psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+        if not close:
+            self._last_used[id(conn)] = time.time()
+        try:
+            self._pool.putconn(conn, close=close)
+        finally:
+            self._release()
+
+    def retire(self):
+        """Close the pool once every connection taken from it has been
+        returned. Connections returned until then are closed.
+        """
+        with self._lock:
+            self.retired = True
+            if not self._in_use and not self._pool.closed:
+                self.closeall()
+
+    def isReplica(self, conn):
+        """Returns whether the pool's database is a streaming replica,
+        asking on conn, one of the pool's connections, the first time.
+        """
+        if self.replica is None:
+            c = conn.cursor()
+            c.execute("SELECT pg_is_in_recovery();")
+            self.replica = c.fetchone()[0]
+            conn.rollback()
+        return self.replica
+
+    def _release(self):
+        """Free the slot of a connection that has been returned, or that
+        could not be taken, and close a retired pool once it is idle.
+        """
+        with self._lock:
+            self._in_use -= 1
+            if self.retired and not self._in_use and not self._pool.closed:
+                self.closeall()
+        self._slots.release()
+
+    def noteWrite(self, lsn):
+        """Remember the WAL position of a committed write, if it is later
+        than the ones already noted.
+        """
+        (high, low) = lsn.split("/")
+        position = (int(high, 16) << 32) + int(low, 16)
+        with self._lock:
+            if position > self._last_write:
+                self._last_write = position
+                self.last_write_lsn = lsn
+
+    def closeall(self):
+        """Close all the connections in the pool."""
+        self._last_used.clear()
+        self._pool.closeall()
+
+    def _healthy(self, conn):
+        """Returns True if the connection can still run a query."""
+        if conn.closed:
+            return False
+        try:
+            c = conn.cursor()
+            c.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+class BaseSession(object):
+    """The interface shared by the sessions of every storage backend.
+
+    A session is a unit of work against one tournament. When used as a
+    context manager, the session's work is committed when the block exits,
+    or rolled back if the block raises.
+
+        with tournament.session(tournament_id) as s:
+            s.registerPlayer("Kirk")
+            pairs = s.swissPairings()
+
+    The methods have the same arguments and results as the module functions
+    of the same names, less the tournament argument. A backend implements
+    the storage methods, and the pairing methods are built on top of them.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def commit(self):
+        """Commit the work done so far in the session."""
+        raise NotImplementedError
+
+    def rollback(self):
+        """Roll back the work done since the last commit."""
+        raise NotImplementedError
+
+    def beginSnapshot(self):
+        """Read everything that follows in the session from one snapshot,
+        unaffected by other sessions' writes.
+        """
+        raise NotImplementedError
+
+    def createTournament(self, name):
+        """Adds a tournament, and returns its id."""
+        raise NotImplementedError
+
+    def deleteTournament(self):
+        """Remove the tournament, and all its players and matches."""
+        raise NotImplementedError
+
+    def deleteMatches(self):
+        """Remove all the tournament's match records."""
+        raise NotImplementedError
+
+    def deletePlayers(self):
+        """Remove all the tournament's player records."""
+        raise NotImplementedError
+
+    def countPlayers(self):
+        """Returns the number of players currently registered."""
+        raise NotImplementedError
+
+    def countMatches(self):
+        """Returns the number of matches recorded, byes included."""
+        raise NotImplementedError
+
+    def registerPlayer(self, name):
+        """Adds a player to the tournament, and returns the player's id."""
+        raise NotImplementedError
+
+    def registerPlayers(self, names):
+        """Adds a list of players to the tournament at once."""
+        raise NotImplementedError
+
+    def playerStandings(self, as_of_round=None):
+        """Returns a list of the players and their win records, as they
+        were when the round as_of_round was closed, if given.
+        """
+        raise NotImplementedError
+
+    def rankedStandings(self, as_of_round=None, tiebreaks=None):
+        """Returns the standings, as playerStandings() does, with the
+        players of the same rank ordered by the given tiebreaks.
+        Defaults to TIEBREAKS.
+        """
+        if tiebreaks is None:
+            tiebreaks = TIEBREAKS
+        standings = self.playerStandings(as_of_round)
+        if tuple(tiebreaks) == ("opponent_wins",):
+            # The order the backends already return the standings in.
+            return standings
+        return tournament_tiebreaks.orderStandings(
+            standings, self.matchResults(as_of_round), tiebreaks)
+
+    def matchResults(self, through_round=None):
+        """Returns a list of (player1, player2, winner) tuples of every
+        match recorded, byes included, or of the matches up to the end of
+        the round through_round, if given.
+        """
+        raise NotImplementedError
+
+    def currentRound(self):
+        """Returns the round that new matches are recorded in."""
+        raise NotImplementedError
+
+    def closeRound(self):
+        """Snapshot the standings, and start the next round.
+        Returns the round that was closed.
+        """
+        raise NotImplementedError
+
+    def roundDeltas(self, round):
+        """Returns how each player's standing changed over a closed round.
+
+        See the module function roundDeltas().
+        """
+        after = self.rankedStandings(round)
+        before = self.rankedStandings(round - 1) if round > 1 else []
+        places = dict((row[0], (place, row))
+                      for (place, row) in enumerate(before, 1))
+        no_results = (None, None, 0, 0, 0, 0, 0, 0.0)
+        deltas = []
+        for (place, row) in enumerate(after, 1):
+            (previous_place, previous) = places.get(row[0], (None, no_results))
+            deltas.append((row[0], row[1], place, previous_place) + tuple(
+                row[i] - previous[i] for i in range(2, 8)))
+        return deltas
+
+    def iterStandings(self, after=None, limit=None, fetch_size=None):
+        """Yields the players and their win records, up to limit of them,
+        starting after the standings row after, if given.
+        """
+        raise NotImplementedError
+
+    def reportMatch(self, player1, player2, winner=None):
+        """Records the outcome of a single match between two players."""
+        raise NotImplementedError
+
+    def reportMatches(self, results):
+        """Records the outcomes of a round of matches."""
+        raise NotImplementedError
+
+    def submitResult(self, player1, player2, winner=None):
+        """Records the outcome of a match, unless it is already recorded.
+        Returns True if it was recorded.
+        """
+        raise NotImplementedError
+
+    def lockPairing(self):
+        """Wait for the results being submitted to the tournament, and hold
+        back new ones, until the session ends.
+        """
+        raise NotImplementedError
+
+    def checkPlayerStats(self):
+        """Compare the running player totals with a full recompute."""
+        raise NotImplementedError
+
+    def rebuildPlayerStats(self):
+        """Recompute the running player totals from the match history."""
+        raise NotImplementedError
+
+    def standingsPlan(self, analyze=False):
+        """Returns the query plan for recomputing the full standings."""
+        raise NotImplementedError
+
+    def exportTournament(self, players, matches):
+        """Write the tournament's players and matches to two files."""
+        raise NotImplementedError
+
+    def importTournament(self, players, matches, current_round=None):
+        """Read players and matches, written by exportTournament(), into
+        the tournament, which must have no players.
+        """
+        raise NotImplementedError
+
+    def possibleByePlayers(self):
+        """Get the list of players that have not had a bye."""
+        raise NotImplementedError
+
+    def possiblePairings(self, window=None):
+        """Get the list of possible pairings for a round, of players at
+        most window places apart in the standings, if given.
+        """
+        raise NotImplementedError
+
+    def playedPairs(self):
+        """Get the set of pairs of players that have already played."""
+        raise NotImplementedError
+
+    def matchWinners(self, pairs):
+        """Returns a dictionary of the winners of the given pairs of players
+        that have played, keyed by (lower id, higher id).
+        """
+        raise NotImplementedError
+
+    def swissPairings(self, candidates=None, engine=None, window=None):
+        """Returns a list of pairs of players for the next round of a match.
+
+        See the module function swissPairings() for the pairing rules.
+        """
+        if candidates is None:
+            candidates = PAIRING_CANDIDATES
+
+        self.lockPairing()
+        standings = self.rankedStandings()
+        player_ids = [row[0] for row in standings]
+
+        if candidates == "view":
+            # Get the possible bye players and the possible pairings,
+            # with names, from the backend.
+            possible_bye_players = []
+            if len(standings) % 2 != 0:
+                possible_bye_players = self.possibleByePlayers()
+            possible_pairs = self.possiblePairings
+            if tuple(TIEBREAKS) != ("opponent_wins",):
+                # The view orders players of the same rank by opponent
+                # wins, so put them in the tiebreak order, and count the
+                # places of a window here.
+                positions = dict((id, i) for (i, id) in enumerate(player_ids))
+                possible_bye_players.sort(
+                    key=lambda player: positions[player[0]])
+                possible_pairs = sorted(
+                    self.possiblePairings(),
+                    key=lambda pair: (positions[pair[0]], positions[pair[2]]))
+                return pairPossiblePairs(
+                    player_ids, possible_bye_players, possible_pairs,
+                    engine, window)
+            return pairWithinWindow(
+                player_ids, possible_bye_players, possible_pairs,
+                engine, window)
+        elif candidates == "memory":
+            # Get the pairs of players that have already played, and work
+            # out the possible pairings here.
+            return pairStandings(
+                standings, self.playedPairs(), engine, window)
+        raise ValueError("Unknown pairing candidates %r" % (candidates,))
+
+
+class Session(BaseSession):
+    """A unit of work against the PostgreSQL tournament database.
+
+    A session takes one connection from the pool, and all its calls share
+    that connection, and its transaction. A session given a read pool only
+    reads, and takes its connection from the read pool instead, unless it
+    is consistent and the read database has not caught up with the writes
+    made through the pool.
+    """
+
+    # The statements run on every pairing and every result, prepared once
+    # on each pooled connection, so PostgreSQL plans the view expansions
+    # once rather than on every call. Parameters are $1, $2, ...
+    statements = {
+        # The version, and the version this transaction has taken for its
+        # own changes, if any, see tournaments_new_version().
+        "tournament_version": """SELECT version,
+            current_setting('tournament.version_' || id, true)
+            FROM tournaments WHERE id = $1""",
+        "player_standings": """SELECT id, name, wins, draws, opponent_wins,
+            played, byes, rank FROM standings WHERE tournament_id = $1
+            ORDER BY rank, opponent_wins DESC, id""",
+        "possible_bye_players": """SELECT id, name FROM standings
+            WHERE tournament_id = $1 AND byes = 0
+            ORDER BY rank, opponent_wins DESC, id""",
+        "possible_pairings": """SELECT id1, name1, id2, name2
+            FROM possible_pairings WHERE tournament_id = $1
+            ORDER BY rank1, opponent_wins1 DESC, id1,
+            rank2, opponent_wins2 DESC, id2""",
+        # Number the players in standings order, and join each player
+        # to the players up to $2 places either side by position,
+        # so only O(n * window) pairs are looked at rather than O(n^2).
+        "possible_pairings_window": """WITH positions AS (
+            SELECT id, name, ROW_NUMBER() OVER (
+                ORDER BY rank, opponent_wins DESC, id) AS position
+            FROM standings WHERE tournament_id = $1)
+            SELECT a.id, a.name, b.id, b.name FROM positions a
+            CROSS JOIN generate_series(-$2::integer, $2) AS offsets (step)
+            JOIN positions b ON b.position = a.position + step
+            WHERE step != 0
+            AND NOT EXISTS (SELECT 1 FROM matches
+                WHERE matches.tournament_id = $1
+                AND matches.player1 = a.id AND matches.player2 = b.id)
+            AND NOT EXISTS (SELECT 1 FROM matches
+                WHERE matches.tournament_id = $1
+                AND matches.player1 = b.id AND matches.player2 = a.id)
+            ORDER BY a.position, b.position""",
+        "round_standings": """SELECT players.id, players.name,
+            r.wins, r.draws, r.opponent_wins, r.played, r.byes, r.rank
+            FROM round_standings r JOIN players ON players.id = r.id
+            WHERE r.tournament_id = $1 AND r.round = $2
+            ORDER BY r.rank, r.opponent_wins DESC, r.id""",
+        "match_results": """SELECT player1, player2, winner FROM matches
+            WHERE tournament_id = $1 AND ($2::integer IS NULL OR round <= $2)
+            ORDER BY round, player1, player2""",
+        "played_pairs": """SELECT player1, player2 FROM matches
+            WHERE tournament_id = $1 AND player1 != player2""",
+        # Takes the tournament's results lock, see _lockResults().
+        "report_match": """WITH results_lock AS (
+            SELECT pg_advisory_xact_lock_shared($1::integer))
+            INSERT INTO matches (tournament_id, player1, player2, winner)
+            SELECT $1::integer, $2::integer, $3::integer, $4::integer
+            FROM results_lock""",
+    }
+
+    def __init__(self, pool=None, tournament=None, read_pool=None,
+                 consistent=True):
+        self.pool = pool or getPool()
+        if tournament is None:
+            tournament = DEFAULT_TOURNAMENT
+        self.tournament = tournament
+        self.read_pool = read_pool
+        self.consistent = consistent
+        # The pool the session's connection came from.
+        self.source = None
+        self.conn = None
+
+    def __enter__(self):
+        if _metrics is None:
+            self._getconn()
+        else:
+            started = time.time()
+            self._getconn()
+            _metrics.record("connections", "getconn", time.time() - started)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+                if self.read_pool is None and READ_DSN is not None:
+                    self._noteWrite()
+        finally:
+            self.source.putconn(self.conn)
+            self.source = None
+            self.conn = None
+        return False
+
+    def _getconn(self):
+        """Take a connection from the read pool, if the session has one,
+        and the read database is up to date enough, or from the pool.
+
+        A read database that is not a streaming replica has no replay
+        position to wait for, so consistent reads go straight to the pool
+        once the process has written.
+        """
+        if self.read_pool is not None:
+            conn = self.read_pool.getconn()
+            lsn = self.pool.last_write_lsn
+            if (not self.consistent or lsn is None or
+                    (self.read_pool.isReplica(conn) and
+                     self._caughtUp(conn, lsn))):
+                self.source, self.conn = self.read_pool, conn
+                return
+            self.read_pool.putconn(conn)
+            logging.debug("The read database is behind, so reading from "
+                          "the tournament database")
+        self.source, self.conn = self.pool, self.pool.getconn()
+
+    def _caughtUp(self, conn, lsn):
+        """Returns True once the read database on a connection has replayed
+        the WAL up to lsn, or False if it has not within READ_WAIT seconds.
+        """
+        deadline = time.time() + READ_WAIT
+        c = conn.cursor()
+        while True:
+            c.execute("""SELECT COALESCE(
+                        pg_last_wal_replay_lsn() >= %s::pg_lsn, false);""",
+                      (lsn,))
+            caught_up = c.fetchone()[0]
+            conn.rollback()
+            if caught_up or time.time() >= deadline:
+                return caught_up
+            time.sleep(0.005)
+
+    def _noteWrite(self):
+        """Note the WAL position after the session's transaction, so that
+        consistent reads wait until the read database has replayed it.
+        """
+        lsn = self._execute("SELECT pg_current_wal_lsn();").fetchone()[0]
+        self.conn.rollback()
+        self.pool.noteWrite(lsn)
+
+    def commit(self):
+        """Commit the work done so far in the session."""
+        self.conn.commit()
+
+    def rollback(self):
+        """Roll back the work done since the last commit."""
+        self.conn.rollback()
+
+    def beginSnapshot(self):
+        """Read everything that follows in the transaction from one snapshot.
+
+        Must be called before anything else in the transaction.
+        """
+        self._execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;")
+
+    def _execute(self, sql, args=None):
+        """Execute a statement and return the cursor holding its results."""
+        c = self.conn.cursor()
+        if _metrics is None:
+            c.execute(sql, args)
+        else:
+            started = time.time()
+            try:
+                c.execute(sql, args)
+            finally:
+                _metrics.recordQuery(sql, time.time() - started)
+        return c
+
+    def _copy(self, sql, file):
+        """Run a COPY statement, to or from a file."""
+        started = time.time()
+        try:
+            self.conn.cursor().copy_expert(sql, file)
+        finally:
+            if _metrics is not None:
+                _metrics.recordQuery(sql, time.time() - started)
+
+    def _executePrepared(self, name, args):
+        """Execute one of the statements, preparing it first if it has
+        not yet been prepared on the session's connection.
+
+        A prepared statement lasts as long as its connection, even if
+        the transaction that prepared it is rolled back.
+        """
+        prepared = getattr(self.conn, "prepared", None)
+        if prepared is None:
+            # Not a PreparingConnection, so run the statement as it is.
+            sql = re.sub(r"\$(\d+)", r"%(\1)s", self.statements[name])
+            return self._execute(sql + ";", dict(
+                (str(i + 1), arg) for (i, arg) in enumerate(args)))
+        if name not in prepared:
+            self._execute("PREPARE %s AS %s;" % (name, self.statements[name]))
+            prepared.add(name)
+        return self._execute(
+            "EXECUTE %s (%s);" % (name, ", ".join(["%s"] * len(args))), args)
+
+    def createTournament(self, name):
+        """Adds a tournament to the database, and returns its id."""
+        sql = "INSERT INTO tournaments (name) VALUES (%s) RETURNING id;"
+        return self._execute(sql, (name,)).fetchone()[0]
+
+    def deleteTournament(self):
+        """Remove the tournament, and all its players and matches."""
+        self._execute("DELETE FROM matches WHERE tournament_id = %s;",
+                      (self.tournament,))
+        self._execute("DELETE FROM tournaments WHERE id = %s;",
+                      (self.tournament,))
+
+    def deleteMatches(self):
+        """Remove all the tournament's match records from the database,
+        and its rounds.
+        """
+        self._execute("DELETE FROM matches WHERE tournament_id = %s;",
+                      (self.tournament,))
+        self._resetRounds()
+
+    def _resetRounds(self):
+        """Remove the round standings, and go back to the first round."""
+        self._execute("DELETE FROM round_standings WHERE tournament_id = %s;",
+                      (self.tournament,))
+        self._execute("""UPDATE tournaments SET current_round = 1,
+                    version = tournaments_new_version(id)
+                    WHERE id = %s AND current_round != 1;""",
+                      (self.tournament,))
 
+    def deletePlayers(self):
+        """Remove all the tournament's player records from the database,
+        and its rounds.
+        """
+        self._execute("DELETE FROM players WHERE tournament_id = %s;",
+                      (self.tournament,))
+        self._resetRounds()
 
-def deleteMatches():
-    """Remove all the match records from the database."""
-    conn = connect()
-    c = conn.cursor()
-    c.execute("DELETE FROM matches;")
-    conn.commit()
-    conn.close()
+    def countPlayers(self):
+        """Returns the number of players currently registered."""
+        sql = "SELECT COUNT(id) FROM players WHERE tournament_id = %s;"
+        return self._execute(sql, (self.tournament,)).fetchone()[0]
 
+    def countMatches(self):
+        """Returns the number of matches recorded, byes included."""
+        sql = "SELECT COUNT(*) FROM matches WHERE tournament_id = %s;"
+        return self._execute(sql, (self.tournament,)).fetchone()[0]
 
-def deletePlayers():
-    """Remove all the player records from the database."""
-    conn = connect()
-    c = conn.cursor()
-    c.execute("DELETE FROM players;")
-    conn.commit()
-    conn.close()
+    def registerPlayer(self, name):
+        """Adds a player to the tournament database."""
+        sql = """INSERT INTO Players (tournament_id, name) VALUES (%s, %s)
+                    RETURNING id;"""
+        return self._execute(sql, (self.tournament, name)).fetchone()[0]
 
+    def registerPlayers(self, names):
+        """Adds a list of players to the tournament database at once."""
+        if not names:
+            return []
+        # Inserting the names in input order makes the serial ids ascend
+        # in input order, so sorting the returned ids lines them up with
+        # the names, whatever order RETURNING produces them in.
+        sql = """INSERT INTO players (tournament_id, name)
+                    SELECT %s, name FROM unnest(%s::text[])
+                    WITH ORDINALITY AS t (name, position)
+                    ORDER BY position
+                    RETURNING id;"""
+        args = (self.tournament, list(names))
+        return sorted(row[0] for row in self._execute(sql, args))
 
-def countPlayers():
-    """Returns the number of players currently registered."""
-    conn = connect()
-    c = conn.cursor()
-    c.execute("SELECT COUNT(id) FROM players;")
-    row = c.fetchone()
-    conn.close()
-    return row[0]
+    def _cached(self, name, read):
+        """Returns the result of read(), from the standings cache if the
+        cache holds it for the tournament's current version.
 
+        Reads in a transaction that has changed the tournament are not
+        cached, since the changes are not yet committed.
+        """
+        if _cache is None:
+            return read()
+        row = self._executePrepared(
+            "tournament_version", (self.tournament,)).fetchone()
+        if row is None or row[1]:
+            return read()
+        key = (getattr(self.pool, "dsn", None), self.tournament)
+        result = _cache.get(key, row[0], name)
+        if result is None:
+            result = read()
+            _cache.put(key, row[0], name, result)
+        return copy.copy(result)
 
-def registerPlayer(name):
+    def playerStandings(self, as_of_round=None):
+        """Returns a list of the players and their win records, as they
+        were when the round as_of_round was closed, if given.
+        """
+        if as_of_round is None:
+            return self._cached(
+                "playerStandings", lambda: self._executePrepared(
+                    "player_standings", (self.tournament,)).fetchall())
+        rows = self._cached(
+            "playerStandings[%d]" % as_of_round,
+            lambda: self._executePrepared(
+                "round_standings", (self.tournament, as_of_round)).fetchall())
+        if not rows and not 1 <= as_of_round < self.currentRound():
+            raise ValueError("Round %d has not been closed" % as_of_round)
+        return rows
+
+    def matchResults(self, through_round=None):
+        """Returns a list of (player1, player2, winner) tuples of every
+        match recorded, byes included, or of the matches up to the end of
+        the round through_round, if given.
+        """
+        name = "matchResults"
+        if through_round is not None:
+            name = "matchResults[%d]" % through_round
+        return self._cached(name, lambda: self._executePrepared(
+            "match_results", (self.tournament, through_round)).fetchall())
+
+    def currentRound(self):
+        """Returns the round that new matches are recorded in."""
+        sql = "SELECT current_round FROM tournaments WHERE id = %s;"
+        row = self._execute(sql, (self.tournament,)).fetchone()
+        return row[0] if row is not None else None
+
+    def closeRound(self):
+        """Snapshot the standings, and start the next round.
+        Returns the round that was closed.
+        """
+        # Waits for the results being written, and holds back new ones,
+        # so no matches can be recorded in the round while the snapshot is
+        # taken. The version changes, so that cached standings for the
+        # round are read again.
+        self.lockPairing()
+        sql = """UPDATE tournaments SET current_round = current_round + 1,
+                    version = tournaments_new_version(id)
+                    WHERE id = %s RETURNING current_round - 1;"""
+        row = self._execute(sql, (self.tournament,)).fetchone()
+        if row is None:
+            raise ValueError(
+                "Tournament %s does not exist" % (self.tournament,))
+        round = row[0]
+        self._execute("""INSERT INTO round_standings (tournament_id, round, id,
+                    wins, draws, played, byes, opponent_wins, rank)
+                    SELECT tournament_id, %s, id,
+                    wins, draws, played, byes, opponent_wins, rank
+                    FROM player_stats WHERE tournament_id = %s;""",
+                      (round, self.tournament))
+        return round
+
+    def iterStandings(self, after=None, limit=None, fetch_size=None):
+        """Yields the players and their win records, up to limit of them,
+        starting after the standings row after, if given.
+
+        The rows are read through a server-side cursor, fetch_size rows
+        at a time, so only one batch is held in memory at once.
+        """
+        sql = """SELECT id, name, wins, draws, opponent_wins, played, byes, rank
+                    FROM standings WHERE tournament_id = %(tournament)s"""
+        args = {"tournament": self.tournament, "limit": limit}
+        if after is not None:
+            # Seek past the given row, rather than counting rows with an
+            # OFFSET, so the player_stats_rank index can start each page
+            # where the last one ended.
+            sql += """ AND rank >= %(rank)s AND (rank > %(rank)s
+                    OR opponent_wins < %(opponent_wins)s
+                    OR (opponent_wins = %(opponent_wins)s AND id > %(id)s))"""
+            args.update(rank=after[7], opponent_wins=after[4], id=after[0])
+        sql += """ ORDER BY rank, opponent_wins DESC, id
+                    LIMIT %(limit)s;"""
+
+        c = self.conn.cursor("standings_%d" % next(_cursor_ids))
+        c.itersize = fetch_size or STANDINGS_FETCH_SIZE
+        try:
+            started = time.time()
+            try:
+                c.execute(sql, args)
+            finally:
+                if _metrics is not None:
+                    _metrics.recordQuery(sql, time.time() - started)
+            for row in c:
+                yield row
+        finally:
+            c.close()
+
+    def reportMatch(self, player1, player2, winner=None):
+        """Records the outcome of a single match between two players."""
+        self._executePrepared(
+            "report_match", (self.tournament, player1, player2, winner))
+
+    def reportMatches(self, results):
+        """Records the outcomes of a round of matches with one statement."""
+        rows = [_matchRow(result) for result in results]
+        if not rows:
+            return []
+        self._lockResults()
+        sql = """INSERT INTO matches (tournament_id,player1,player2,winner)
+                    VALUES %s;"""
+
+        # Try to insert the whole round at once.
+        # If that fails, fall back to inserting the rows one at a time,
+        # so that we can find out which rows are bad, and keep the rest.
+        self._execute("SAVEPOINT report_matches;")
+        started = time.time()
+        try:
+            try:
+                psycopg2.extras.execute_values(
+                    self.conn.cursor(), sql,
+                    [(self.tournament,) + row for row in rows],
+                    page_size=len(rows))
+            finally:
+                if _metrics is not None:
+                    _metrics.recordQuery(sql, time.time() - started)
+            self._execute("RELEASE SAVEPOINT report_matches;")
+            return []
+        except psycopg2.Error:
+            self._execute("ROLLBACK TO SAVEPOINT report_matches;")
+            self._execute("RELEASE SAVEPOINT report_matches;")
+
+        errors = []
+        for i, row in enumerate(rows):
+            self._execute("SAVEPOINT report_match;")
+            try:
+                self.reportMatch(*row)
+            except psycopg2.Error as e:
+                self._execute("ROLLBACK TO SAVEPOINT report_match;")
+                errors.append((i, row, str(e).strip()))
+            self._execute("RELEASE SAVEPOINT report_match;")
+        logging.info("%d of %d match results could not be recorded",
+                     len(errors), len(rows))
+        return errors
+
+    def submitResult(self, player1, player2, winner=None):
+        """Records the outcome of a match, unless it is already recorded.
+        Returns True if it was recorded.
+
+        Submissions to a tournament share a lock that pairing takes alone,
+        and submissions of the same pair of players take turns, so a
+        result is only looked up once no other session can be recording
+        it. The lookup uses the matches_pair index, so the players can be
+        given in either order.
+        """
+        self._lockResults()
+        self._execute("SELECT pg_advisory_xact_lock(%s, %s);",
+                      (self.tournament, min(player1, player2)))
+        sql = """SELECT winner FROM matches WHERE tournament_id = %s
+                    AND LEAST(player1, player2) = %s
+                    AND GREATEST(player1, player2) = %s;"""
+        row = self._execute(sql, (self.tournament, min(player1, player2),
+                                  max(player1, player2))).fetchone()
+        if row is None:
+            self.reportMatch(player1, player2, winner)
+            return True
+        if row[0] != winner:
+            raise ValueError(
+                "The match (%s, %s) has already been reported with a "
+                "different result" % (player1, player2))
+        return False
+
+    def _lockResults(self):
+        """Share the tournament's results lock until the session ends, so
+        that the results written are held back while it is being paired.
+        Every statement that writes matches takes it.
+        """
+        self._execute("SELECT pg_advisory_xact_lock_shared(%s::bigint);",
+                      (self.tournament,))
+
+    def lockPairing(self):
+        """Wait for the results being submitted to the tournament, and hold
+        back new ones, until the session ends.
+        """
+        self._execute("SELECT pg_advisory_xact_lock(%s::bigint);",
+                      (self.tournament,))
+
+    def checkPlayerStats(self):
+        """Compare the player stats table with a full recompute."""
+        sql = """SELECT COALESCE(s.id, f.id),
+                    f.wins, f.draws, f.played, f.byes, f.opponent_wins, f.rank,
+                    s.wins, s.draws, s.played, s.byes, s.opponent_wins, s.rank
+                    FROM (SELECT * FROM player_stats
+                          WHERE tournament_id = %s) s
+                    FULL OUTER JOIN (SELECT * FROM standings_full
+                                     WHERE tournament_id = %s) f
+                    ON s.id = f.id
+                    WHERE (s.wins, s.draws, s.played, s.byes,
+                           s.opponent_wins, s.rank)
+                    IS DISTINCT FROM (f.wins, f.draws, f.played, f.byes,
+                                      f.opponent_wins, f.rank)
+                    ORDER BY 1;"""
+        args = (self.tournament, self.tournament)
+        return [(row[0], tuple(row[1:7]), tuple(row[7:13]))
+                for row in self._execute(sql, args)]
+
+    def rebuildPlayerStats(self):
+        """Recompute the player stats table from the match history."""
+        self._execute("DELETE FROM player_stats WHERE tournament_id = %s;",
+                      (self.tournament,))
+        self._execute("""INSERT INTO player_stats (id, tournament_id,
+                            wins, draws, played, byes, opponent_wins, rank)
+                            SELECT id, tournament_id,
+                            wins, draws, played, byes, opponent_wins, rank
+                            FROM standings_full WHERE tournament_id = %s;""",
+                      (self.tournament,))
+        # The stats are not covered by the version triggers.
+        self._execute("""UPDATE tournaments
+                            SET version = tournaments_new_version(id)
+                            WHERE id = %s;""", (self.tournament,))
+
+    def exportTournament(self, players, matches):
+        """Write the tournament's players and matches to two CSV files,
+        with COPY, so the rows are streamed rather than held in memory.
+        """
+        self._copy("""COPY (SELECT id, name FROM players
+                    WHERE tournament_id = %d ORDER BY id)
+                    TO STDOUT WITH (FORMAT csv, HEADER);"""
+                   % self.tournament, players)
+        self._copy("""COPY (SELECT player1, player2, winner, round FROM matches
+                    WHERE tournament_id = %d ORDER BY round, player1, player2)
+                    TO STDOUT WITH (FORMAT csv, HEADER);"""
+                   % self.tournament, matches)
+
+    def importTournament(self, players, matches, current_round=None):
+        """Read players and matches, written by exportTournament(), into
+        the tournament, which must have no players.
+
+        Both files are loaded with COPY into temporary tables, checked
+        with one query, and inserted with one statement each. The player
+        stats triggers are skipped for the imported matches, and the
+        checks of the matches' players are deferred, so the stats are
+        rebuilt, and the players checked, once at the end.
+        """
+        sql = """SELECT COUNT(players.id) FROM tournaments
+                    LEFT JOIN players ON players.tournament_id = tournaments.id
+                    WHERE tournaments.id = %s GROUP BY tournaments.id;"""
+        row = self._execute(sql, (self.tournament,)).fetchone()
+        if row is None:
+            raise ValueError(
+                "Tournament %s does not exist" % (self.tournament,))
+        if row[0]:
+            raise ValueError("Tournament %s already has players"
+                             % (self.tournament,))
+        if current_round is not None and current_round < 1:
+            raise ValueError("The current round must be at least 1")
+
+        self._execute("""CREATE TEMPORARY TABLE import_players (
+                    old_id integer PRIMARY KEY, name text, id integer)
+                    ON COMMIT DROP;""")
+        self._execute("""CREATE TEMPORARY TABLE import_matches (
+                    player1 integer, player2 integer, winner integer,
+                    round integer) ON COMMIT DROP;""")
+        self._copy("""COPY import_players (old_id, name)
+                    FROM STDIN WITH (FORMAT csv, HEADER);""", players)
+        self._copy("""COPY import_matches (player1, player2, winner, round)
+                    FROM STDIN WITH (FORMAT csv, HEADER);""", matches)
+
+        # Check every match at once, before anything is inserted.
+        sql = """SELECT m.player1, m.player2, m.winner, m.round
+                    FROM import_matches m
+                    LEFT JOIN import_players p1 ON p1.old_id = m.player1
+                    LEFT JOIN import_players p2 ON p2.old_id = m.player2
+                    WHERE p1.old_id IS NULL OR p2.old_id IS NULL
+                    OR m.winner NOT IN (m.player1, m.player2)
+                    OR m.round IS NULL OR m.round < 1
+                    LIMIT 1;"""
+        row = self._execute(sql).fetchone()
+        if row is not None:
+            raise ValueError("The match %r has an unknown player, a winner "
+                             "that did not play, or no round" % (row,))
+
+        # Give the players new ids, in the order of their old ones.
+        self._execute("""UPDATE import_players SET id = new.id
+                    FROM (SELECT old_id,
+                          nextval(pg_get_serial_sequence('players', 'id'))
+                          AS id
+                          FROM (SELECT old_id FROM import_players
+                                ORDER BY old_id) AS ordered) AS new
+                    WHERE import_players.old_id = new.old_id;""")
+        self._execute("""INSERT INTO players (id, tournament_id, name)
+                    SELECT id, %s, name FROM import_players ORDER BY id;""",
+                      (self.tournament,))
+
+        self._lockResults()
+        self._execute("SET CONSTRAINTS ALL DEFERRED;")
+        self._execute("SELECT set_config('tournament.importing', 'on', true);")
+        self._execute("""INSERT INTO matches
+                    (tournament_id, player1, player2, winner, round)
+                    SELECT %s, p1.id, p2.id, w.id, m.round
+                    FROM import_matches m
+                    JOIN import_players p1 ON p1.old_id = m.player1
+                    JOIN import_players p2 ON p2.old_id = m.player2
+                    LEFT JOIN import_players w ON w.old_id = m.winner;""",
+                      (self.tournament,))
+        self._execute(
+            "SELECT set_config('tournament.importing', 'off', true);")
+        self._execute("SET CONSTRAINTS ALL IMMEDIATE;")
+        self.rebuildPlayerStats()
+
+        # The last round played is left open, unless told otherwise, and
+        # the standings of each round before it are recounted from the
+        # matches up to that round.
+        if current_round is None:
+            sql = "SELECT COALESCE(MAX(round), 1) FROM import_matches;"
+            current_round = self._execute(sql).fetchone()[0]
+        self._execute("""UPDATE tournaments SET current_round = %s
+                    WHERE id = %s;""", (current_round, self.tournament))
+        self._execute("""INSERT INTO round_standings (tournament_id, round, id,
+                    wins, draws, played, byes, opponent_wins, rank)
+                    WITH rounds AS (
+                        SELECT generate_series(1, %(closed)s) AS round),
+                    perspectives AS (
+                        SELECT rounds.round, m.player1 AS id,
+                        NULLIF(m.player2, m.player1) AS opponent_id, m.winner
+                        FROM rounds JOIN matches m ON m.round <= rounds.round
+                        WHERE m.tournament_id = %(tournament)s
+                        UNION ALL
+                        SELECT rounds.round, m.player2, m.player1, m.winner
+                        FROM rounds JOIN matches m ON m.round <= rounds.round
+                        WHERE m.tournament_id = %(tournament)s
+                        AND m.player1 != m.player2),
+                    totals AS (
+                        SELECT rounds.round, players.id,
+                        COUNT(p.id) AS played,
+                        COUNT(CASE WHEN p.winner = players.id THEN 1 END)
+                            AS wins,
+                        COUNT(CASE WHEN p.id IS NOT NULL
+                            AND p.winner IS NULL THEN 1 END) AS draws,
+                        COUNT(CASE WHEN p.id IS NOT NULL
+                            AND p.opponent_id IS NULL THEN 1 END) AS byes
+                        FROM rounds CROSS JOIN players
+                        LEFT JOIN perspectives p
+                        ON p.round = rounds.round AND p.id = players.id
+                        WHERE players.tournament_id = %(tournament)s
+                        GROUP BY rounds.round, players.id)
+                    SELECT %(tournament)s, t.round, t.id,
+                    t.wins, t.draws, t.played, t.byes,
+                    COALESCE(SUM(o.wins), 0),
+                    t.played - t.wins - t.draws::float / 2
+                    FROM totals t
+                    LEFT JOIN perspectives p
+                    ON p.round = t.round AND p.id = t.id
+                    LEFT JOIN totals o
+                    ON o.round = p.round AND o.id = p.opponent_id
+                    GROUP BY t.round, t.id,
+                    t.wins, t.draws, t.played, t.byes;""",
+                      {"closed": current_round - 1,
+                       "tournament": self.tournament})
+
+        counts = self._execute("""SELECT (SELECT COUNT(*) FROM import_players),
+                    (SELECT COUNT(*) FROM import_matches);""").fetchone()
+        self._execute("DROP TABLE import_players, import_matches;")
+        return tuple(counts)
+
+    def standingsPlan(self, analyze=False):
+        """Returns the query plan for recomputing the full standings."""
+        if analyze:
+            self._execute("ANALYZE players;")
+            self._execute("ANALYZE matches;")
+        sql = """EXPLAIN (FORMAT JSON)
+                    SELECT * FROM standings_full WHERE tournament_id = %s;"""
+        plan = self._execute(sql, (self.tournament,)).fetchone()[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        return plan[0]["Plan"]
+
+    def possibleByePlayers(self):
+        """Get the list of players that have not had a bye."""
+        return self._cached(
+            "possibleByePlayers", lambda: self._executePrepared(
+                "possible_bye_players", (self.tournament,)).fetchall())
+
+    def possiblePairings(self, window=None):
+        """Get the list of possible pairings for a round, of players at
+        most window places apart in the standings, if given.
+        """
+        if window is None:
+            return self._cached(
+                "possiblePairings", lambda: self._executePrepared(
+                    "possible_pairings", (self.tournament,)).fetchall())
+        return self._cached(
+            "possiblePairings[%d]" % window, lambda: self._executePrepared(
+                "possible_pairings_window",
+                (self.tournament, window)).fetchall())
+
+    def playedPairs(self):
+        """Get the set of pairs of players that have already played."""
+        return self._cached("playedPairs", lambda: set(
+            (min(row), max(row)) for row in self._executePrepared(
+                "played_pairs", (self.tournament,))))
+
+    def matchWinners(self, pairs):
+        """Returns a dictionary of the winners of the given pairs of players
+        that have played, keyed by (lower id, higher id).
+        """
+        if not pairs:
+            return {}
+        sql = """SELECT LEAST(player1, player2), GREATEST(player1, player2),
+                    winner FROM matches WHERE tournament_id = %s
+                    AND (LEAST(player1, player2), GREATEST(player1, player2))
+                    IN %s;"""
+        args = (self.tournament, tuple(pairs))
+        return dict(((id1, id2), winner)
+                    for (id1, id2, winner) in self._execute(sql, args))
+
+
+def session(tournament=None, read_only=False, consistent=None):
+    """Returns a new session on the backend in use, see useBackend().
+
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+      read_only: True if the session only reads, so it can read from
+        READ_DSN, if set.
+      consistent: True if a read only session must see the writes this
+        process has made. Defaults to READ_YOUR_WRITES.
+    """
+    return getBackend().session(tournament, read_only, consistent)
+
+
+@_timed
+def createTournament(name):
+    """Adds a tournament to the database.
+
+    Each tournament has its own players and matches. The module functions
+    work on the default tournament unless they are given a tournament id.
+
+    Args:
+      name: the tournament's name.
+
+    Returns:
+      The id assigned to the tournament.
+    """
+    with session() as s:
+        return s.createTournament(name)
+
+
+@_timed
+def deleteTournament(tournament):
+    """Remove a tournament, and all its players and matches.
+
+    Args:
+      tournament: the id of the tournament.
+    """
+    with session(tournament) as s:
+        s.deleteTournament()
+
+
+@_timed
+def deleteMatches(tournament=None):
+    """Remove all the match records of a tournament from the database.
+
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+    """
+    with session(tournament) as s:
+        s.deleteMatches()
+
+
+@_timed
+def deletePlayers(tournament=None):
+    """Remove all the player records of a tournament from the database.
+
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+    """
+    with session(tournament) as s:
+        s.deletePlayers()
+
+
+@_timed
+def countPlayers(tournament=None):
+    """Returns the number of players currently registered.
+
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+    """
+    with session(tournament, read_only=True) as s:
+        return s.countPlayers()
+
+
+@_timed
+def registerPlayer(name, tournament=None):
     """Adds a player to the tournament database.
 
     The database assigns a unique serial id number for the player.
 
     Args:
       name: the player's full name (need not be unique).
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+
+    Returns:
+      The id assigned to the player.
+    """
+    with session(tournament) as s:
+        return s.registerPlayer(name)
+
+
+@_timed
+def registerPlayers(names, tournament=None):
+    """Adds a list of players to the tournament database in one statement.
+
+    Args:
+      names: a list of the players' full names.
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+
+    Returns:
+      A list of the ids assigned to the players, in the same order as names.
     """
-    conn = connect()
-    c = conn.cursor()
-    c.execute("INSERT INTO Players (name) VALUES (%s);", (name,))
-    conn.commit()
-    conn.close()
+    with session(tournament) as s:
+        return s.registerPlayers(names)
 
 
-def playerStandings():
+@_timed
+def playerStandings(tournament=None, as_of_round=None, tiebreaks=None):
     """Returns a list of the players and their win records.
 
-    The list is sorted by rank ascending and opponent match wins descending.
+    The list is sorted by rank ascending, then by each tiebreak, by default
+    opponent match wins descending.
     Rank is calulated as player matches - wins - draws / 2.
     The first entry in the list should be the player in first place,
     or a player tied for first place if there is currently a tie.
 
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+      as_of_round: if given, the standings as they were when this round
+        was closed, read from the round's snapshot, see closeRound().
+      tiebreaks: the tiebreaks that order players of the same rank, from
+        tournament_tiebreaks.TIEBREAKS, most important first.
+        Defaults to TIEBREAKS.
+
     Returns:
       A list of tuples, each of which contains
         (id, name, wins, draws, played, byes, opponent_wins, rank):
@@ -76,33 +1454,395 @@ def playerStandings():
         opponent_wins: the number of matches the players opponents have won
         rank: the ranking of the player = played - wins - draws/2
     """
-    conn = connect()
-    c = conn.cursor()
-    sql = """SELECT id, name, wins, draws, opponent_wins, played, byes, rank
-                FROM standings ORDER BY rank, opponent_wins DESC;"""
-    c.execute(sql)
-    standings = c.fetchall()
-    conn.close()
-    return standings
+    with session(tournament, read_only=True) as s:
+        return s.rankedStandings(as_of_round, tiebreaks)
+
+
+@_timed
+def currentRound(tournament=None):
+    """Returns the round that new matches are recorded in.
+
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+    """
+    with session(tournament, read_only=True) as s:
+        return s.currentRound()
+
+
+@_timed
+def closeRound(tournament=None):
+    """Close the current round, and start the next one.
+
+    A snapshot of every player's totals is kept for the round, so that
+    playerStandings(as_of_round=round) and roundDeltas(round) can read
+    the standings after the round without going back over the matches.
+    Matches reported after this are recorded in the next round.
+
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+
+    Returns:
+      The number of the round that was closed.
+    """
+    with session(tournament) as s:
+        return s.closeRound()
 
 
-def reportMatch(player1, player2, winner=None):
+@_timed
+def roundDeltas(round, tournament=None):
+    """Returns how each player's standing changed over a closed round.
+
+    Read from the snapshots of the round and the round before it.
+
+    Args:
+      round: the number of a closed round.
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+
+    Returns:
+      A list of tuples, in standings order after the round, each of which
+      contains (id, name, place, previous_place, wins, draws,
+      opponent_wins, played, byes, rank):
+        place: the player's place in the standings after the round,
+          starting from 1
+        previous_place: the player's place before the round, or None
+          if the player was not in the standings before the round
+        wins, draws, opponent_wins, played, byes, rank: the change in
+          each of the player's totals over the round
+    """
+    with session(tournament, read_only=True) as s:
+        return s.roundDeltas(round)
+
+
+def iterStandings(tournament=None, after=None, fetch_size=None,
+                  row_class=None):
+    """Yields the players and their win records, in standings order.
+
+    Unlike playerStandings(), the rows are streamed from a server-side
+    cursor, fetch_size rows at a time, so the first rows arrive without
+    waiting for the rest, and the whole field is never held in memory
+    at once. The session, and its connection, are held until the
+    iterator is exhausted or closed.
+
+    Players of the same rank are always ordered by opponent match wins,
+    whatever the TIEBREAKS, since the other tiebreaks need the whole
+    field's results.
+
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+      after: a standings row; if given, start with the player after it.
+      fetch_size: the number of rows fetched at a time,
+        defaults to STANDINGS_FETCH_SIZE.
+      row_class: if given, called with the fields of each row, such as
+        StandingsRow, to make the rows yielded instead of tuples.
+
+    Yields:
+      The standings rows, as returned by playerStandings().
+    """
+    with session(tournament, read_only=True) as s:
+        for row in s.iterStandings(after, None, fetch_size):
+            yield row if row_class is None else row_class(*row)
+
+
+@_timed
+def standingsPage(limit, after=None, tournament=None, row_class=None):
+    """Returns one page of the standings.
+
+    Pages are found by the last row of the previous page, rather than
+    by an offset, so a page deep in a large field is as quick to read as
+    the first, and players moving between reads are not skipped or shown
+    twice within the page.
+
+    Args:
+      limit: the most players on the page.
+      after: the last standings row of the previous page, or None for
+        the first page.
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+      row_class: as passed to iterStandings().
+
+    Returns:
+      A list of standings rows, as returned by playerStandings().
+    """
+    with session(tournament, read_only=True) as s:
+        rows = list(s.iterStandings(after, limit))
+    if row_class is None:
+        return rows
+    return [row_class(*row) for row in rows]
+
+
+class StandingsRow(object):
+    """A standings row with named fields, that can be used in place of the
+    tuples returned by playerStandings().
+
+    Uses __slots__, so a row takes less memory than a tuple of the same
+    fields, or an object with a __dict__.
+    """
+
+    __slots__ = ("id", "name", "wins", "draws", "opponent_wins", "played",
+                 "byes", "rank")
+
+    def __init__(self, id, name, wins, draws, opponent_wins, played, byes,
+                 rank):
+        self.id = id
+        self.name = name
+        self.wins = wins
+        self.draws = draws
+        self.opponent_wins = opponent_wins
+        self.played = played
+        self.byes = byes
+        self.rank = rank
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __repr__(self):
+        return "StandingsRow(%s)" % ", ".join(repr(x) for x in self)
+
+
+@_timed
+def reportMatch(player1, player2, winner=None, tournament=None):
     """Records the outcome of a single match between two players.
 
     Args:
       player1:  the id number of the player 1
       player2:  the id number of the player 2
       winner:   the id number of the player who won, or None for a draw
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
     """
-    conn = connect()
-    c = conn.cursor()
-    sql = "INSERT INTO matches (player1,player2,winner) VALUES (%s,%s,%s);"
-    c.execute(sql, (player1, player2, winner))
-    conn.commit()
-    conn.close()
+    with session(tournament) as s:
+        s.reportMatch(player1, player2, winner)
+    if _speculator is not None:
+        _speculator.resultReported(s.tournament)
+
 
+@_timed
+def submitResult(player1, player2, winner=None, tournament=None):
+    """Records the outcome of a match, safely when many scorekeepers submit
+    results at once.
 
-def swissPairings():
+    Unlike reportMatch(), a result that has already been recorded, with
+    the players in either order, is not an error, so a result can be
+    submitted again when it is not known whether it got through.
+    A result is never recorded while swissPairings() is pairing the
+    tournament, so the pairings see either all of a result or none of
+    it. If the transaction is rolled back by a serialization failure or
+    a deadlock, it is tried again, up to SUBMIT_ATTEMPTS times in all.
+
+    Args:
+      player1:  the id number of the player 1
+      player2:  the id number of the player 2
+      winner:   the id number of the player who won, or None for a draw
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+
+    Returns:
+      True if the result was recorded, False if it had already been.
+
+    Raises:
+      ValueError: if the match has already been recorded with a different
+        result.
+    """
+    delay = SUBMIT_RETRY_DELAY
+    for attempt in range(1, SUBMIT_ATTEMPTS + 1):
+        try:
+            with session(tournament) as s:
+                recorded = s.submitResult(player1, player2, winner)
+            break
+        except psycopg2.extensions.TransactionRollbackError as e:
+            if attempt == SUBMIT_ATTEMPTS:
+                raise
+            logging.info("Retrying the result of (%s, %s): %s",
+                         player1, player2, str(e).strip())
+            # Wait a random part of the delay, so that the transactions
+            # that collided do not all retry at once.
+            time.sleep(random.uniform(0, delay))
+            delay *= 2
+    if recorded and _speculator is not None:
+        _speculator.resultReported(s.tournament)
+    return recorded
+
+
+@_timed
+def reportMatches(results, tournament=None):
+    """Records the outcomes of a round of matches in a single transaction.
+
+    All the results are written with one multi-row insert. If any result
+    cannot be recorded, for example because the match has already been
+    reported, the other results are still recorded and the bad ones are
+    returned.
+
+    Args:
+      results: a list of (player1, player2, winner) tuples, as passed to
+        reportMatch(). Use winner = None, or leave it out, for a draw,
+        and player1 = player2 = winner for a bye.
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+
+    Returns:
+      A list of tuples, one for each result that was not recorded,
+        each of which contains (index, result, error):
+        index: the position of the result in the results list
+        result: the (player1, player2, winner) tuple that was not recorded
+        error: the database error message
+    """
+    with session(tournament) as s:
+        errors = s.reportMatches(results)
+    if _speculator is not None:
+        _speculator.resultReported(s.tournament)
+    return errors
+
+
+@_timed
+def checkPlayerStats(tournament=None):
+    """Check the player stats table against a full recompute of the standings.
+
+    The player stats table is kept up to date by database triggers as
+    matches are recorded, so it should always agree with the standings
+    recomputed from the whole match history by the standings_full view.
+
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+
+    Returns:
+      A list of tuples, one for each player whose stats do not agree,
+        each of which contains (id, expected, actual):
+        id: the player's unique id
+        expected: (wins, draws, played, byes, opponent_wins, rank)
+          recomputed from the match history
+        actual: (wins, draws, played, byes, opponent_wins, rank)
+          from the player stats table
+    """
+    with session(tournament, read_only=True) as s:
+        return s.checkPlayerStats()
+
+
+@_timed
+def rebuildPlayerStats(tournament=None):
+    """Recompute the player stats table from the whole match history.
+
+    Only needed to repair the table, for example after loading matches
+    into a database that did not have the player stats triggers.
+
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+    """
+    with session(tournament) as s:
+        s.rebuildPlayerStats()
+
+
+@_timed
+def exportTournament(players, matches, tournament=None):
+    """Write a tournament's players and matches to two CSV files.
+
+    The players file has an id and name column, and the matches file a
+    player1, player2, winner and round column, each with a header row.
+    A draw has an empty winner. The rows are streamed out with COPY.
+
+    Args:
+      players: the file to write the players to.
+      matches: the file to write the matches to.
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+    """
+    with session(tournament, read_only=True) as s:
+        s.exportTournament(players, matches)
+
+
+@_timed
+def importTournament(players, matches, tournament=None, current_round=None):
+    """Read a tournament's players and matches from two CSV files, as
+    written by exportTournament(), in one transaction.
+
+    The players are given new ids, and the matches are recorded in the
+    rounds they were exported with. The files are loaded with COPY, and
+    the matches are checked, and the player stats and round standings
+    worked out, once for the whole history rather than once for each
+    match. Rounds before the current round are closed, with standings
+    that include every imported player.
+
+    Args:
+      players: the file to read the players from.
+      matches: the file to read the matches from.
+      tournament: the id of the tournament to import into, which must have
+        no players, defaults to DEFAULT_TOURNAMENT.
+      current_round: the round new matches are recorded in after the
+        import. Defaults to the last round of the imported matches.
+
+    Returns:
+      A tuple of (the number of players, the number of matches) imported.
+
+    Raises:
+      ValueError: if the tournament already has players, or a match has
+        a player that is not in the players file, a winner that did not
+        play in it, or no round.
+    """
+    with session(tournament) as s:
+        return s.importTournament(players, matches, current_round)
+
+
+@_timed
+def standingsPlan(tournament=None, analyze=False):
+    """Get the query plan for recomputing a tournament's full standings.
+
+    Used to check that the standings_full view is computed with a cost
+    that grows in line with the number of matches.
+
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+      analyze: if True, update the planner's statistics first.
+
+    Returns:
+      The top node of the plan, as a dictionary decoded from
+      EXPLAIN (FORMAT JSON).
+    """
+    with session(tournament) as s:
+        return s.standingsPlan(analyze)
+
+
+@_timed
+def playedPairs(tournament=None):
+    """Get the pairs of players that have already played each other.
+
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+
+    Returns:
+      A set of (lower id, higher id) tuples, one for each pair of players
+      that have played a match. Byes are not included.
+    """
+    with session(tournament, read_only=True) as s:
+        return s.playedPairs()
+
+
+@_timed
+def matchResults(tournament=None, through_round=None):
+    """Get the results of the matches recorded so far.
+
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+      through_round: if given, only the matches recorded up to the end of
+        this round.
+
+    Returns:
+      A list of (player1, player2, winner) tuples, one for each match,
+      byes included. The winner is None for a draw.
+    """
+    with session(tournament, read_only=True) as s:
+        return s.matchResults(through_round)
+
+
+def _matchRow(result):
+    """Returns a match result as a (player1, player2, winner) tuple."""
+    if len(result) == 2:
+        return (result[0], result[1], None)
+    return tuple(result)
+
+
+@_timed
+def swissPairings(candidates=None, engine=None, tournament=None,
+                  window=None):
     """Returns a list of pairs of players for the next round of a match.
 
     Each player appears in only one pairing.
@@ -115,6 +1855,24 @@ def swissPairings():
     If the lowest rank cannot be given a bye because it stops a complete set
     of pairings from being made, then the next lowest rank without a previous
     bye is attempted, and so on.
+    Results submitted with submitResult() are waited for, and new ones
+    held back, while the tournament is paired.
+
+    Args:
+      candidates: where the possible pairings come from.
+        "memory" reads the standings and the pairs of players that have
+        already played, and works out the possible pairings in Python.
+        "view" reads the possible pairings from the possible_pairings view.
+        Defaults to PAIRING_CANDIDATES.
+      engine: how the pairs are chosen from the possible pairings.
+        "backtrack" takes the possible pairings in rank order, and backs
+        up when it gets stuck, which can take exponential time.
+        "matching" finds a maximum weight matching in polynomial time,
+        keeping paired players as close in the standings as it can.
+        Both follow the same rules. Defaults to PAIRING_ENGINE.
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+      window: how many places apart in the standings pairs are first
+        looked for, see pairWithinWindow(). Defaults to PAIRING_WINDOW.
 
     Returns:
       A list of tuples, each of which contains (id1, name1, id2, name2)
@@ -123,33 +1881,294 @@ def swissPairings():
         id2: the second player's unique id
         name2: the second player's name
     """
+    if _speculator is not None:
+        return _speculator.swissPairings(
+            candidates, engine, tournament, window)
+    with session(tournament) as s:
+        return s.swissPairings(candidates, engine, window)
+
+
+@_timed
+def pairStandings(standings, played_pairs, engine=None, window=None):
+    """Find a complete set of pairs for a round without the database.
+
+    The possible pairings are worked out in memory, and names are only
+    attached to the pairs that are chosen.
+
+    Args:
+      standings: the player standings, as returned by playerStandings().
+      played_pairs: a set of (lower id, higher id) tuples of the players
+        that have already played each other, as returned by playedPairs().
+      engine: the pairing engine, as passed to pairPlayers().
+      window: how many places apart in the standings pairs are first
+        looked for, see pairWithinWindow(). Defaults to PAIRING_WINDOW.
+
+    Returns:
+      A list of tuples, each of which contains (id1, name1, id2, name2),
+      as returned by swissPairings().
+    """
+    player_ids = [row[0] for row in standings]
+    possible_bye_players = [(row[0], None) for row in standings if row[6] == 0]
+    pairs = pairWithinWindow(
+        player_ids, possible_bye_players,
+        lambda window: possiblePairingsFromStandings(
+            standings, played_pairs, window),
+        engine, window)
+    names = dict((row[0], row[1]) for row in standings)
+    return [(id1, names[id1], id2, names[id2])
+            for (id1, name1, id2, name2) in pairs]
+
+
+def pairPossiblePairs(player_ids, possible_bye_players, possible_pairs,
+                      engine=None, window=None):
+    """Find a complete set of pairs from a list of every possible pairing,
+    looking at nearby players first, see pairWithinWindow().
+
+    The places of a window are counted in the order of player_ids.
+
+    Args:
+      player_ids: the ids of the players to pair, ordered by rank.
+      possible_bye_players: a list of players (id, name) that can be given
+        a bye, ordered by rank.
+      possible_pairs: a list of every possible pairing (id1, name1, id2,
+        name2), ordered by rank.
+      engine: the pairing engine, as passed to pairPlayers().
+      window: the number of places to start with, or None for no limit.
+        Defaults to PAIRING_WINDOW.
+
+    Returns:
+      A list of tuples, each of which contains (id1, name1, id2, name2),
+      as returned by swissPairings().
+    """
+    positions = dict((id, i) for (i, id) in enumerate(player_ids))
+    return pairWithinWindow(
+        player_ids, possible_bye_players,
+        lambda window: [
+            pair for pair in possible_pairs if window is None or
+            abs(positions[pair[0]] - positions[pair[2]]) <= window],
+        engine, window)
+
+
+def pairWithinWindow(player_ids, possible_bye_players, possible_pairs,
+                     engine=None, window=None):
+    """Find a complete set of pairs, looking at nearby players first.
+
+    Only players at most window places apart in the standings are paired,
+    so only O(n * window) possible pairings are looked at, rather than
+    O(n^2). If no complete set of pairs can be made within the window,
+    the window is doubled, until it covers the whole field.
+
+    Both engines prefer pairs close together in the standings, so when
+    the pairs they would choose from every possible pairing fit within
+    the window, they choose the same pairs. For an odd number of players,
+    the bye is settled first: the lowest ranked possible bye player is
+    tried with the window widened as far as it takes, and only if no
+    complete set of pairs can be made around that bye at all is the next
+    one tried, so the bye goes to the same player as without a window.
+    Within a window, the backtracking search gives up once it has added
+    as many pairs as there are possible pairings, since backing up out of
+    a window too narrow for it can take exponential time.
+
+    Args:
+      player_ids: the ids of the players to pair, ordered by rank.
+      possible_bye_players: a list of players (id, name) that can be given
+        a bye, ordered by rank.
+      possible_pairs: a function of a window, or None for no limit, that
+        returns the possible pairings (id1, name1, id2, name2) of players
+        at most that many places apart, ordered by rank.
+      engine: the pairing engine, as passed to pairPlayers().
+      window: the number of places to start with, or None for no limit.
+        Defaults to PAIRING_WINDOW.
+
+    Returns:
+      A list of tuples, each of which contains (id1, name1, id2, name2),
+      as returned by swissPairings().
+    """
+    if engine is None:
+        engine = PAIRING_ENGINE
+    if window is None:
+        window = PAIRING_WINDOW
+    if window is not None and window < 1:
+        raise ValueError("The pairing window must be at least 1")
+    if window is None or window >= len(player_ids) - 1:
+        return pairPlayers(
+            player_ids, possible_bye_players, possible_pairs(None), engine)
+
+    # Each window's possible pairings are read once, however many byes
+    # are tried with them.
+    windows = {}
+
+    def pairsWithin(window):
+        if window not in windows:
+            windows[window] = possible_pairs(window)
+        return windows[window]
+
+    if len(player_ids) % 2 == 0:
+        return _pairWidening(player_ids, [], pairsWithin, engine, window)
+    for bye_player in reversed(possible_bye_players):
+        try:
+            return _pairWidening(
+                player_ids, [bye_player], pairsWithin, engine, window)
+        except ValueError:
+            logging.debug(
+                "No complete set of pairs with a bye for %s", bye_player[0])
+    raise ValueError("No players are eligible for a bye.")
+
+
+def _pairWidening(player_ids, possible_bye_players, possible_pairs, engine,
+                  window):
+    """Find a complete set of pairs within the window, doubling it until
+    one is found, for pairWithinWindow().
+    """
+    while window < len(player_ids) - 1:
+        pairs = possible_pairs(window)
+        try:
+            if engine == "backtrack":
+                return findPairings(len(player_ids), possible_bye_players,
+                                    pairs, max_nodes=len(pairs))
+            return pairPlayers(
+                player_ids, possible_bye_players, pairs, engine)
+        except ValueError:
+            logging.debug(
+                "No complete set of pairs within %d places", window)
+            window *= 2
+    return pairPlayers(
+        player_ids, possible_bye_players, possible_pairs(None), engine)
+
+
+def applyResults(standings, played_pairs, results):
+    """Work out what the standings would be after some more results.
+
+    The totals are updated in the same way as the player_stats triggers
+    update them, so the new standings are the same as the ones that
+    playerStandings() would return once the results had been reported.
+
+    Args:
+      standings: the player standings, as returned by playerStandings().
+      played_pairs: a set of (lower id, higher id) tuples of the players
+        that have already played each other, as returned by playedPairs().
+      results: a list of (player1, player2, winner) tuples.
+
+    Returns:
+      A tuple of (standings, played_pairs) after the results.
+    """
+    rows = dict((row[0], list(row)) for row in standings)
+    played_pairs = set(played_pairs)
+    opponents = dict((id, []) for id in rows)
+    for (id1, id2) in played_pairs:
+        opponents[id1].append(id2)
+        opponents[id2].append(id1)
+
+    # Row indexes of (id, name, wins, draws, opponent_wins, played, byes, rank)
+    WINS, DRAWS, OPPONENT_WINS, PLAYED, BYES, RANK = 2, 3, 4, 5, 6, 7
+    for (player1, player2, winner) in results:
+        if player1 != player2:
+            rows[player1][OPPONENT_WINS] += rows[player2][WINS]
+            rows[player2][OPPONENT_WINS] += rows[player1][WINS]
+            opponents[player1].append(player2)
+            opponents[player2].append(player1)
+            played_pairs.add((min(player1, player2), max(player1, player2)))
+        for id in set((player1, player2)):
+            row = rows[id]
+            row[PLAYED] += 1
+            if winner is None:
+                row[DRAWS] += 1
+            elif winner == id:
+                row[WINS] += 1
+            if player1 == player2:
+                row[BYES] += 1
+            row[RANK] = row[PLAYED] - row[WINS] - row[DRAWS] / 2.0
+        if winner is not None:
+            for id in opponents[winner]:
+                rows[id][OPPONENT_WINS] += 1
+
+    standings = sorted(
+        (tuple(row) for row in rows.values()),
+        key=lambda row: (row[RANK], -row[OPPONENT_WINS], row[0]))
+    return standings, played_pairs
+
+
+@_timed
+def pairPlayers(player_ids, possible_bye_players, possible_pairs,
+                engine=None):
+    """Find a complete set of pairs for a round with the chosen engine.
+
+    Args:
+      player_ids: the ids of the players to pair, ordered by rank.
+      possible_bye_players: a list of players (id, name) that can be given
+        a bye, ordered by rank.
+      possible_pairs: a list of possible pairings (id1, name1, id2, name2)
+        of players that have not played each other, ordered by rank.
+      engine: "backtrack" to use findPairings(), or "matching" to use
+        matchPairings(). Defaults to PAIRING_ENGINE.
+
+    Returns:
+      A list of tuples, each of which contains (id1, name1, id2, name2),
+      as returned by swissPairings().
+    """
+    if engine is None:
+        engine = PAIRING_ENGINE
+    if engine == "backtrack":
+        return findPairings(
+            len(player_ids), possible_bye_players, possible_pairs)
+    elif engine == "matching":
+        return matchPairings(
+            player_ids, possible_bye_players, possible_pairs)
+    raise ValueError("Unknown pairing engine %r" % (engine,))
+
+
+def findPairings(player_count, possible_bye_players, possible_pairs,
+                 max_nodes=None):
+    """Find a complete set of pairs for a round.
+
+    Args:
+      player_count: the number of players to pair.
+      possible_bye_players: a list of players (id, name) that can be given
+        a bye, ordered by rank. Only needed for an odd number of players.
+      possible_pairs: a list of possible pairings (id1, name1, id2, name2)
+        of players that have not played each other, ordered by rank.
+      max_nodes: if given, raise ValueError once the search has added
+        more than this many pairs, over all the byes tried.
+
+    Returns:
+      A list of tuples, each of which contains (id1, name1, id2, name2),
+      as returned by swissPairings().
+    """
 
     # Create list for pairings.
     pairs = []
 
-    player_count = countPlayers()
-
     # The number of pairs needed for a complete set that includes every player.
     # If there is a bye player, the bye player is added as a pair.
     all_paired_count = int(math.ceil(float(player_count)/2))
 
-    # If odd number of players, then get a list of possible bye players,
-    # from which to award a bye.
+    # If odd number of players, then the possible bye players list is used
+    # to award a bye.
     # A possible bye player is a player that has not had a bye in a previous
     # round.
-    # The list is sorted by rank.
-    if player_count % 2 != 0:
-        possible_bye_players = possibleByePlayers()
-
-    # Get a list of possible pairings from the possible_pairings view,
-    # sorted by rank.
-    # Possible pairings only include players that have not played each other
-    # in a previous round.
-    possible_pairs = possiblePairings()
+    # The list is sorted by rank, so copy it before popping from it.
+    possible_bye_players = list(possible_bye_players)
 
     logging.debug(
-        "Started pairing %d players using %d possible pairings"
-        % (player_count, len(possible_pairs)))
+        "Started pairing %d players using %d possible pairings",
+        player_count, len(possible_pairs))
+
+    # Count the work done by the search, while metrics are enabled,
+    # or to stop it after max_nodes pairs.
+    search = None
+    if _metrics is not None or max_nodes is not None:
+        search = PairingSearch(max_nodes)
+    try:
+        return _findPairings(player_count, all_paired_count, pairs,
+                             possible_bye_players, possible_pairs, search)
+    finally:
+        if _metrics is not None:
+            _metrics.recordSearch(search)
+
+
+def _findPairings(player_count, all_paired_count, pairs,
+                  possible_bye_players, possible_pairs, search):
+    """The search loop of findPairings()."""
 
     # Try to find a complete set of pairings.
     # The while loop is only useful when there are an odd number of players.
@@ -160,6 +2179,8 @@ def swissPairings():
     while len(pairs) < all_paired_count:
         # clear list of pairings
         del pairs[:]
+        if search is not None:
+            search.attempts += 1
 
         # If we have an odd number of players,
         # add lowest ranked possible bye player to pairs,
@@ -170,12 +2191,12 @@ def swissPairings():
                 pairs.append((
                     bye_player[0], bye_player[1],
                     bye_player[0], bye_player[1]))
-                logging.debug("Added bye player %s to pairs" % bye_player[1])
+                logging.debug("Added bye player %s to pairs", bye_player[0])
             else:
                 raise ValueError("No players are eligible for a bye.")
 
         # Add possible pairs to list, only adding each player once.
-        if tryPairing(0, all_paired_count, pairs, possible_pairs):
+        if tryPairing(0, all_paired_count, pairs, possible_pairs, search):
             logging.debug("Finished pairing")
             # We have found all the pairs for the next round.
             return pairs
@@ -185,9 +2206,121 @@ def swissPairings():
             raise ValueError(
                 "Pairing failed. Needed %d pairs, found %d"
                 % (all_paired_count, len(pairs)))
+    return pairs
+
+
+def matchPairings(player_ids, possible_bye_players, possible_pairs):
+    """Find a complete set of pairs for a round with a maximum weight matching.
+
+    The players are the vertices of a graph, and each possible pairing is
+    an edge. For an odd number of players, an extra vertex stands for the
+    bye, with an edge to each possible bye player. A maximum cardinality
+    matching of maximum weight is then found in polynomial time, rather
+    than by a backtracking search.
+
+    The weights are chosen so that the bye goes to the lowest ranked
+    possible bye player that still allows a complete set of pairs, and
+    after that, the total of the squared distances in the standings
+    between paired players is as small as possible.
+
+    Args:
+      player_ids: the ids of the players to pair, ordered by rank.
+      possible_bye_players: a list of players (id, name) that can be given
+        a bye, ordered by rank.
+      possible_pairs: a list of possible pairings (id1, name1, id2, name2)
+        of players that have not played each other, ordered by rank.
+
+    Returns:
+      A list of tuples, each of which contains (id1, name1, id2, name2),
+      as returned by swissPairings(). A bye, if any, comes first, followed
+      by the pairs in order of their higher ranked player.
+    """
+    player_count = len(player_ids)
+    all_paired_count = int(math.ceil(float(player_count)/2))
+    if player_count == 0:
+        return []
+    if player_count % 2 != 0 and not possible_bye_players:
+        raise ValueError("No players are eligible for a bye.")
+
+    position = dict((id, i) for i, id in enumerate(player_ids))
+    names = {}
+
+    # Any single pair costs less than pair_weight, and all the pairs
+    # together cost less than bye_weight, so moving the bye one place
+    # down the standings always outweighs the pairing costs.
+    pair_weight = player_count ** 2
+    bye_weight = player_count ** 3
+    edges = []
+    edge_set = set()
+    for (id1, name1, id2, name2) in possible_pairs:
+        names[id1] = name1
+        names[id2] = name2
+        i, j = sorted((position[id1], position[id2]))
+        if (i, j) not in edge_set:
+            edge_set.add((i, j))
+            edges.append((i, j, pair_weight - (j - i) ** 2))
+    if player_count % 2 != 0:
+        bye = player_count
+        for (id, name) in possible_bye_players:
+            names[id] = name
+            i = position[id]
+            edges.append((i, bye, pair_weight + (i + 1) * bye_weight))
+
+    logging.debug(
+        "Started matching %d players using %d possible pairings",
+        player_count, len(edges))
+
+    mate = maxWeightMatching(edges, maxcardinality=True)
+    mate += [-1] * (player_count + 1 - len(mate))
 
+    pairs = []
+    for i, id in enumerate(player_ids):
+        j = mate[i]
+        if j == player_count:
+            pairs.insert(0, (id, names[id], id, names[id]))
+        elif j > i:
+            id2 = player_ids[j]
+            pairs.append((id, names[id], id2, names[id2]))
+
+    if len(pairs) < all_paired_count:
+        if player_count % 2 != 0:
+            raise ValueError("No players are eligible for a bye.")
+        raise ValueError(
+            "Pairing failed. Needed %d pairs, found %d"
+            % (all_paired_count, len(pairs)))
+    logging.debug("Finished matching")
+    return pairs
+
+
+def possiblePairingsFromStandings(standings, played_pairs, window=None):
+    """Work out the possible pairings for a round without the database.
+
+    Gives the same pairings, in the same order, as the possible_pairings
+    view, but without the players' names, which are left as None.
+
+    Args:
+      standings: the player standings, as returned by playerStandings().
+      played_pairs: a set of (lower id, higher id) tuples of the players
+        that have already played each other.
+      window: if given, only pair players at most this many places apart
+        in the standings.
 
-def tryPairing(start, all_paired_count, pairs, possible_pairs):
+    Returns:
+      A list of tuples of possible player pairings (id1, None, id2, None)
+      ordered by rank.
+    """
+    ids = [row[0] for row in standings]
+    if window is None:
+        window = len(ids)
+    possible_pairs = []
+    for (i, id1) in enumerate(ids):
+        for id2 in ids[max(0, i - window):i + window + 1]:
+            if id1 != id2 and (min(id1, id2), max(id1, id2)) not in played_pairs:
+                possible_pairs.append((id1, None, id2, None))
+    return possible_pairs
+
+
+def tryPairing(start, all_paired_count, pairs, possible_pairs, search=None):
     """Recursive function that attempts to find a complete set of pairs
         for a round, from a list of all possible pairs.
 
@@ -204,11 +2337,15 @@ def tryPairing(start, all_paired_count, pairs, possible_pairs):
         all_paired_count: number of pairs needed for a complete set.
         pairs: list of pairs that have been found so far.
         possible_pairs: list of possible pairs for inclusion in pairs.
+        search: a PairingSearch to count the pairs tried, or None.
 
     Returns:
         True: Found complete set of pairs.
         False: Unable to find complete set of pairs.
 
+    Raises:
+        ValueError: the search added more than search.max_nodes pairs.
+
     """
     for i in range(start, len(possible_pairs)):
         (id1, name1, id2, name2) = possible_pairs[i]
@@ -218,55 +2355,545 @@ def tryPairing(start, all_paired_count, pairs, possible_pairs):
         if not any(id1 in (p[0], p[2]) or id2 in (p[0], p[2]) for p in pairs):
             # Add pair to pairs.
             pairs.append((id1, name1, id2, name2))
-            logging.debug("Added pair (%s,%s) to pairs" % (name1, name2))
+            logging.debug("Added pair (%s,%s) to pairs", id1, id2)
+            if search is not None:
+                search.nodes += 1
+                search.max_depth = max(search.max_depth, len(pairs))
+                if (search.max_nodes is not None and
+                        search.nodes > search.max_nodes):
+                    raise ValueError(
+                        "Pairing gave up after %d pairs" % search.max_nodes)
 
             if (len(pairs) == all_paired_count):
                 # We have found all the pairs for the next round.
                 return True
             # Try to find the next pair.
-            if tryPairing(start+1, all_paired_count, pairs, possible_pairs):
+            if tryPairing(start+1, all_paired_count, pairs, possible_pairs,
+                          search):
                 # We have found all the pairs for the next round.
                 return True
             else:
                 # Failed to find a complete set of pairs,
                 # so remove last pair added, and move on to next possible pair.
                 pairs.pop()
-                logging.debug(
-                    "Removed pair (%s,%s) from pairs" % (name1, name2))
+                logging.debug("Removed pair (%s,%s) from pairs", id1, id2)
+                if search is not None:
+                    search.backtracks += 1
     return False
 
 
-def possibleByePlayers():
+@_timed
+def possibleByePlayers(tournament=None):
     """Get the list of players that have not had a bye.
 
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+
     Returns:
       A list of tuples of players (id, name) ordered by rank.
     """
-    conn = connect()
-    c = conn.cursor()
-    sql = """SELECT id, name FROM standings WHERE byes = 0
-                ORDER BY rank, opponent_wins DESC;"""
-    c.execute(sql)
-    possible_bye_players = c.fetchall()
-    conn.close()
-    return possible_bye_players
+    with session(tournament, read_only=True) as s:
+        return s.possibleByePlayers()
 
 
-def possiblePairings():
+@_timed
+def possiblePairings(tournament=None, window=None):
     """Get the list of possible pairings for a round.
         A possible pairing is two players that have not played each other in
         a previous round.
 
+    Args:
+      tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+      window: if given, only pair players at most this many places apart
+        in the standings.
+
     Returns:
       A list of tuples of possible player pairings (id1, name1, id2, name2)
       ordered by rank.
     """
-    conn = connect()
-    c = conn.cursor()
-    sql = """SELECT id1, name1, id2, name2 FROM possible_pairings
-                ORDER BY rank1, opponent_wins1 DESC,
-                rank2, opponent_wins2 DESC;"""
-    c.execute(sql)
-    possible_pairs = c.fetchall()
-    conn.close()
-    return possible_pairs
+    with session(tournament, read_only=True) as s:
+        return s.possiblePairings(window)
+
+
+def enableSpeculativePairing(max_outstanding=1, engine=None):
+    """Start working out the next round's pairings while results come in.
+
+    Once enabled, swissPairings() records each round it pairs, and
+    reportMatch() and reportMatches() wake a background thread that works
+    out the next round's pairings for every possible outcome of the
+    round's last outstanding matches. When the round's last result is
+    reported, swissPairings() can then return the pairings straight away.
+    See SpeculativePairing.
+
+    Args:
+      max_outstanding: speculate once this many matches, or fewer, of the
+        round are still to be reported. Each outstanding match triples
+        the number of outcomes that are tried.
+      engine: the pairing engine to speculate with.
+        Defaults to PAIRING_ENGINE.
+    """
+    global _speculator
+    disableSpeculativePairing()
+    _speculator = SpeculativePairing(max_outstanding, engine)
+
+
+def disableSpeculativePairing():
+    """Stop working out pairings in the background."""
+    global _speculator
+    if _speculator is not None:
+        _speculator.stop()
+        _speculator = None
+
+
+def _winnersByPair(results):
+    """Returns the winner of each match, keyed by (lower id, higher id)."""
+    return dict(((min(p1, p2), max(p1, p2)), w) for (p1, p2, w) in results)
+
+
+class SpeculativePairing(object):
+    """Works out the next round's pairings while the round's results come in.
+
+    Once a round has been paired by swissPairings(), each reported result
+    wakes a background thread. When no more than max_outstanding matches of
+    the round are still to be reported, the thread reads the standings once,
+    and works out the next round's pairings for every possible outcome of
+    the outstanding matches. The players whose matches have finished are
+    already in their final score groups, so only the outstanding results
+    have to be tried.
+
+    When swissPairings() is called after the round's last result, it checks
+    that the database holds exactly the matches the speculation started
+    from, plus one of the outcomes it tried. If it does, the pairings for
+    that outcome are returned straight away, otherwise the pairings are
+    worked out as usual.
+    """
+
+    def __init__(self, max_outstanding=1, engine=None):
+        self.max_outstanding = max_outstanding
+        self.engine = engine
+        # Number of times swissPairings() used a speculation.
+        self.hits = 0
+        # The (lower id, higher id) pairs of each tournament's current round,
+        # the latest speculation about each tournament's next round, and the
+        # tournaments with results that have not been looked at yet.
+        self._rounds = {}
+        self._speculations = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        # Held by the background thread while it is speculating.
+        self._busy = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        self._stopped = True
+        self._wake.set()
+
+    def resultReported(self, tournament):
+        """Tell the background thread that a result has been reported."""
+        with self._lock:
+            self._pending.add(tournament)
+        self._wake.set()
+
+    def settle(self):
+        """Wait until the background thread has caught up with the results."""
+        while self._wake.is_set() and not self._stopped:
+            time.sleep(0.01)
+        with self._busy:
+            pass
+
+    def swissPairings(self, candidates=None, engine=None, tournament=None,
+                      window=None):
+        """Returns the pairs for the next round, as swissPairings() does."""
+        if candidates is None:
+            candidates = PAIRING_CANDIDATES
+        if engine is None:
+            engine = PAIRING_ENGINE
+        if window is None:
+            window = PAIRING_WINDOW
+        if tournament is None:
+            tournament = DEFAULT_TOURNAMENT
+
+        # Wait for any speculation in progress, since it is probably
+        # about this round.
+        with self._busy:
+            with self._lock:
+                speculation = self._speculations.get(tournament)
+
+        with session(tournament) as s:
+            # Keep results from being submitted while the speculation is
+            # checked, as s.swissPairings() does.
+            s.lockPairing()
+            pairs = None
+            if (candidates == "memory" and speculation is not None and
+                    speculation["engine"] == engine and
+                    speculation["window"] == window and
+                    speculation["tiebreaks"] == tuple(TIEBREAKS)):
+                pairs = self._finish(s, speculation)
+            if pairs is None:
+                pairs = s.swissPairings(candidates, engine, window)
+            else:
+                self.hits += 1
+                logging.debug("Used the speculative pairings")
+
+        with self._lock:
+            self._rounds[tournament] = [
+                (min(id1, id2), max(id1, id2))
+                for (id1, name1, id2, name2) in pairs]
+            self._speculations.pop(tournament, None)
+        return pairs
+
+    def _finish(self, s, speculation):
+        """Returns the speculative pairings for the results in the database,
+        or None if the speculation does not hold.
+
+        The speculation holds if the tournament has the same players, and
+        the same results, as when it was made, plus a result for each of
+        the outstanding matches and nothing else.
+        """
+        outstanding = speculation["outstanding"]
+        if (frozenset(row[0] for row in s.playerStandings()) !=
+                speculation["players"]):
+            return None
+        winners = _winnersByPair(s.matchResults())
+        if (len(winners) != len(speculation["winners"]) + len(outstanding) or
+                any(pair not in winners for pair in outstanding) or
+                any(pair not in winners or winners[pair] != winner
+                    for (pair, winner) in speculation["winners"].items())):
+            return None
+        outcome = tuple(winners[pair] for pair in outstanding)
+        return speculation["pairings"].get(outcome)
+
+    def _run(self):
+        """Speculate each time a result is reported, until stopped."""
+        while True:
+            self._wake.wait()
+            with self._busy:
+                self._wake.clear()
+                if self._stopped:
+                    return
+                with self._lock:
+                    pending = self._pending
+                    self._pending = set()
+                for tournament in pending:
+                    try:
+                        self._speculate(tournament)
+                    except Exception:
+                        logging.exception("Speculative pairing failed")
+
+    def _speculate(self, tournament):
+        """Work out the next round's pairings for each possible outcome
+        of the tournament's outstanding matches in the current round.
+        """
+        with self._lock:
+            round = self._rounds.get(tournament)
+            speculation = self._speculations.get(tournament)
+        if not round:
+            return
+        engine = self.engine or PAIRING_ENGINE
+        window = PAIRING_WINDOW
+        tiebreaks = tuple(TIEBREAKS)
+
+        with session(tournament) as s:
+            # Read everything from one snapshot of the database.
+            s.beginSnapshot()
+            reported = s.matchWinners(round)
+            outstanding = [pair for pair in round if pair not in reported]
+            if not outstanding or len(outstanding) > self.max_outstanding:
+                return
+            match_results = s.matchResults()
+            winners = _winnersByPair(match_results)
+            if (speculation is not None and
+                    speculation["winners"] == winners and
+                    speculation["outstanding"] == outstanding):
+                return
+            standings = s.playerStandings()
+            played_pairs = s.playedPairs()
+
+        # A bye can only be won, any other match can be won by either
+        # player, or drawn.
+        outcomes = [(id1,) if id1 == id2 else (id1, id2, None)
+                    for (id1, id2) in outstanding]
+        pairings = {}
+        for outcome in itertools.product(*outcomes):
+            results = [(id1, id2, winner) for ((id1, id2), winner)
+                       in zip(outstanding, outcome)]
+            new_standings, new_played_pairs = applyResults(
+                standings, played_pairs, results)
+            if tiebreaks != ("opponent_wins",):
+                new_standings = tournament_tiebreaks.orderStandings(
+                    new_standings, match_results + results, tiebreaks)
+            try:
+                pairings[outcome] = pairStandings(
+                    new_standings, new_played_pairs, engine, window)
+            except ValueError:
+                pairings[outcome] = None
+        logging.debug(
+            "Speculated on %d outcomes of %d outstanding matches",
+            len(pairings), len(outstanding))
+
+        with self._lock:
+            if self._rounds.get(tournament) is round:
+                self._speculations[tournament] = {
+                    "players": frozenset(row[0] for row in standings),
+                    "winners": winners,
+                    "outstanding": outstanding,
+                    "engine": engine,
+                    "window": window,
+                    "tiebreaks": tiebreaks,
+                    "pairings": pairings}
+
+
+def enableMetrics():
+    """Start recording how long the module's work takes.
+
+    Once enabled, the latency of each public function, the count and
+    duration of each SQL statement, the time spent waiting for a pooled
+    connection, and the work done by the backtracking pairing search are
+    recorded, until disableMetrics() is called. Read them with getStats()
+    or dumpStats(). While metrics are disabled, nothing is recorded, and
+    the checks for them cost next to nothing.
+    """
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+
+
+def disableMetrics():
+    """Stop recording metrics, and throw away the ones recorded."""
+    global _metrics
+    _metrics = None
+
+
+def resetStats():
+    """Throw away the metrics recorded so far, and keep recording."""
+    global _metrics
+    if _metrics is not None:
+        _metrics = Metrics()
+
+
+def getStats():
+    """Get the metrics recorded since they were enabled or reset.
+
+    Returns:
+      None if metrics are not enabled, otherwise a dictionary containing:
+        functions: the latency of each public function, by name
+        queries: the duration of each SQL statement, by statement
+        connections: the time spent waiting for a pooled connection,
+          under "getconn"
+        pairing: the totals of the backtracking pairing searches, see
+          Metrics.recordSearch()
+      Each latency is a dictionary, see Histogram.stats().
+    """
+    if _metrics is None:
+        return None
+    return _metrics.stats()
+
+
+def dumpStats(out=None):
+    """Write the metrics recorded so far as a readable table.
+
+    Args:
+      out: the file to write to, defaults to sys.stderr.
+    """
+    if out is None:
+        out = sys.stderr
+    stats = getStats()
+    if stats is None:
+        out.write("Metrics are not enabled.\n")
+        return
+    for group in ("functions", "connections", "queries"):
+        out.write("%-60s %8s %10s %10s %10s\n"
+                  % (group, "count", "mean ms", "max ms", "total s"))
+        for name, latency in sorted(stats[group].items(),
+                                    key=lambda item: -item[1]["total"]):
+            out.write("  %-58s %8d %10.3f %10.3f %10.3f\n" % (
+                " ".join(name.split())[:58], latency["count"],
+                latency["mean"] * 1000, latency["max"] * 1000,
+                latency["total"]))
+    out.write("pairing\n")
+    for name, value in sorted(stats["pairing"].items()):
+        out.write("  %-58s %8d\n" % (name, value))
+
+
+class Histogram(object):
+    """A latency histogram, with buckets on a 1, 2.5, 5 scale
+    from 0.1 milliseconds to 10 seconds.
+    """
+
+    BOUNDS = [scale * 10 ** exponent for exponent in range(-4, 1)
+              for scale in (1, 2.5, 5)] + [10]
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        # One bucket for each bound, and one for slower times.
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+
+    def add(self, seconds):
+        """Add a time, in seconds."""
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+
+    def stats(self):
+        """Returns the histogram as a dictionary, containing:
+            count: the number of times added
+            total: the total of the times, in seconds
+            mean, min, max: the mean, shortest and longest time
+            buckets: a list of [upper bound, count] pairs, with an upper
+              bound of None for the times slower than the last bound
+        """
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min,
+            "max": self.max,
+            "buckets": [[bound, count] for (bound, count) in
+                        zip(self.BOUNDS + [None], self.buckets) if count]}
+
+
+class PairingSearch(object):
+    """Counts the work done by one run of the backtracking pairing search."""
+
+    def __init__(self, max_nodes=None):
+        # Number of pairs the search can add before it gives up, or None.
+        self.max_nodes = max_nodes
+        # Number of times the search was started, once for each bye tried.
+        self.attempts = 0
+        # Number of pairs added, removed again, and the most pairs held.
+        self.nodes = 0
+        self.backtracks = 0
+        self.max_depth = 0
+
+
+class Metrics(object):
+    """The metrics recorded while enabled, see enableMetrics()."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {"functions": {}, "connections": {}, "queries": {}}
+        self._pairing = {"searches": 0, "nodes": 0, "backtracks": 0,
+                         "bye_retries": 0, "max_depth": 0}
+
+    def record(self, group, name, seconds):
+        """Add a time to the named histogram of a group."""
+        with self._lock:
+            histograms = self._histograms[group]
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def recordQuery(self, sql, seconds):
+        """Add the time taken by a SQL statement."""
+        self.record("queries", sql, seconds)
+
+    def recordSearch(self, search):
+        """Add the work done by a PairingSearch to the totals of searches,
+        nodes (pairs added), backtracks (pairs removed), bye_retries
+        (byes tried after the first), and max_depth (the most pairs held).
+        """
+        with self._lock:
+            totals = self._pairing
+            totals["searches"] += 1
+            totals["nodes"] += search.nodes
+            totals["backtracks"] += search.backtracks
+            totals["bye_retries"] += max(search.attempts - 1, 0)
+            totals["max_depth"] = max(totals["max_depth"], search.max_depth)
+
+    def stats(self):
+        """Returns the metrics, as getStats() does."""
+        with self._lock:
+            stats = dict((group, dict((name, histogram.stats())
+                                      for (name, histogram)
+                                      in histograms.items()))
+                         for (group, histograms) in self._histograms.items())
+            stats["pairing"] = dict(self._pairing)
+        return stats
+
+
+def enableStandingsCache(size=128):
+    """Start caching the standings read from the database.
+
+    Once enabled, the standings, possible byes, possible pairings and
+    played pairs of a tournament are kept in memory, tagged with the
+    tournament's version. The database gives the tournament a new version
+    each time its players or matches change, in any process, so each read
+    checks the version, and only runs the full query again if it has
+    changed. See StandingsCache.
+
+    Args:
+      size: the number of tournaments to keep results for. The least
+        recently used tournament's results are dropped first.
+    """
+    global _cache
+    _cache = StandingsCache(size)
+
+
+def disableStandingsCache():
+    """Stop caching the standings, and drop the cached results."""
+    global _cache
+    _cache = None
+
+
+class StandingsCache(object):
+    """Results of the standings queries, by tournament and version.
+
+    Each tournament's entry holds the results read at one version of the
+    tournament, and is replaced when a read finds a newer version. Versions
+    come from a database sequence, so a version is never reused, even by a
+    transaction that rolls back, and a result read inside a transaction that
+    has written to the tournament can never be mistaken for another
+    transaction's.
+    """
+
+    def __init__(self, size=128):
+        self.size = size
+        # Number of reads served from the cache, and read from the database.
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version, name):
+        """Returns the named result for a tournament at a version,
+        or None if it is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version or name not in entry[1]:
+                self.misses += 1
+                return None
+            # Move the tournament to the most recently used end.
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1][name]
+
+    def put(self, key, version, name, result):
+        """Cache the named result for a tournament at a version."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != version:
+                entry = (version, {})
+            entry[1][name] = result
+            self._entries[key] = entry
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached result."""
+        with self._lock:
+            self._entries.clear()
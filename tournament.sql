@@ -7,10 +7,34 @@ CREATE DATABASE tournament;
 \c tournament;
 
 
+-- Create tournaments table.
+-- Each tournament has its own players and matches, so one database can
+-- hold many tournaments at once.
+-- The version changes each time the tournament's players or matches
+-- change, so that cached standings can be checked against it.
+-- Matches are recorded in the current round, until the round is closed.
+CREATE TABLE tournaments (
+	id serial PRIMARY KEY,
+	name text,
+	version bigint NOT NULL DEFAULT 0,
+	current_round integer NOT NULL DEFAULT 1
+);
+
+-- Versions are taken from a sequence rather than counted up, so that a
+-- version used by a transaction that rolled back is never used again.
+CREATE SEQUENCE tournament_versions;
+
+-- Create the default tournament, used when no tournament is given.
+INSERT INTO tournaments (name) VALUES ('Default');
+
+
 -- Create players table.
 CREATE TABLE players (
 	id serial PRIMARY KEY,
-	name text
+	tournament_id integer NOT NULL DEFAULT 1
+		REFERENCES tournaments (id) ON DELETE CASCADE,
+	name text,
+	UNIQUE (tournament_id, id)
 );
 
 
@@ -19,97 +43,380 @@ CREATE TABLE players (
 -- A bye can be recorded for a player by inserting a row with columns 
 -- player1 = player2 = winner = player.
 -- A draw can be recorded for a match by setting the column winner = null.
+-- The players of a match must belong to the match's tournament.
+-- The round defaults to the tournament's current round.
+-- The player checks can be deferred to the end of a transaction, so that
+-- an import checks them once, after all its matches are in.
 CREATE TABLE matches (
-	player1 integer REFERENCES players (id),
-	player2 integer REFERENCES players (id),
-	winner integer REFERENCES players (id),
-	PRIMARY KEY (player1, player2)
+	tournament_id integer NOT NULL DEFAULT 1
+		REFERENCES tournaments (id) ON DELETE CASCADE,
+	player1 integer,
+	player2 integer,
+	winner integer,
+	round integer NOT NULL,
+	PRIMARY KEY (tournament_id, player1, player2),
+	FOREIGN KEY (tournament_id, player1) REFERENCES players (tournament_id, id)
+		DEFERRABLE,
+	FOREIGN KEY (tournament_id, player2) REFERENCES players (tournament_id, id)
+		DEFERRABLE,
+	FOREIGN KEY (tournament_id, winner) REFERENCES players (tournament_id, id)
+		DEFERRABLE
 );
 
+-- The primary key finds a player's matches as player1.
+-- These indexes find a player's matches as player2, and the matches
+-- a player has won.
+CREATE INDEX matches_player2 ON matches (tournament_id, player2);
+CREATE INDEX matches_winner ON matches (tournament_id, winner);
 
--- Create player win count view.
-CREATE VIEW player_wins AS
-	SELECT players.id, players.name, COUNT(matches.winner) AS wins
-	FROM players 
-	LEFT OUTER JOIN matches ON players.id = matches.winner
-	GROUP BY players.id;
+-- A pair of players can only have one match, whichever order the players
+-- are given in. The index also finds the match of a pair of players.
+CREATE UNIQUE INDEX matches_pair ON matches
+	(tournament_id, LEAST(player1, player2), GREATEST(player1, player2));
 
 
--- Create player draw count view.
--- A draw is recorded in the matches tables by setting winner = null.
-CREATE VIEW player_draws AS
-	SELECT players.id, players.name, COUNT(matches.player1) AS draws
-	FROM players 
-	LEFT OUTER JOIN matches 
-	ON (players.id = matches.player1 OR players.id = matches.player2) AND matches.winner IS NULL
-	GROUP BY players.id;
+-- Create player stats table.
+-- Holds running totals of each player's results, so that the standings can
+-- be read without aggregating the whole match history.
+-- The table is kept up to date by the triggers on the players and matches
+-- tables below. The standings_full view recomputes the same totals from
+-- the match history, and can be used to check or rebuild the table.
+CREATE TABLE player_stats (
+	id integer PRIMARY KEY REFERENCES players (id) ON DELETE CASCADE,
+	tournament_id integer NOT NULL,
+	wins integer NOT NULL DEFAULT 0,
+	draws integer NOT NULL DEFAULT 0,
+	played integer NOT NULL DEFAULT 0,
+	byes integer NOT NULL DEFAULT 0,
+	opponent_wins integer NOT NULL DEFAULT 0,
+	rank float NOT NULL DEFAULT 0
+);
 
+CREATE INDEX player_stats_rank
+	ON player_stats (tournament_id, rank, opponent_wins DESC, id);
 
--- Create player match count view.
-CREATE VIEW player_matches AS
-	SELECT players.id, players.name, COUNT(matches.player1 + matches.player2) AS played
-	FROM players 
-	LEFT OUTER JOIN matches ON players.id = matches.player1 OR players.id = matches.player2
-	GROUP BY players.id;
 
+-- Create a stats row for each new player.
+CREATE FUNCTION player_stats_add_player() RETURNS trigger AS $$
+BEGIN
+	INSERT INTO player_stats (id, tournament_id)
+	VALUES (NEW.id, NEW.tournament_id);
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
 
--- Create player opponents view.
--- Ignore bye rows.
-CREATE VIEW player_opponents AS
-	SELECT players.id, players.name, 
-	CASE WHEN players.id = matches.player1 THEN matches.player2 ELSE matches.player1 END AS opponent_id
-	FROM players 
-	JOIN matches 
-	ON players.id = matches.player1 OR players.id = matches.player2
-	WHERE matches.player1 != matches.player2;
+CREATE TRIGGER player_stats_add_player AFTER INSERT ON players
+	FOR EACH ROW EXECUTE PROCEDURE player_stats_add_player();
 
 
--- Create player opponent win count view.
-CREATE VIEW player_opponent_wins AS
-	SELECT players.id, players.name, 
-	SUM(CASE WHEN player_wins.wins IS NULL THEN 0 ELSE player_wins.wins END) AS opponent_wins
-	FROM players 
-	LEFT OUTER JOIN player_opponents ON players.id = player_opponents.id
-	LEFT OUTER JOIN player_wins ON player_opponents.opponent_id = player_wins.id
-	GROUP BY players.id;
-
-	
--- Create player bye count view.
+-- Add (change = 1) or remove (change = -1) the result of a match
+-- from the player stats.
+-- When a player's wins change, the opponent wins of each of the player's
+-- opponents change too. When two players meet for the first time, each
+-- player's opponent wins go up by the other player's wins, so this link
+-- is made before the match's win is counted, and undone after it is
+-- removed.
+-- The match row itself is left out of the opponent lookup, since it is
+-- not yet in the table when it is added, but is when it is removed.
+CREATE FUNCTION player_stats_apply_match(t integer,
+	p1 integer, p2 integer, w integer, change integer) RETURNS void AS $$
+BEGIN
+	IF change > 0 AND p1 != p2 THEN
+		UPDATE player_stats AS s
+		SET opponent_wins = s.opponent_wins + change * o.wins
+		FROM player_stats AS o
+		WHERE (s.id = p1 AND o.id = p2) OR (s.id = p2 AND o.id = p1);
+	END IF;
+
+	UPDATE player_stats SET
+		played = played + change,
+		wins = wins + CASE WHEN id = w THEN change ELSE 0 END,
+		draws = draws + CASE WHEN w IS NULL THEN change ELSE 0 END,
+		byes = byes + CASE WHEN p1 = p2 THEN change ELSE 0 END,
+		rank = rank + change
+			- CASE WHEN id = w THEN change ELSE 0 END
+			- CASE WHEN w IS NULL THEN change::float / 2 ELSE 0 END
+	WHERE id IN (p1, p2);
+
+	IF w IS NOT NULL THEN
+		UPDATE player_stats
+		SET opponent_wins = opponent_wins + change * o.times
+		FROM (
+			SELECT opponent_id, COUNT(*) AS times FROM (
+				SELECT player2 AS opponent_id FROM matches
+				WHERE tournament_id = t AND player1 = w AND player2 != w
+				AND NOT (player1 = p1 AND player2 = p2)
+				UNION ALL
+				SELECT player1 FROM matches
+				WHERE tournament_id = t AND player2 = w AND player1 != w
+				AND NOT (player1 = p1 AND player2 = p2)
+			) AS opponents
+			GROUP BY opponent_id
+		) AS o
+		WHERE player_stats.id = o.opponent_id;
+
+		IF p1 != p2 THEN
+			UPDATE player_stats SET opponent_wins = opponent_wins + change
+			WHERE id = CASE WHEN w = p1 THEN p2 ELSE p1 END;
+		END IF;
+	END IF;
+
+	IF change < 0 AND p1 != p2 THEN
+		UPDATE player_stats AS s
+		SET opponent_wins = s.opponent_wins + change * o.wins
+		FROM player_stats AS o
+		WHERE (s.id = p1 AND o.id = p2) OR (s.id = p2 AND o.id = p1);
+	END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Keep the player stats up to date as matches are added, changed and removed.
+-- This is a BEFORE trigger so that, within a statement that writes several
+-- matches, each call sees the matches table exactly as the player stats
+-- describe it.
+-- The tournament and players of a match cannot be changed, only its winner.
+-- While tournament.importing is on, new matches are left out of the stats,
+-- and the importer rebuilds the stats once at the end.
+CREATE FUNCTION player_stats_update_match() RETURNS trigger AS $$
+BEGIN
+	IF TG_OP = 'INSERT'
+			AND current_setting('tournament.importing', true) = 'on' THEN
+		RETURN NEW;
+	END IF;
+	IF TG_OP = 'UPDATE' AND (NEW.tournament_id != OLD.tournament_id
+			OR NEW.player1 != OLD.player1 OR NEW.player2 != OLD.player2) THEN
+		RAISE EXCEPTION 'The players of a match cannot be changed';
+	END IF;
+	IF TG_OP IN ('UPDATE', 'DELETE') THEN
+		PERFORM player_stats_apply_match(OLD.tournament_id,
+			OLD.player1, OLD.player2, OLD.winner, -1);
+	END IF;
+	IF TG_OP = 'DELETE' THEN
+		RETURN OLD;
+	END IF;
+	PERFORM player_stats_apply_match(NEW.tournament_id,
+		NEW.player1, NEW.player2, NEW.winner, 1);
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER player_stats_update_match
+	BEFORE INSERT OR UPDATE OR DELETE ON matches
+	FOR EACH ROW EXECUTE PROCEDURE player_stats_update_match();
+
+
+-- Record each new match in its tournament's current round, unless a round
+-- is given. The tournament row is not locked, so matches can be recorded
+-- at once. The module's writes share the tournament's advisory lock that
+-- closing a round takes alone, so a round cannot be closed between reading
+-- the current round and the match being committed.
+CREATE FUNCTION matches_set_round() RETURNS trigger AS $$
+BEGIN
+	IF NEW.round IS NULL THEN
+		SELECT current_round INTO NEW.round FROM tournaments
+		WHERE id = NEW.tournament_id;
+	END IF;
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER matches_set_round BEFORE INSERT ON matches
+	FOR EACH ROW EXECUTE PROCEDURE matches_set_round();
+
+
+-- Create round standings table.
+-- Holds a copy of each player's stats as they were when each round was
+-- closed, so that past standings are read from one round's rows rather
+-- than recomputed from the match history.
+CREATE TABLE round_standings (
+	tournament_id integer NOT NULL
+		REFERENCES tournaments (id) ON DELETE CASCADE,
+	round integer NOT NULL,
+	id integer NOT NULL REFERENCES players (id) ON DELETE CASCADE,
+	wins integer NOT NULL,
+	draws integer NOT NULL,
+	played integer NOT NULL,
+	byes integer NOT NULL,
+	opponent_wins integer NOT NULL,
+	rank float NOT NULL,
+	PRIMARY KEY (tournament_id, round, id)
+);
+
+CREATE INDEX round_standings_rank
+	ON round_standings (tournament_id, round, rank, opponent_wins DESC, id);
+
+
+-- Take a new version for a tournament that the current transaction has
+-- changed. The version is kept in a setting local to the transaction, and
+-- is only written to the tournament row as the transaction commits, see
+-- tournaments_publish_version(). While the setting is set, the
+-- transaction's own reads are not cached. Returns the new version.
+CREATE FUNCTION tournaments_new_version(t integer) RETURNS bigint AS $$
+DECLARE
+	v bigint := nextval('tournament_versions');
+BEGIN
+	PERFORM set_config('tournament.version_' || t, v::text, true);
+	RETURN v;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Give a tournament a new version after each statement that changes its
+-- players or matches. Statement triggers with transition tables take a
+-- version for each tournament once per statement, however many rows the
+-- statement writes. No rows are locked, so concurrent writers to one
+-- tournament do not wait for each other.
+CREATE FUNCTION tournaments_bump_version() RETURNS trigger AS $$
+BEGIN
+	PERFORM tournaments_new_version(t)
+	FROM (SELECT DISTINCT tournament_id AS t FROM changed_rows) AS changed;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER players_insert_version AFTER INSERT ON players
+	REFERENCING NEW TABLE AS changed_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE tournaments_bump_version();
+CREATE TRIGGER players_delete_version AFTER DELETE ON players
+	REFERENCING OLD TABLE AS changed_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE tournaments_bump_version();
+CREATE TRIGGER matches_insert_version AFTER INSERT ON matches
+	REFERENCING NEW TABLE AS changed_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE tournaments_bump_version();
+CREATE TRIGGER matches_update_version AFTER UPDATE ON matches
+	REFERENCING NEW TABLE AS changed_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE tournaments_bump_version();
+CREATE TRIGGER matches_delete_version AFTER DELETE ON matches
+	REFERENCING OLD TABLE AS changed_rows
+	FOR EACH STATEMENT EXECUTE PROCEDURE tournaments_bump_version();
+
+
+-- Write the latest version the transaction took for a tournament to the
+-- tournament row. A deferred trigger runs as the transaction commits, so
+-- the row is only locked for the commit itself. Only the first changed
+-- row of each tournament updates it, the rest find it up to date.
+CREATE FUNCTION tournaments_publish_version() RETURNS trigger AS $$
+DECLARE
+	t integer;
+	v bigint;
+BEGIN
+	IF TG_OP = 'DELETE' THEN
+		t := OLD.tournament_id;
+	ELSE
+		t := NEW.tournament_id;
+	END IF;
+	v := NULLIF(current_setting('tournament.version_' || t, true), '');
+	IF v IS NOT NULL THEN
+		UPDATE tournaments SET version = v
+		WHERE id = t AND version IS DISTINCT FROM v;
+	END IF;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE CONSTRAINT TRIGGER players_publish_version
+	AFTER INSERT OR DELETE ON players
+	DEFERRABLE INITIALLY DEFERRED
+	FOR EACH ROW EXECUTE PROCEDURE tournaments_publish_version();
+CREATE CONSTRAINT TRIGGER matches_publish_version
+	AFTER INSERT OR UPDATE OR DELETE ON matches
+	DEFERRABLE INITIALLY DEFERRED
+	FOR EACH ROW EXECUTE PROCEDURE tournaments_publish_version();
+
+
+-- Create match perspectives view.
+-- Each match is seen once from each player's side, giving the player,
+-- their opponent and the winner, so that each player's totals can be
+-- counted in a single pass over the matches, without OR joins.
+-- A bye is only seen once, with no opponent.
+CREATE VIEW match_perspectives AS
+	SELECT tournament_id, player1 AS id,
+	NULLIF(player2, player1) AS opponent_id, winner
+	FROM matches
+	UNION ALL
+	SELECT tournament_id, player2, player1, winner
+	FROM matches
+	WHERE player1 != player2;
+
+
+-- Create player totals view.
+-- Counts each player's wins, draws, matches played and byes.
+-- A draw is recorded in the matches tables by setting winner = null.
 -- A player bye is recorded in the matches table as
 -- player = player1 = player2 = winner.
-CREATE VIEW player_byes AS
-	SELECT players.id, players.name, COUNT(matches.player1) AS byes
-	FROM players 
-	LEFT OUTER JOIN matches ON players.id = matches.player1 AND players.id = matches.player2
-	GROUP BY players.id;
+CREATE VIEW player_totals AS
+	SELECT players.tournament_id, players.id, players.name,
+	COUNT(match_perspectives.id) AS played,
+	COUNT(CASE WHEN match_perspectives.winner = players.id THEN 1 END) AS wins,
+	COUNT(CASE WHEN match_perspectives.id IS NOT NULL
+		AND match_perspectives.winner IS NULL THEN 1 END) AS draws,
+	COUNT(CASE WHEN match_perspectives.id IS NOT NULL
+		AND match_perspectives.opponent_id IS NULL THEN 1 END) AS byes
+	FROM players
+	LEFT OUTER JOIN match_perspectives
+	ON players.tournament_id = match_perspectives.tournament_id
+	AND players.id = match_perspectives.id
+	GROUP BY players.tournament_id, players.id;
 
 
--- Create player standings view.
+-- Create player opponent win count view.
+-- Ignore bye rows.
+CREATE VIEW player_opponent_wins AS
+	SELECT players.tournament_id, players.id, players.name,
+	COALESCE(SUM(opponents.wins), 0) AS opponent_wins
+	FROM players
+	LEFT OUTER JOIN match_perspectives
+	ON players.tournament_id = match_perspectives.tournament_id
+	AND players.id = match_perspectives.id
+	LEFT OUTER JOIN player_totals opponents
+	ON match_perspectives.tournament_id = opponents.tournament_id
+	AND match_perspectives.opponent_id = opponents.id
+	GROUP BY players.tournament_id, players.id;
+
+
+-- Create full player standings view.
+-- Recomputes every player's standing from the whole match history.
 -- Player rank is defined as 
 -- matches played by player - player wins - player draws / 2,
 -- so 0 is the highest rank.
+CREATE VIEW standings_full AS
+	SELECT player_totals.tournament_id, player_totals.id, player_totals.name,
+	player_totals.wins, player_totals.draws,
+	player_opponent_wins.opponent_wins,
+	player_totals.played, player_totals.byes,
+	(player_totals.played - player_totals.wins - player_totals.draws::float / 2) AS rank
+	FROM player_totals
+	JOIN player_opponent_wins
+	ON player_totals.tournament_id = player_opponent_wins.tournament_id
+	AND player_totals.id = player_opponent_wins.id;
+
+
+-- Create player standings view.
+-- Reads the running totals from the player stats table.
 CREATE VIEW standings AS
-	SELECT players.id, players.name, 
-	player_wins.wins, player_draws.draws, player_opponent_wins.opponent_wins,
-	player_matches.played, player_byes.byes,
-	(player_matches.played - player_wins.wins - player_draws.draws::float / 2) AS rank
-	FROM players 
-	JOIN player_wins ON players.id = player_wins.id
-	JOIN player_draws ON players.id = player_draws.id
-	JOIN player_opponent_wins ON players.id = player_opponent_wins.id
-	JOIN player_matches ON players.id = player_matches.id
-	JOIN player_byes ON players.id = player_byes.id;
+	SELECT player_stats.tournament_id, players.id, players.name,
+	player_stats.wins, player_stats.draws, player_stats.opponent_wins,
+	player_stats.played, player_stats.byes, player_stats.rank
+	FROM players
+	JOIN player_stats ON players.id = player_stats.id;
 
 
 -- Create possible pairings view.
--- Only return pairings that have not already played each other.
+-- Only return pairings of players in the same tournament,
+-- that have not already played each other.
 CREATE VIEW possible_pairings AS
-	SELECT a.id AS id1, a.name AS name1, a.rank AS rank1, a.opponent_wins AS opponent_wins1,
+	SELECT a.tournament_id,
+	a.id AS id1, a.name AS name1, a.rank AS rank1, a.opponent_wins AS opponent_wins1,
 	b.id AS id2, b.name AS name2, b.rank AS rank2, b.opponent_wins AS opponent_wins2
 	FROM standings a 
-	CROSS JOIN standings b 
+	JOIN standings b ON a.tournament_id = b.tournament_id
 	WHERE a.id != b.id
-	AND b.id NOT IN (SELECT matches.player2 FROM matches WHERE matches.player1 = a.id)
-	AND b.id NOT IN (SELECT matches.player1 FROM matches WHERE matches.player2 = a.id);
+	AND NOT EXISTS (SELECT 1 FROM matches
+		WHERE matches.tournament_id = a.tournament_id
+		AND matches.player1 = a.id AND matches.player2 = b.id)
+	AND NOT EXISTS (SELECT 1 FROM matches
+		WHERE matches.tournament_id = a.tournament_id
+		AND matches.player1 = b.id AND matches.player2 = a.id);
 
 
@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+#
+# tournament_async.py -- asyncio API for a Swiss-system tournament
+#
+# Needs Python 3.5 or later, and the aiopg package.
+#
+
+import asyncio
+import logging
+import aiopg
+import psycopg2
+import tournament
+import tournament_tiebreaks
+
+
+# The executor the pairing search runs in, or None for the event loop's
+# default executor. A concurrent.futures.ProcessPoolExecutor runs the
+# searches of several tournaments in parallel.
+EXECUTOR = None
+
+_pool = None
+
+
+def configure(executor=None):
+    """Change the executor the pairing search runs in.
+
+    The database connection settings are shared with the tournament
+    module, see tournament.configure().
+
+    Args:
+      executor: a concurrent.futures.Executor, or None for the event
+        loop's default executor.
+    """
+    global EXECUTOR
+    EXECUTOR = executor
+
+
+async def getPool():
+    """Returns the shared aiopg connection pool, creating it if needed.
+
+    Uses the DSN and pool sizes of the tournament module.
+    """
+    global _pool
+    if _pool is None:
+        _pool = asyncio.ensure_future(aiopg.create_pool(
+            tournament.DSN, minsize=tournament.POOL_MIN,
+            maxsize=tournament.POOL_MAX))
+    try:
+        return await _pool
+    except Exception:
+        _pool = None
+        raise
+
+
+async def closePool():
+    """Close all the connections in the shared pool."""
+    global _pool
+    if _pool is not None:
+        pool, _pool = await _pool, None
+        pool.close()
+        await pool.wait_closed()
+
+
+class AsyncSession(object):
+    """A unit of work against the tournament database, for asyncio.
+
+    The async counterpart of tournament.Session. A session takes one
+    connection from the pool, and runs its calls in one transaction, which
+    is committed when the block exits, or rolled back if the block raises.
+
+        async with tournament_async.session(tournament_id) as s:
+            await s.registerPlayer("Kirk")
+            pairs = await s.swissPairings()
+
+    The methods are coroutines with the same arguments and results as the
+    methods of tournament.Session.
+    """
+
+    def __init__(self, pool=None, tournament_id=None):
+        self.pool = pool
+        if tournament_id is None:
+            tournament_id = tournament.DEFAULT_TOURNAMENT
+        self.tournament = tournament_id
+        self.conn = None
+
+    async def __aenter__(self):
+        if self.pool is None:
+            self.pool = await getPool()
+        self.conn = await self.pool.acquire()
+        try:
+            # aiopg connections are in autocommit mode,
+            # so the transaction is started by hand.
+            await self._execute("BEGIN;")
+        except Exception:
+            self.pool.release(self.conn)
+            self.conn = None
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                await self._execute("COMMIT;")
+            else:
+                await self._execute("ROLLBACK;")
+        finally:
+            self.pool.release(self.conn)
+            self.conn = None
+        return False
+
+    async def _execute(self, sql, args=None):
+        """Execute a statement and return the cursor holding its results."""
+        c = await self.conn.cursor()
+        await c.execute(sql, args)
+        return c
+
+    async def _fetchone(self, sql, args=None):
+        c = await self._execute(sql, args)
+        return await c.fetchone()
+
+    async def _fetchall(self, sql, args=None):
+        c = await self._execute(sql, args)
+        return await c.fetchall()
+
+    async def createTournament(self, name):
+        """Adds a tournament to the database, and returns its id."""
+        sql = "INSERT INTO tournaments (name) VALUES (%s) RETURNING id;"
+        return (await self._fetchone(sql, (name,)))[0]
+
+    async def deleteTournament(self):
+        """Remove the tournament, and all its players and matches."""
+        await self._execute("DELETE FROM matches WHERE tournament_id = %s;",
+                            (self.tournament,))
+        await self._execute("DELETE FROM tournaments WHERE id = %s;",
+                            (self.tournament,))
+
+    async def deleteMatches(self):
+        """Remove all the tournament's match records from the database,
+        and its rounds.
+        """
+        await self._execute("DELETE FROM matches WHERE tournament_id = %s;",
+                            (self.tournament,))
+        await self._resetRounds()
+
+    async def _resetRounds(self):
+        """Remove the round standings, and go back to the first round."""
+        await self._execute(
+            "DELETE FROM round_standings WHERE tournament_id = %s;",
+            (self.tournament,))
+        await self._execute("""UPDATE tournaments SET current_round = 1,
+                    version = tournaments_new_version(id)
+                    WHERE id = %s AND current_round != 1;""",
+                            (self.tournament,))
+
+    async def deletePlayers(self):
+        """Remove all the tournament's player records from the database,
+        and its rounds.
+        """
+        await self._execute("DELETE FROM players WHERE tournament_id = %s;",
+                            (self.tournament,))
+        await self._resetRounds()
+
+    async def countPlayers(self):
+        """Returns the number of players currently registered."""
+        sql = "SELECT COUNT(id) FROM players WHERE tournament_id = %s;"
+        return (await self._fetchone(sql, (self.tournament,)))[0]
+
+    async def registerPlayer(self, name):
+        """Adds a player to the tournament database."""
+        sql = """INSERT INTO players (tournament_id, name) VALUES (%s, %s)
+                    RETURNING id;"""
+        return (await self._fetchone(sql, (self.tournament, name)))[0]
+
+    async def registerPlayers(self, names):
+        """Adds a list of players to the tournament database at once."""
+        if not names:
+            return []
+        sql = """INSERT INTO players (tournament_id, name)
+                    SELECT %s, name FROM unnest(%s::text[])
+                    WITH ORDINALITY AS t (name, position)
+                    ORDER BY position
+                    RETURNING id;"""
+        rows = await self._fetchall(sql, (self.tournament, list(names)))
+        return sorted(row[0] for row in rows)
+
+    async def playerStandings(self):
+        """Returns a list of the players and their win records."""
+        sql = """SELECT id, name, wins, draws, opponent_wins, played, byes, rank
+                    FROM standings WHERE tournament_id = %s
+                    ORDER BY rank, opponent_wins DESC, id;"""
+        return await self._fetchall(sql, (self.tournament,))
+
+    async def rankedStandings(self):
+        """Returns the standings, as playerStandings() does, with the
+        players of the same rank ordered by tournament.TIEBREAKS.
+        """
+        standings = await self.playerStandings()
+        tiebreaks = tuple(tournament.TIEBREAKS)
+        if tiebreaks == ("opponent_wins",):
+            # The order the standings are already read in.
+            return standings
+        return tournament_tiebreaks.orderStandings(
+            standings, await self.matchResults(), tiebreaks)
+
+    async def matchResults(self):
+        """Returns a list of (player1, player2, winner) tuples of every
+        match recorded, byes included.
+        """
+        sql = """SELECT player1, player2, winner FROM matches
+                    WHERE tournament_id = %s
+                    ORDER BY round, player1, player2;"""
+        return await self._fetchall(sql, (self.tournament,))
+
+    async def reportMatch(self, player1, player2, winner=None):
+        """Records the outcome of a single match between two players."""
+        await self._lockResults()
+        sql = """INSERT INTO matches (tournament_id,player1,player2,winner)
+                    VALUES (%s,%s,%s,%s);"""
+        await self._execute(sql, (self.tournament, player1, player2, winner))
+
+    async def reportMatches(self, results):
+        """Records the outcomes of a round of matches with one statement."""
+        rows = [tournament._matchRow(result) for result in results]
+        if not rows:
+            return []
+        await self._lockResults()
+        # aiopg has no execute_values(), so the round is passed as one
+        # array for each column.
+        sql = """INSERT INTO matches (tournament_id,player1,player2,winner)
+                    SELECT %s, player1, player2, winner
+                    FROM unnest(%s::integer[], %s::integer[], %s::integer[])
+                    AS t (player1, player2, winner);"""
+        args = (self.tournament,) + tuple(
+            list(column) for column in zip(*rows))
+
+        # As tournament.Session.reportMatches(), fall back to one row at a
+        # time if the whole round cannot be inserted at once.
+        await self._execute("SAVEPOINT report_matches;")
+        try:
+            await self._execute(sql, args)
+            await self._execute("RELEASE SAVEPOINT report_matches;")
+            return []
+        except psycopg2.Error:
+            await self._execute("ROLLBACK TO SAVEPOINT report_matches;")
+            await self._execute("RELEASE SAVEPOINT report_matches;")
+
+        errors = []
+        for i, row in enumerate(rows):
+            await self._execute("SAVEPOINT report_match;")
+            try:
+                await self.reportMatch(*row)
+            except psycopg2.Error as e:
+                await self._execute("ROLLBACK TO SAVEPOINT report_match;")
+                errors.append((i, row, str(e).strip()))
+            await self._execute("RELEASE SAVEPOINT report_match;")
+        logging.info("%d of %d match results could not be recorded",
+                     len(errors), len(rows))
+        return errors
+
+    async def _lockResults(self):
+        """Share the tournament's results lock until the session ends, as
+        tournament.Session does before it writes matches.
+        """
+        await self._execute(
+            "SELECT pg_advisory_xact_lock_shared(%s::bigint);",
+            (self.tournament,))
+
+    async def lockPairing(self):
+        """Wait for the results being written to the tournament, and hold
+        back new ones, until the session ends.
+        """
+        await self._execute("SELECT pg_advisory_xact_lock(%s::bigint);",
+                            (self.tournament,))
+
+    async def checkPlayerStats(self):
+        """Compare the player stats table with a full recompute."""
+        sql = """SELECT COALESCE(s.id, f.id),
+                    f.wins, f.draws, f.played, f.byes, f.opponent_wins, f.rank,
+                    s.wins, s.draws, s.played, s.byes, s.opponent_wins, s.rank
+                    FROM (SELECT * FROM player_stats
+                          WHERE tournament_id = %s) s
+                    FULL OUTER JOIN (SELECT * FROM standings_full
+                                     WHERE tournament_id = %s) f
+                    ON s.id = f.id
+                    WHERE (s.wins, s.draws, s.played, s.byes,
+                           s.opponent_wins, s.rank)
+                    IS DISTINCT FROM (f.wins, f.draws, f.played, f.byes,
+                                      f.opponent_wins, f.rank)
+                    ORDER BY 1;"""
+        rows = await self._fetchall(sql, (self.tournament, self.tournament))
+        return [(row[0], tuple(row[1:7]), tuple(row[7:13])) for row in rows]
+
+    async def possibleByePlayers(self):
+        """Get the list of players that have not had a bye."""
+        sql = """SELECT id, name FROM standings
+                    WHERE tournament_id = %s AND byes = 0
+                    ORDER BY rank, opponent_wins DESC, id;"""
+        return await self._fetchall(sql, (self.tournament,))
+
+    async def possiblePairings(self):
+        """Get the list of possible pairings for a round."""
+        sql = """SELECT id1, name1, id2, name2 FROM possible_pairings
+                    WHERE tournament_id = %s
+                    ORDER BY rank1, opponent_wins1 DESC, id1,
+                    rank2, opponent_wins2 DESC, id2;"""
+        return await self._fetchall(sql, (self.tournament,))
+
+    async def playedPairs(self):
+        """Get the set of pairs of players that have already played."""
+        sql = """SELECT player1, player2 FROM matches
+                    WHERE tournament_id = %s AND player1 != player2;"""
+        rows = await self._fetchall(sql, (self.tournament,))
+        return set((min(row), max(row)) for row in rows)
+
+    async def swissPairings(self, candidates=None, engine=None, window=None):
+        """Returns a list of pairs of players for the next round of a match.
+
+        The standings are read here, and the pairing search is run in the
+        executor, so that it does not hold up the event loop.
+        See tournament.swissPairings() for the pairing rules.
+        """
+        if candidates is None:
+            candidates = tournament.PAIRING_CANDIDATES
+        if engine is None:
+            engine = tournament.PAIRING_ENGINE
+        if window is None:
+            window = tournament.PAIRING_WINDOW
+        loop = asyncio.get_event_loop()
+
+        await self.lockPairing()
+        standings = await self.rankedStandings()
+        if candidates == "view":
+            possible_bye_players = []
+            if len(standings) % 2 != 0:
+                possible_bye_players = await self.possibleByePlayers()
+            # Every possible pairing is read at once, and the window is
+            # applied to them in the executor.
+            possible_pairs = await self.possiblePairings()
+            if tuple(tournament.TIEBREAKS) != ("opponent_wins",):
+                # The view orders players of the same rank by opponent
+                # wins, so put them in the tiebreak order, as
+                # tournament.BaseSession.swissPairings() does.
+                positions = dict(
+                    (row[0], i) for (i, row) in enumerate(standings))
+                possible_bye_players.sort(
+                    key=lambda player: positions[player[0]])
+                possible_pairs.sort(
+                    key=lambda pair: (positions[pair[0]], positions[pair[2]]))
+            return await loop.run_in_executor(
+                EXECUTOR, tournament.pairPossiblePairs,
+                [row[0] for row in standings], possible_bye_players,
+                possible_pairs, engine, window)
+        elif candidates == "memory":
+            played_pairs = await self.playedPairs()
+            return await loop.run_in_executor(
+                EXECUTOR, tournament.pairStandings,
+                [tuple(row) for row in standings], played_pairs, engine,
+                window)
+        raise ValueError("Unknown pairing candidates %r" % (candidates,))
+
+
+def session(tournament_id=None):
+    """Returns a new AsyncSession that uses the shared connection pool.
+
+    Args:
+      tournament_id: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+    """
+    return AsyncSession(None, tournament_id)
+
+
+async def createTournament(name):
+    """Adds a tournament to the database, see tournament.createTournament()."""
+    async with session() as s:
+        return await s.createTournament(name)
+
+
+async def deleteTournament(tournament_id):
+    """Remove a tournament, and all its players and matches."""
+    async with session(tournament_id) as s:
+        await s.deleteTournament()
+
+
+async def deleteMatches(tournament_id=None):
+    """Remove all the match records of a tournament from the database."""
+    async with session(tournament_id) as s:
+        await s.deleteMatches()
+
+
+async def deletePlayers(tournament_id=None):
+    """Remove all the player records of a tournament from the database."""
+    async with session(tournament_id) as s:
+        await s.deletePlayers()
+
+
+async def countPlayers(tournament_id=None):
+    """Returns the number of players currently registered."""
+    async with session(tournament_id) as s:
+        return await s.countPlayers()
+
+
+async def registerPlayer(name, tournament_id=None):
+    """Adds a player to the tournament database, and returns their id."""
+    async with session(tournament_id) as s:
+        return await s.registerPlayer(name)
+
+
+async def registerPlayers(names, tournament_id=None):
+    """Adds a list of players to the tournament database in one statement,
+    see tournament.registerPlayers().
+    """
+    async with session(tournament_id) as s:
+        return await s.registerPlayers(names)
+
+
+async def playerStandings(tournament_id=None):
+    """Returns a list of the players and their win records,
+    see tournament.playerStandings().
+    """
+    async with session(tournament_id) as s:
+        return await s.rankedStandings()
+
+
+async def reportMatch(player1, player2, winner=None, tournament_id=None):
+    """Records the outcome of a single match between two players."""
+    async with session(tournament_id) as s:
+        await s.reportMatch(player1, player2, winner)
+
+
+async def reportMatches(results, tournament_id=None):
+    """Records the outcomes of a round of matches in a single transaction,
+    see tournament.reportMatches().
+    """
+    async with session(tournament_id) as s:
+        return await s.reportMatches(results)
+
+
+async def checkPlayerStats(tournament_id=None):
+    """Check the player stats table against a full recompute of the
+    standings, see tournament.checkPlayerStats().
+    """
+    async with session(tournament_id) as s:
+        return await s.checkPlayerStats()
+
+
+async def playedPairs(tournament_id=None):
+    """Get the pairs of players that have already played each other."""
+    async with session(tournament_id) as s:
+        return await s.playedPairs()
+
+
+async def possibleByePlayers(tournament_id=None):
+    """Get the list of players that have not had a bye."""
+    async with session(tournament_id) as s:
+        return await s.possibleByePlayers()
+
+
+async def possiblePairings(tournament_id=None):
+    """Get the list of possible pairings for a round."""
+    async with session(tournament_id) as s:
+        return await s.possiblePairings()
+
+
+async def swissPairings(candidates=None, engine=None, tournament_id=None,
+                        window=None):
+    """Returns a list of pairs of players for the next round of a match,
+    see tournament.swissPairings().
+
+    The pairing search runs in the executor, so that it does not hold up
+    the event loop. With the "memory" candidates, the database connection
+    is given back to the pool before the search starts.
+    """
+    if candidates is None:
+        candidates = tournament.PAIRING_CANDIDATES
+    if engine is None:
+        # Settled here, since the executor may run in another process.
+        engine = tournament.PAIRING_ENGINE
+    if window is None:
+        window = tournament.PAIRING_WINDOW
+    if candidates != "memory":
+        async with session(tournament_id) as s:
+            return await s.swissPairings(candidates, engine, window)
+    async with session(tournament_id) as s:
+        await s.lockPairing()
+        standings = [tuple(row) for row in await s.rankedStandings()]
+        played_pairs = await s.playedPairs()
+    return await asyncio.get_event_loop().run_in_executor(
+        EXECUTOR, tournament.pairStandings, standings, played_pairs, engine,
+        window)
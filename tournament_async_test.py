@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#
+# Test cases for tournament_async.py
+#
+
+import asyncio
+import time
+import tournament
+import tournament_async
+
+
+async def playTournament(player_count, rounds):
+    """Play a tournament of its own, with the first player of each pair
+    winning, and return its id.
+    """
+    t = await tournament_async.createTournament("Async test")
+    await tournament_async.registerPlayers(
+        ["Player%d" % x for x in range(player_count)], t)
+    for x in range(rounds):
+        pairings = await tournament_async.swissPairings(tournament_id=t)
+        errors = await tournament_async.reportMatches(
+            [(id1, id2, id1) for (id1, name1, id2, name2) in pairings], t)
+        if errors:
+            raise ValueError("Every result should be recorded.")
+    return t
+
+
+async def testConcurrentTournaments():
+    tournaments = await asyncio.gather(
+        *[playTournament(8 + x % 5, 3) for x in range(20)])
+    try:
+        for (x, t) in enumerate(tournaments):
+            standings = await tournament_async.playerStandings(t)
+            if len(standings) != 8 + x % 5:
+                raise ValueError(
+                    "Each tournament should only have its own players.")
+            if any(row[5] != 3 for row in standings):
+                raise ValueError(
+                    "Each player should have played every round.")
+            if await tournament_async.checkPlayerStats(t):
+                raise ValueError(
+                    "The player stats should agree with a full recompute.")
+    finally:
+        await asyncio.gather(
+            *[tournament_async.deleteTournament(t) for t in tournaments])
+    print("1. Many tournaments can be played at once on one event loop.")
+
+
+async def testSameAsBlocking():
+    t = await playTournament(9, 2)
+    try:
+        for tiebreaks in (("opponent_wins",),
+                          ("opponents_opponents_score", "buchholz")):
+            tournament.TIEBREAKS = tiebreaks
+            if (await tournament_async.playerStandings(t) !=
+                    tournament.playerStandings(t)):
+                raise ValueError("The async standings should match the "
+                                 "blocking standings.")
+            for candidates in ("memory", "view"):
+                for window in (None, 1):
+                    if (await tournament_async.swissPairings(
+                            candidates, None, t, window) !=
+                            tournament.swissPairings(
+                                candidates, None, t, window)):
+                        raise ValueError("The async pairings should match "
+                                         "the blocking pairings.")
+    finally:
+        tournament.TIEBREAKS = ("opponent_wins",)
+        await tournament_async.deleteTournament(t)
+    print("2. The async API gives the same standings and pairings "
+          "as the blocking API.")
+
+
+async def testReportMatchesErrors():
+    t = await tournament_async.createTournament("Async errors")
+    try:
+        [id1, id2, id3, id4] = await tournament_async.registerPlayers(
+            ["Kirk", "Spock", "McCoy", "Scotty"], t)
+        errors = await tournament_async.reportMatches(
+            [(id1, id2, id1), (id1, id2, id2), (id3, id4)], t)
+        if [i for (i, row, error) in errors] != [1]:
+            raise ValueError(
+                "Only the repeated match should fail to be recorded.")
+        standings = await tournament_async.playerStandings(t)
+        if sum(row[5] for row in standings) != 4:
+            raise ValueError("The other results should be recorded.")
+    finally:
+        await tournament_async.deleteTournament(t)
+    print("3. reportMatches() records the good results and returns "
+          "the bad ones.")
+
+
+async def testPairingOffTheLoop():
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(time.time())
+            await asyncio.sleep(0.001)
+
+    t = await tournament_async.createTournament("Async search")
+    ticker = asyncio.ensure_future(tick())
+    try:
+        await tournament_async.registerPlayers(
+            ["Player%d" % x for x in range(200)], t)
+        started = time.time()
+        await tournament_async.swissPairings(engine="matching",
+                                             tournament_id=t)
+        finished = time.time()
+    finally:
+        ticker.cancel()
+        await tournament_async.deleteTournament(t)
+    if len([x for x in ticks if started < x < finished]) < 2:
+        raise ValueError(
+            "The event loop should keep running during the pairing search.")
+    print("4. The pairing search does not hold up the event loop.")
+
+
+async def testDeleteMatchesResetsRounds():
+    t = await playTournament(6, 1)
+    try:
+        tournament.closeRound(t)
+        await tournament_async.deleteMatches(t)
+        if tournament.currentRound(t) != 1:
+            raise ValueError(
+                "Deleting the matches should go back to the first round.")
+        try:
+            tournament.playerStandings(t, as_of_round=1)
+        except ValueError:
+            pass
+        else:
+            raise ValueError(
+                "Deleting the matches should remove the round standings.")
+    finally:
+        await tournament_async.deleteTournament(t)
+    print("5. Deleting the matches starts the rounds again.")
+
+
+async def main():
+    try:
+        await testConcurrentTournaments()
+        await testSameAsBlocking()
+        await testReportMatchesErrors()
+        await testPairingOffTheLoop()
+        await testDeleteMatchesResetsRounds()
+    finally:
+        await tournament_async.closePool()
+    print("Success!  All tests pass!")
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
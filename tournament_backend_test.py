@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# Test cases for the tournament.py storage backends.
+# Plays the same tournaments on the PostgreSQL and in-memory backends,
+# and checks that they give the same standings and pairings.
+#
+
+import math
+from random import Random
+from tournament import PostgresBackend
+from tournament_memory import MemoryBackend
+
+
+def playBoth(player_count, rounds, seed, candidates=None, engine=None):
+    """Play the same tournament on both backends, with random results.
+
+    The standings and pairings of the two backends are compared before
+    every round, and at the end.
+
+    Args:
+        player_count: the number of players.
+        rounds: the number of rounds to play.
+        seed: the seed for the random match results.
+        candidates: the pairing candidates passed to swissPairings().
+        engine: the pairing engine passed to swissPairings().
+    """
+    backends = [PostgresBackend(), MemoryBackend()]
+    tournaments = []
+    try:
+        for backend in backends:
+            with backend.session() as s:
+                tournaments.append(s.createTournament("Backend test"))
+        names = ["Player%d" % x for x in range(player_count)]
+        [pg_ids, memory_ids] = [
+            registerPlayersOn(backend, t, names)
+            for (backend, t) in zip(backends, tournaments)]
+        # Both backends hand out ids in order of registration, so players
+        # are matched up by the order they were registered in.
+        to_pg = dict(zip(memory_ids, pg_ids))
+        to_memory = dict(zip(pg_ids, memory_ids))
+
+        random = Random(seed)
+        for x in range(rounds + 1):
+            [pg, memory] = [
+                standingsAndPairings(backend, t, candidates, engine)
+                for (backend, t) in zip(backends, tournaments)]
+            memory = (mapIds(memory[0], to_pg, (0,)),
+                      mapIds(memory[1], to_pg, (0, 2)))
+            if pg[0] != memory[0]:
+                raise ValueError(
+                    "Both backends should give the same standings.")
+            if pg[1] != memory[1]:
+                raise ValueError(
+                    "Both backends should give the same pairings.")
+            if x == rounds:
+                break
+            results = randomResults(pg[1], random)
+            if (reportMatchesOn(backends[0], tournaments[0], results) or
+                    reportMatchesOn(backends[1], tournaments[1],
+                                    mapIds(results, to_memory, (0, 1, 2)))):
+                raise ValueError("Every result should be recorded.")
+
+        for (backend, t) in zip(backends, tournaments):
+            with backend.session(t) as s:
+                if s.checkPlayerStats():
+                    raise ValueError(
+                        "The player totals should agree with a recompute.")
+    finally:
+        for (backend, t) in zip(backends, tournaments):
+            with backend.session(t) as s:
+                s.deleteTournament()
+
+
+def registerPlayersOn(backend, tournament, names):
+    with backend.session(tournament) as s:
+        return s.registerPlayers(names)
+
+
+def reportMatchesOn(backend, tournament, results):
+    with backend.session(tournament) as s:
+        return s.reportMatches(results)
+
+
+def standingsAndPairings(backend, tournament, candidates, engine):
+    """Returns the standings, and the pairings for the next round or None
+    if no complete set of pairings can be made.
+    """
+    with backend.session(tournament) as s:
+        standings = s.playerStandings()
+        try:
+            pairings = s.swissPairings(candidates, engine)
+        except ValueError:
+            pairings = None
+        return standings, pairings
+
+
+def mapIds(rows, ids, positions):
+    """Returns the rows with the ids in the given positions swapped
+    for the ids they map to.
+    """
+    if rows is None:
+        return None
+    return [tuple(ids.get(value, value) if i in positions else value
+                  for (i, value) in enumerate(row))
+            for row in rows]
+
+
+def randomResults(pairings, random):
+    """Returns random results for a round of pairings."""
+    results = []
+    for (id1, name1, id2, name2) in pairings or []:
+        if id1 == id2:
+            results.append((id1, id2, id1))
+        else:
+            results.append((id1, id2, random.choice((id1, id2, None))))
+    return results
+
+
+def testSameStandings():
+    playBoth(9, 4, 1)
+    print "1. Both backends give the same standings, byes and pairings."
+
+
+def testSameDraws():
+    playBoth(16, 4, 2, engine="matching")
+    print ("2. Both backends give the same standings with draws, "
+           "and the same matching pairings.")
+
+
+def testSameViewCandidates():
+    playBoth(7, 3, 3, candidates="view")
+    print ("3. Both backends give the same possible byes and pairings "
+           "for view candidates.")
+
+
+def testSameErrors():
+    backends = [PostgresBackend(), MemoryBackend()]
+    errors = []
+    for backend in backends:
+        with backend.session() as s:
+            t = s.createTournament("Backend errors")
+        try:
+            with backend.session(t) as s:
+                [id1, id2, id3, id4] = s.registerPlayers(
+                    ["Kirk", "Spock", "McCoy", "Scotty"])
+                errors.append([i for (i, row, error) in s.reportMatches([
+                    (id1, id2, id1), (id1, id2, id2), (id3, -1, id3),
+                    (id3, id4, None), (id4, id4, id4)])])
+                if s.checkPlayerStats():
+                    raise ValueError(
+                        "The player totals should agree with a recompute.")
+        finally:
+            with backend.session(t) as s:
+                s.deleteTournament()
+    if errors != [[1, 2], [1, 2]]:
+        raise ValueError(
+            "Both backends should reject the same results, not %r" % errors)
+    print "4. Both backends reject the same bad results."
+
+
+def testSameRandomTournaments():
+    random = Random(5)
+    for seed in range(20):
+        player_count = random.randint(2, 40)
+        rounds = int(math.ceil(math.log(player_count, 2)))
+        playBoth(player_count, rounds, seed,
+                 engine=random.choice(("backtrack", "matching")))
+    print "5. Both backends play the same random tournaments."
+
+
+if __name__ == '__main__':
+    testSameStandings()
+    testSameDraws()
+    testSameViewCandidates()
+    testSameErrors()
+    testSameRandomTournaments()
+    print "Success!  All tests pass!"
@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+#
+# tournament_bench.py -- benchmarks of standings and pairings by field size
+#
+
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import tournament
+import tournament_tiebreaks
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has no tracemalloc, so only the process' peak memory
+    # is recorded.
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Field sizes, from 8 to 4096 players.
+SIZES = tuple(2 ** x for x in range(3, 13))
+# How the seeded results are chosen.
+# "random": random pairs, and random winners and draws.
+# "draws": pairs by rank, every match drawn, so all the players stay tied.
+# "adversarial": pairs by rank, the higher ranked player always wins, so
+#   players next to each other in the standings have already played,
+#   and the pairing search has to look far for each pair.
+PATTERNS = ("random", "draws", "adversarial")
+
+
+def benchmark(sizes=SIZES, patterns=PATTERNS, repeat=3, seed=0,
+              max_seconds=10.0, backend=None):
+    """Time the standings and pairing functions by field size and round.
+
+    For each pattern and size, a tournament is created and seeded with
+    log2(size) rounds of results. Before each round, and after the last,
+    each function is timed, and its query count and peak memory are
+    recorded. Once a function takes longer than max_seconds for a
+    pattern, it is skipped for the larger sizes of that pattern.
+
+    Args:
+      sizes: the numbers of players.
+      patterns: the result patterns, from PATTERNS.
+      repeat: the number of times each function is timed.
+      seed: the seed for the random results.
+      max_seconds: the time a function can take before it is skipped
+        for larger sizes.
+      backend: the backend to use, as passed to useBackend(), defaults to
+        the backend in use.
+
+    Returns:
+      A dictionary of the results, containing:
+        meta: a dictionary describing the run
+        results: a list of dictionaries, one for each function timed
+          at each pattern, size and round, see measure()
+    """
+    if backend is not None:
+        tournament.useBackend(backend)
+    counter = _QueryCounter()
+    results = []
+    try:
+        for pattern in patterns:
+            rng = random.Random(seed)
+            slow = set()
+            for size in sizes:
+                results.extend(
+                    benchmarkTournament(size, pattern, rng, repeat,
+                                        max_seconds, slow, counter))
+    finally:
+        counter.remove()
+
+    meta = {
+        "backend": tournament.getBackend().name,
+        "commit": _gitCommit(),
+        "python": platform.python_version(),
+        "repeat": repeat,
+        "seed": seed,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    if resource is not None:
+        meta["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {"meta": meta, "results": results}
+
+
+def benchmarkTournament(size, pattern, rng, repeat, max_seconds, slow,
+                        counter):
+    """Seed one tournament round by round, timing the functions before
+    each round, and after the last one.
+
+    The names of the functions that took longer than max_seconds are
+    added to slow, and slow functions are skipped.
+    """
+    t = tournament.createTournament("Benchmark %s %d" % (pattern, size))
+    try:
+        with tournament.session(t) as s:
+            s.registerPlayers(["Player%d" % x for x in range(size)])
+        rounds = int(math.ceil(math.log(size, 2)))
+        results = []
+        for depth in range(rounds + 1):
+            for (name, function) in _functions(t):
+                if name in slow:
+                    continue
+                result = measure(function, repeat, counter)
+                results.append(_row(pattern, size, depth, name, result))
+                if name == "swissPairings[backtrack]":
+                    # The backtracking search on its own, without the
+                    # queries and the work of setting it up.
+                    times = counter.searchTimes
+                    results.append(_row(pattern, size, depth, "tryPairing", {
+                        "seconds": min(times), "median": _median(times),
+                        "queries": 0, "peak_memory": None,
+                        "error": result["error"]}))
+                if result["seconds"] > max_seconds:
+                    slow.add(name)
+            if depth < rounds:
+                standings = tournament.playerStandings(t)
+                played_pairs = tournament.playedPairs(t)
+                match_results = seedResults(
+                    standings, played_pairs, pattern, rng)
+                result = measure(
+                    lambda: tournament.reportMatches(match_results, t),
+                    1, counter, memory=False)
+                results.append(
+                    _row(pattern, size, depth, "reportMatches", result))
+        return results
+    finally:
+        tournament.deleteTournament(t)
+
+
+def _functions(t):
+    """Returns the (name, function) pairs to time for a tournament."""
+    return [
+        ("countPlayers", lambda: tournament.countPlayers(t)),
+        ("playerStandings", lambda: tournament.playerStandings(t)),
+        ("playerStandings[tiebreaks]",
+         lambda: tournament.playerStandings(
+             t, tiebreaks=tournament_tiebreaks.TIEBREAKS)),
+        ("iterStandings",
+         lambda: sum(1 for row in tournament.iterStandings(t))),
+        ("standingsPage", lambda: tournament.standingsPage(50, tournament=t)),
+        ("playedPairs", lambda: tournament.playedPairs(t)),
+        ("possibleByePlayers", lambda: tournament.possibleByePlayers(t)),
+        ("possiblePairings", lambda: tournament.possiblePairings(t)),
+        ("swissPairings[backtrack]",
+         lambda: tournament.swissPairings(engine="backtrack", tournament=t)),
+        ("swissPairings[matching]",
+         lambda: tournament.swissPairings(engine="matching", tournament=t)),
+        ("swissPairings[backtrack,window=8]",
+         lambda: tournament.swissPairings(engine="backtrack", tournament=t,
+                                          window=8)),
+        ("swissPairings[matching,window=8]",
+         lambda: tournament.swissPairings(engine="matching", tournament=t,
+                                          window=8)),
+    ]
+
+
+def _row(pattern, size, depth, name, result):
+    row = {"pattern": pattern, "players": size, "round": depth,
+           "function": name}
+    row.update(result)
+    return row
+
+
+def measure(function, repeat, counter, memory=True):
+    """Time a function.
+
+    Args:
+      function: the function to call, with no arguments.
+      repeat: the number of times to call it.
+      counter: the _QueryCounter counting the queries.
+      memory: if True, call the function once more to find its peak memory.
+
+    Returns:
+      A dictionary, containing:
+        seconds: the shortest time the function took
+        median: the median time the function took
+        queries: the number of SQL statements the function executed
+        peak_memory: the most memory, in bytes, the function had allocated
+          at once, or None if it was not measured
+        error: the error raised by the function, or None
+    """
+    times = []
+    error = None
+    queries = 0
+    counter.searchTimes = []
+    for x in range(repeat):
+        counter.queries = 0
+        counter.searchSeconds = 0.0
+        started = time.time()
+        try:
+            function()
+        except ValueError as e:
+            # The pairing functions raise ValueError when no complete
+            # set of pairs can be made.
+            error = str(e)
+        times.append(time.time() - started)
+        queries = counter.queries
+        counter.searchTimes.append(counter.searchSeconds)
+
+    peak_memory = None
+    if memory and tracemalloc is not None:
+        # Traced separately, since tracing slows the function down.
+        tracemalloc.start()
+        try:
+            try:
+                function()
+            except ValueError:
+                pass
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {"seconds": min(times), "median": _median(times),
+            "queries": queries, "peak_memory": peak_memory, "error": error}
+
+
+def benchmarkPlanning(size=1024, repeat=20, seed=0):
+    """Compare the planning time of the prepared statements, see
+    tournament.Session.statements, with the same statements sent as plain
+    SQL, as they were before they were prepared.
+
+    A tournament of size players is seeded with log2(size) rounds of
+    random results, and each statement is run repeat times each way,
+    under EXPLAIN ANALYZE to read its planning time, and on its own to
+    time it. PostgreSQL plans the first few executions of a prepared
+    statement for their parameters, and after that reuses a generic plan,
+    so the medians show the time saved on a busy connection. Each run is
+    rolled back, so the match insert does not change the tournament.
+
+    Args:
+      size: the number of players.
+      repeat: the number of times each statement is run each way.
+      seed: the seed for the random results.
+
+    Returns:
+      A list of dictionaries, one for each statement, containing:
+        statement: the name of the statement
+        players: the number of players
+        plain_planning: the median planning time of the plain SQL,
+          in seconds
+        prepared_planning: the median planning time of the prepared
+          statement, in seconds
+        plain_seconds: the median time taken to run the plain SQL
+        prepared_seconds: the median time taken to run the prepared
+          statement
+    """
+    if tournament.getBackend().name != "postgresql":
+        raise ValueError("Only PostgreSQL plans statements")
+    rng = random.Random(seed)
+    t = tournament.createTournament("Planning benchmark %d" % size)
+    try:
+        with tournament.session(t) as s:
+            s.registerPlayers(["Player%d" % x for x in range(size)])
+            for x in range(int(math.ceil(math.log(size, 2)))):
+                s.reportMatches(seedResults(
+                    s.playerStandings(), s.playedPairs(), "random", rng))
+            (id1, name1, id2, name2) = s.possiblePairings()[0]
+        args = {
+            "possible_pairings_window": (t, 8),
+            "report_match": (t, id1, id2, None),
+        }
+        results = []
+        for name in sorted(tournament.Session.statements):
+            with tournament.session(t) as s:
+                row = _planStatement(s, name, args.get(name, (t,)), repeat)
+            row["players"] = size
+            results.append(row)
+        return results
+    finally:
+        tournament.deleteTournament(t)
+
+
+def _planStatement(s, name, args, repeat):
+    """Time one of the prepared statements both ways, see
+    benchmarkPlanning().
+    """
+    sql = re.sub(r"\$(\d+)", r"%(\1)s", s.statements[name]) + ";"
+    plain_args = dict((str(i + 1), arg) for (i, arg) in enumerate(args))
+    execute = "EXECUTE %s (%s);" % (name, ", ".join(["%s"] * len(args)))
+    times = {"plain_planning": [], "prepared_planning": [],
+             "plain_seconds": [], "prepared_seconds": []}
+
+    def run(key, sql, args):
+        s._execute("SAVEPOINT benchmark;")
+        plan = s._execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql,
+                          args).fetchone()[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        times[key + "_planning"].append(plan[0]["Planning Time"] / 1000.0)
+        s._execute("ROLLBACK TO SAVEPOINT benchmark;")
+        started = time.time()
+        s._execute(sql, args)
+        times[key + "_seconds"].append(time.time() - started)
+        s._execute("ROLLBACK TO SAVEPOINT benchmark;")
+        s._execute("RELEASE SAVEPOINT benchmark;")
+
+    # Prepare the statement, as the first call on a connection does.
+    s._execute("SAVEPOINT benchmark;")
+    s._executePrepared(name, args)
+    s._execute("ROLLBACK TO SAVEPOINT benchmark;")
+    s._execute("RELEASE SAVEPOINT benchmark;")
+    for x in range(repeat):
+        run("plain", sql, plain_args)
+        run("prepared", execute, args)
+    row = {"statement": name}
+    for (key, values) in times.items():
+        row[key] = _median(values)
+    return row
+
+
+def seedResults(standings, played_pairs, pattern, rng):
+    """Returns a round of results for the pattern.
+
+    Players are paired in order, each with the next player they have not
+    played. The players are in rank order, or shuffled for the "random"
+    pattern. Players that cannot be paired sit the round out.
+    """
+    ids = [row[0] for row in standings]
+    had_bye = set(row[0] for row in standings if row[6] > 0)
+    if pattern == "random":
+        rng.shuffle(ids)
+
+    results = []
+    if len(ids) % 2 != 0:
+        byes = [id for id in ids if id not in had_bye] or ids
+        bye = byes[-1]
+        ids.remove(bye)
+        results.append((bye, bye, bye))
+    while ids:
+        id1 = ids.pop(0)
+        for (i, id2) in enumerate(ids):
+            if (min(id1, id2), max(id1, id2)) not in played_pairs:
+                del ids[i]
+                break
+        else:
+            continue
+        if pattern == "random":
+            winner = rng.choice((id1, id2, None))
+        elif pattern == "draws":
+            winner = None
+        else:
+            winner = id1
+        results.append((id1, id2, winner))
+    return results
+
+
+def compare(old, new, threshold=1.2, min_seconds=0.001):
+    """Compare two benchmark results, as returned by benchmark().
+
+    Args:
+      old: the results to compare against.
+      new: the new results.
+      threshold: the ratio of the new time to the old time above which
+        a function has regressed.
+      min_seconds: differences in time smaller than this are ignored.
+
+    Returns:
+      A list of tuples, one for each function timed in both results,
+        each of which contains (key, old seconds, new seconds, regressed):
+        key: a (pattern, players, round, function) tuple
+        regressed: True if the function has slowed down
+    """
+    def index(results):
+        return dict(((row["pattern"], row["players"], row["round"],
+                      row["function"]), row["seconds"])
+                    for row in results["results"]
+                    if row["seconds"] is not None)
+    old_times = index(old)
+    new_times = index(new)
+    comparison = []
+    for key in sorted(set(old_times) & set(new_times)):
+        old_seconds = old_times[key]
+        new_seconds = new_times[key]
+        regressed = (new_seconds > old_seconds * threshold and
+                     new_seconds - old_seconds > min_seconds)
+        comparison.append((key, old_seconds, new_seconds, regressed))
+    return comparison
+
+
+def _median(values):
+    if not values:
+        return None
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _gitCommit():
+    """Returns the current git commit, or None if it cannot be found."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class _QueryCounter(object):
+    """Counts the SQL statements executed by PostgreSQL sessions,
+    and adds up the time spent in the outermost calls of tryPairing().
+
+    Wraps Session._execute() and tryPairing() until removed.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.searchSeconds = 0.0
+        self.searchTimes = []
+        self._execute = tournament.Session._execute
+        self._tryPairing = tournament.tryPairing
+        self._depth = 0
+        counter = self
+
+        def _execute(session, sql, args=None):
+            counter.queries += 1
+            return counter._execute(session, sql, args)
+
+        def tryPairing(*args):
+            counter._depth += 1
+            started = time.time()
+            try:
+                return counter._tryPairing(*args)
+            finally:
+                counter._depth -= 1
+                if counter._depth == 0:
+                    counter.searchSeconds += time.time() - started
+
+        tournament.Session._execute = _execute
+        tournament.tryPairing = tryPairing
+
+    def remove(self):
+        """Put back the functions that were wrapped."""
+        tournament.Session._execute = self._execute
+        tournament.tryPairing = self._tryPairing
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the tournament standings and pairings.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES,
+                        help="the numbers of players")
+    parser.add_argument("--patterns", nargs="+", choices=PATTERNS,
+                        default=PATTERNS, help="the result patterns")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="the number of times each function is timed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-seconds", type=float, default=10.0,
+                        help="skip a function for larger sizes once it "
+                        "takes longer than this")
+    parser.add_argument("--backend", choices=("memory", "postgresql"))
+    parser.add_argument("--output", help="the file to write the results to")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two results files instead")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="the slow down that counts as a regression")
+    parser.add_argument("--planning", type=int, metavar="PLAYERS",
+                        help="compare the planning time of the prepared "
+                        "statements on a field of this size instead")
+    args = parser.parse_args()
+
+    if args.planning:
+        print "%-26s %12s %12s %12s %12s" % (
+            "statement", "plain plan", "prepared", "plain run", "prepared")
+        for row in benchmarkPlanning(args.planning, seed=args.seed):
+            print "%-26s %12.6f %12.6f %12.6f %12.6f" % (
+                row["statement"], row["plain_planning"],
+                row["prepared_planning"], row["plain_seconds"],
+                row["prepared_seconds"])
+        sys.exit(0)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        regressions = 0
+        for (key, old_seconds, new_seconds, regressed) in compare(
+                old, new, args.threshold):
+            regressions += regressed
+            print "%-12s %5d %3d %-34s %10.6f %10.6f %6.2fx%s" % (
+                key + (old_seconds, new_seconds,
+                       new_seconds / old_seconds if old_seconds else 0,
+                       "  REGRESSED" if regressed else ""))
+        print "%d regressions" % regressions
+        sys.exit(1 if regressions else 0)
+
+    results = benchmark(args.sizes, args.patterns, args.repeat, args.seed,
+                        args.max_seconds, args.backend)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
@@ -0,0 +1,573 @@
+#!/usr/bin/env python
+#
+# tournament_memory.py -- in-memory storage backend for tournament.py
+#
+
+from array import array
+import bisect
+import csv
+import logging
+import threading
+import tournament
+
+
+class MemoryBackend(object):
+    """Keeps the tournament data in memory, without a database.
+
+    Gives the same standings and pairings as the PostgreSQL backend, and is
+    much faster, so it suits dry runs, what-if pairings and simulations.
+    The data is lost when the process exits.
+
+        tournament.useBackend("memory")
+
+    Sessions on the backend take turns, each holding the backend's lock
+    until it ends. A session's changes are made as it goes, and undone if
+    it is rolled back.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.tournaments = {
+            tournament.DEFAULT_TOURNAMENT: MemoryTournament("Default")}
+        # Ids are never reused, like the database's serial ids.
+        self.next_tournament_id = tournament.DEFAULT_TOURNAMENT + 1
+        self.next_player_id = 1
+
+    def session(self, tournament=None, read_only=False, consistent=None):
+        """Returns a new MemorySession on the backend. There is only one
+        copy of the data, so reads and writes are not told apart.
+        """
+        return MemorySession(self, tournament)
+
+
+class MemoryTournament(object):
+    """The players and matches of one tournament, held in memory.
+
+    Each player has a slot, in order of registration, and each player's
+    totals are kept in compact arrays indexed by slot. The totals are kept
+    up to date as matches are added, in the same way as the player_stats
+    triggers keep the player stats table up to date.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        # The player id and name of each slot, and the slot of each id.
+        self.ids = array("i")
+        self.names = []
+        self.slots = {}
+        self.wins = array("i")
+        self.draws = array("i")
+        self.played = array("i")
+        self.byes = array("i")
+        self.opponent_wins = array("i")
+        # The slots of each player's opponents, once for each match played.
+        self.opponents = []
+        # The winner of each match, and the round it was recorded in,
+        # keyed by (player1, player2).
+        self.matches = {}
+        self.match_rounds = {}
+        # (lower id, higher id) tuples of the players that have played.
+        self.played_pairs = set()
+        # The round new matches are recorded in, and the standings as they
+        # were when each earlier round was closed, keyed by round.
+        self.current_round = 1
+        self.round_standings = {}
+
+    def withoutMatches(self):
+        """Returns a copy of the tournament with the same players
+        and no matches.
+        """
+        t = MemoryTournament(self.name)
+        for (id, name) in zip(self.ids, self.names):
+            t.addPlayer(id, name)
+        return t
+
+    def addPlayer(self, id, name):
+        """Add a player, with no results, in the next slot."""
+        self.slots[id] = len(self.ids)
+        self.ids.append(id)
+        self.names.append(name)
+        for totals in (self.wins, self.draws, self.played, self.byes,
+                       self.opponent_wins):
+            totals.append(0)
+        self.opponents.append(array("i"))
+
+    def removeLastPlayer(self):
+        """Remove the player in the last slot."""
+        del self.slots[self.ids.pop()]
+        self.names.pop()
+        for totals in (self.wins, self.draws, self.played, self.byes,
+                       self.opponent_wins):
+            totals.pop()
+        self.opponents.pop()
+
+    def rank(self, slot):
+        """Returns the rank of the player in a slot."""
+        return self.played[slot] - self.wins[slot] - self.draws[slot] / 2.0
+
+    def standings(self):
+        """Returns the standings, as playerStandings() does."""
+        order = sorted(
+            range(len(self.ids)),
+            key=lambda slot: (self.rank(slot), -self.opponent_wins[slot],
+                              self.ids[slot]))
+        return [(self.ids[slot], self.names[slot], self.wins[slot],
+                 self.draws[slot], self.opponent_wins[slot],
+                 self.played[slot], self.byes[slot], self.rank(slot))
+                for slot in order]
+
+    def addMatch(self, player1, player2, winner):
+        """Add a match result, checking it as the database would."""
+        for id in (player1, player2):
+            if id not in self.slots:
+                raise ValueError(
+                    "Player %s is not registered in the tournament" % (id,))
+        if winner is not None and winner not in (player1, player2):
+            raise ValueError(
+                "The winner %s did not play in the match" % (winner,))
+        if ((player1, player2) in self.matches or
+                (player2, player1) in self.matches):
+            raise ValueError(
+                "The match (%s, %s) has already been reported"
+                % (player1, player2))
+        self.matches[(player1, player2)] = winner
+        self.match_rounds[(player1, player2)] = self.current_round
+        if player1 != player2:
+            self.played_pairs.add((min(player1, player2),
+                                   max(player1, player2)))
+        self.applyMatch(player1, player2, winner, 1)
+
+    def removeLastMatch(self, player1, player2):
+        """Remove the most recently added match."""
+        winner = self.matches.pop((player1, player2))
+        del self.match_rounds[(player1, player2)]
+        self.played_pairs.discard((min(player1, player2),
+                                   max(player1, player2)))
+        self.applyMatch(player1, player2, winner, -1)
+
+    def applyMatch(self, player1, player2, winner, change):
+        """Add (change = 1) or remove (change = -1) the result of a match
+        from the player totals.
+
+        Follows the player_stats_apply_match() database function step by
+        step. A match can only be removed while it is the last one added.
+        """
+        a = self.slots[player1]
+        b = self.slots[player2]
+        w = self.slots[winner] if winner is not None else None
+
+        # Leave the match out of the winner's opponents below.
+        if change < 0 and a != b:
+            self.opponents[a].pop()
+            self.opponents[b].pop()
+
+        if change > 0 and a != b:
+            self.opponent_wins[a] += change * self.wins[b]
+            self.opponent_wins[b] += change * self.wins[a]
+
+        for slot in set((a, b)):
+            self.played[slot] += change
+            if w is None:
+                self.draws[slot] += change
+            elif w == slot:
+                self.wins[slot] += change
+            if a == b:
+                self.byes[slot] += change
+
+        if w is not None:
+            for slot in self.opponents[w]:
+                self.opponent_wins[slot] += change
+            if a != b:
+                self.opponent_wins[b if w == a else a] += change
+
+        if change < 0 and a != b:
+            self.opponent_wins[a] += change * self.wins[b]
+            self.opponent_wins[b] += change * self.wins[a]
+
+        if change > 0 and a != b:
+            self.opponents[a].append(b)
+            self.opponents[b].append(a)
+
+    def fullTotals(self):
+        """Recompute each player's totals from the match history, as the
+        standings_full view does.
+
+        Returns:
+          A list with a (wins, draws, played, byes, opponent_wins, rank)
+          tuple for each slot.
+        """
+        count = len(self.ids)
+        wins = [0] * count
+        draws = [0] * count
+        played = [0] * count
+        byes = [0] * count
+        opponent_wins = [0] * count
+        for ((player1, player2), winner) in self.matches.items():
+            for id in set((player1, player2)):
+                slot = self.slots[id]
+                played[slot] += 1
+                if winner is None:
+                    draws[slot] += 1
+                elif winner == id:
+                    wins[slot] += 1
+                if player1 == player2:
+                    byes[slot] += 1
+        for (player1, player2) in self.matches:
+            if player1 != player2:
+                a = self.slots[player1]
+                b = self.slots[player2]
+                opponent_wins[a] += wins[b]
+                opponent_wins[b] += wins[a]
+        return [(wins[slot], draws[slot], played[slot], byes[slot],
+                 opponent_wins[slot],
+                 played[slot] - wins[slot] - draws[slot] / 2.0)
+                for slot in range(count)]
+
+
+class MemorySession(tournament.BaseSession):
+    """A unit of work against a MemoryBackend.
+
+    Each change is recorded with a way to undo it, so that the session
+    can be rolled back.
+    """
+
+    def __init__(self, backend, tournament_id=None):
+        self.backend = backend
+        if tournament_id is None:
+            tournament_id = tournament.DEFAULT_TOURNAMENT
+        self.tournament = tournament_id
+        self._undo = []
+
+    def __enter__(self):
+        self.backend.lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return tournament.BaseSession.__exit__(
+                self, exc_type, exc_value, traceback)
+        finally:
+            self.backend.lock.release()
+
+    def commit(self):
+        """Keep the work done so far in the session."""
+        del self._undo[:]
+
+    def rollback(self):
+        """Undo the work done since the last commit."""
+        while self._undo:
+            self._undo.pop()()
+
+    def beginSnapshot(self):
+        """Other sessions wait for this one to end, so it always reads
+        from one snapshot.
+        """
+
+    def _data(self):
+        """Returns the session's tournament, or an empty one to read from
+        if there is no such tournament.
+        """
+        t = self.backend.tournaments.get(self.tournament)
+        if t is None:
+            return MemoryTournament(None)
+        return t
+
+    def _writable(self):
+        """Returns the session's tournament, to make changes to."""
+        t = self.backend.tournaments.get(self.tournament)
+        if t is None:
+            raise ValueError(
+                "Tournament %s does not exist" % (self.tournament,))
+        return t
+
+    def _replace(self, t):
+        """Swap the session's tournament for t, or remove it if t is None."""
+        tournaments = self.backend.tournaments
+        old = tournaments.pop(self.tournament, None)
+        if t is not None:
+            tournaments[self.tournament] = t
+
+        def undo():
+            tournaments.pop(self.tournament, None)
+            if old is not None:
+                tournaments[self.tournament] = old
+        self._undo.append(undo)
+
+    def createTournament(self, name):
+        """Adds a tournament, and returns its id."""
+        id = self.backend.next_tournament_id
+        self.backend.next_tournament_id += 1
+        self.backend.tournaments[id] = MemoryTournament(name)
+        self._undo.append(lambda: self.backend.tournaments.pop(id, None))
+        return id
+
+    def deleteTournament(self):
+        """Remove the tournament, and all its players and matches."""
+        self._replace(None)
+
+    def deleteMatches(self):
+        """Remove all the tournament's match records, and its rounds."""
+        t = self.backend.tournaments.get(self.tournament)
+        if t is not None and (t.matches or t.current_round != 1):
+            self._replace(t.withoutMatches())
+
+    def deletePlayers(self):
+        """Remove all the tournament's player records, and its rounds."""
+        t = self.backend.tournaments.get(self.tournament)
+        if t is None or (not t.ids and t.current_round == 1):
+            return
+        if t.matches:
+            raise ValueError(
+                "Players cannot be deleted while they have matches")
+        self._replace(MemoryTournament(t.name))
+
+    def countPlayers(self):
+        """Returns the number of players currently registered."""
+        return len(self._data().ids)
+
+    def countMatches(self):
+        """Returns the number of matches recorded, byes included."""
+        return len(self._data().matches)
+
+    def registerPlayer(self, name):
+        """Adds a player to the tournament, and returns the player's id."""
+        t = self._writable()
+        id = self.backend.next_player_id
+        self.backend.next_player_id += 1
+        t.addPlayer(id, name)
+        self._undo.append(t.removeLastPlayer)
+        return id
+
+    def registerPlayers(self, names):
+        """Adds a list of players to the tournament at once."""
+        return [self.registerPlayer(name) for name in names]
+
+    def playerStandings(self, as_of_round=None):
+        """Returns a list of the players and their win records, as they
+        were when the round as_of_round was closed, if given.
+        """
+        t = self._data()
+        if as_of_round is None:
+            return t.standings()
+        if as_of_round not in t.round_standings:
+            raise ValueError("Round %d has not been closed" % as_of_round)
+        return list(t.round_standings[as_of_round])
+
+    def matchResults(self, through_round=None):
+        """Returns a list of (player1, player2, winner) tuples of every
+        match recorded, byes included, or of the matches up to the end of
+        the round through_round, if given.
+        """
+        t = self._data()
+        return [(player1, player2, winner)
+                for ((player1, player2), winner) in t.matches.items()
+                if through_round is None or
+                t.match_rounds[(player1, player2)] <= through_round]
+
+    def currentRound(self):
+        """Returns the round that new matches are recorded in."""
+        return self._data().current_round
+
+    def closeRound(self):
+        """Snapshot the standings, and start the next round.
+        Returns the round that was closed.
+        """
+        t = self._writable()
+        round = t.current_round
+        t.round_standings[round] = t.standings()
+        t.current_round += 1
+
+        def undo():
+            del t.round_standings[round]
+            t.current_round -= 1
+        self._undo.append(undo)
+        return round
+
+    def iterStandings(self, after=None, limit=None, fetch_size=None):
+        """Yields the players and their win records, up to limit of them,
+        starting after the standings row after, if given.
+
+        The standings are already in memory, so fetch_size is ignored.
+        """
+        standings = self._data().standings()
+        start = 0
+        if after is not None:
+            key = (after[7], -after[4], after[0])
+            start = bisect.bisect_right(
+                [(row[7], -row[4], row[0]) for row in standings], key)
+        end = len(standings) if limit is None else start + limit
+        for row in standings[start:end]:
+            yield row
+
+    def reportMatch(self, player1, player2, winner=None):
+        """Records the outcome of a single match between two players."""
+        t = self._writable()
+        t.addMatch(player1, player2, winner)
+        self._undo.append(lambda: t.removeLastMatch(player1, player2))
+
+    def reportMatches(self, results):
+        """Records the outcomes of a round of matches.
+
+        Each result is checked before it is recorded, so a bad result is
+        simply left out.
+        """
+        rows = [tournament._matchRow(result) for result in results]
+        errors = []
+        for i, row in enumerate(rows):
+            try:
+                self.reportMatch(*row)
+            except ValueError as e:
+                errors.append((i, row, str(e)))
+        if errors:
+            logging.info("%d of %d match results could not be recorded",
+                         len(errors), len(rows))
+        return errors
+
+    def submitResult(self, player1, player2, winner=None):
+        """Records the outcome of a match, unless it is already recorded.
+        Returns True if it was recorded.
+        """
+        matches = self._data().matches
+        for pair in ((player1, player2), (player2, player1)):
+            if pair in matches:
+                if matches[pair] != winner:
+                    raise ValueError(
+                        "The match (%s, %s) has already been reported with "
+                        "a different result" % (player1, player2))
+                return False
+        self.reportMatch(player1, player2, winner)
+        return True
+
+    def lockPairing(self):
+        """Other sessions wait for this one to end, so no results can be
+        submitted while it pairs.
+        """
+
+    def checkPlayerStats(self):
+        """Compare the running player totals with a full recompute."""
+        t = self._data()
+        differences = []
+        for slot, expected in enumerate(t.fullTotals()):
+            actual = (t.wins[slot], t.draws[slot], t.played[slot],
+                      t.byes[slot], t.opponent_wins[slot], t.rank(slot))
+            if actual != expected:
+                differences.append((t.ids[slot], expected, actual))
+        return sorted(differences)
+
+    def rebuildPlayerStats(self):
+        """Recompute the running player totals from the match history."""
+        t = self._writable()
+        old = [array("i", totals) for totals in
+               (t.wins, t.draws, t.played, t.byes, t.opponent_wins)]
+        for slot, totals in enumerate(t.fullTotals()):
+            (t.wins[slot], t.draws[slot], t.played[slot], t.byes[slot],
+             t.opponent_wins[slot]) = totals[:5]
+
+        def undo():
+            (t.wins, t.draws, t.played, t.byes, t.opponent_wins) = old
+        self._undo.append(undo)
+
+    def exportTournament(self, players, matches):
+        """Write the tournament's players and matches to two CSV files,
+        in the same format as the PostgreSQL backend.
+        """
+        t = self._data()
+        writer = csv.writer(players, lineterminator="\n")
+        writer.writerow(("id", "name"))
+        writer.writerows(sorted(zip(t.ids, t.names)))
+        writer = csv.writer(matches, lineterminator="\n")
+        writer.writerow(("player1", "player2", "winner", "round"))
+        writer.writerows(sorted(
+            ((player1, player2, winner, t.match_rounds[(player1, player2)])
+             for ((player1, player2), winner) in t.matches.items()),
+            key=lambda row: (row[3], row[0], row[1])))
+
+    def importTournament(self, players, matches, current_round=None):
+        """Read players and matches, written by exportTournament(), into
+        the tournament, which must have no players.
+
+        The matches are replayed round by round, and the standings of
+        each round before the current one are kept as it ends.
+        """
+        t = self._writable()
+        if t.ids:
+            raise ValueError("Tournament %s already has players"
+                             % (self.tournament,))
+        if current_round is not None and current_round < 1:
+            raise ValueError("The current round must be at least 1")
+        reader = csv.reader(players)
+        next(reader)
+        player_rows = sorted((int(id), name) for (id, name) in reader)
+        reader = csv.reader(matches)
+        next(reader)
+        match_rows = [
+            (int(player1), int(player2), int(winner) if winner else None,
+             int(round) if round else None)
+            for (player1, player2, winner, round) in reader]
+
+        old_ids = set(id for (id, name) in player_rows)
+        for row in match_rows:
+            (player1, player2, winner, round) = row
+            if (player1 not in old_ids or player2 not in old_ids or
+                    winner not in (None, player1, player2) or
+                    round is None or round < 1):
+                raise ValueError("The match %r has an unknown player, a "
+                                 "winner that did not play, or no round"
+                                 % (row,))
+        if current_round is None:
+            current_round = max([row[3] for row in match_rows] or [1])
+
+        new = MemoryTournament(t.name)
+        new_ids = {}
+        for (id, name) in player_rows:
+            new_ids[id] = self.backend.next_player_id
+            self.backend.next_player_id += 1
+            new.addPlayer(new_ids[id], name)
+        by_round = {}
+        for (player1, player2, winner, round) in match_rows:
+            by_round.setdefault(round, []).append((
+                new_ids[player1], new_ids[player2],
+                None if winner is None else new_ids[winner]))
+        for round in range(1, max([current_round] + list(by_round)) + 1):
+            new.current_round = round
+            for (player1, player2, winner) in by_round.get(round, []):
+                new.addMatch(player1, player2, winner)
+            if round < current_round:
+                new.round_standings[round] = new.standings()
+        new.current_round = current_round
+        self._replace(new)
+        return (len(player_rows), len(match_rows))
+
+    def possibleByePlayers(self):
+        """Get the list of players that have not had a bye."""
+        return [(row[0], row[1]) for row in self.rankedStandings()
+                if row[6] == 0]
+
+    def possiblePairings(self, window=None):
+        """Get the list of possible pairings for a round, of players at
+        most window places apart in the standings, if given.
+        """
+        t = self._data()
+        names = dict(zip(t.ids, t.names))
+        return [(id1, names[id1], id2, names[id2])
+                for (id1, name1, id2, name2) in
+                tournament.possiblePairingsFromStandings(
+                    self.rankedStandings(), t.played_pairs, window)]
+
+    def playedPairs(self):
+        """Get the set of pairs of players that have already played."""
+        return set(self._data().played_pairs)
+
+    def matchWinners(self, pairs):
+        """Returns a dictionary of the winners of the given pairs of players
+        that have played, keyed by (lower id, higher id).
+        """
+        pairs = set(pairs)
+        winners = {}
+        for ((player1, player2), winner) in self._data().matches.items():
+            pair = (min(player1, player2), max(player1, player2))
+            if pair in pairs:
+                winners[pair] = winner
+        return winners
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+#
+# tournament_sim.py -- play many simulated tournaments across a process pool
+#
+
+import argparse
+import logging
+import multiprocessing
+import random
+import sys
+import time
+import traceback
+import tournament
+import tournament_test
+
+
+def runSimulations(count, processes=None, seed=0, player_count=None,
+                   engine=None, backend="memory"):
+    """Simulate many random tournaments at once, to fuzz the pairing rules.
+
+    The tournaments are spread across a pool of worker processes. Each
+    tournament is played in a tournament of its own, so the workers cannot
+    see each other's players and matches. With the "memory" backend each
+    worker also has its own in-memory store.
+
+    Each tournament is played by tournament_test.simTournament(), with a
+    random.Random seeded from seed plus the tournament's index, so any
+    failure can be replayed with runSimulation().
+
+    Args:
+      count: the number of tournaments to play.
+      processes: the number of worker processes, defaults to the number
+        of CPUs.
+      seed: the seed of the first tournament.
+      player_count: the number of players in each tournament, or None for
+        a random number between 2 and 99.
+      engine: the pairing engine passed to swissPairings().
+      backend: the backend each worker uses, as passed to useBackend().
+
+    Returns:
+      A dictionary of the results, containing:
+        tournaments: the number of tournaments played
+        passed: the number of tournaments that passed every check
+        failures: a list of (seed, player_count, error) tuples, one for
+          each tournament that failed a check or raised an exception
+        seconds: the time taken to play all the tournaments
+        tournaments_per_second: the number of tournaments played per second
+    """
+    started = time.time()
+    pool = multiprocessing.Pool(processes, _startWorker, (backend,))
+    try:
+        jobs = [(seed + i, player_count, engine) for i in range(count)]
+        results = list(pool.imap_unordered(_runJob, jobs))
+    finally:
+        pool.close()
+        pool.join()
+    seconds = time.time() - started
+
+    failures = sorted((seed, players, error)
+                      for (seed, players, error) in results
+                      if error is not None)
+    return {
+        "tournaments": count,
+        "passed": count - len(failures),
+        "failures": failures,
+        "seconds": seconds,
+        "tournaments_per_second": count / seconds if seconds else None}
+
+
+def runSimulation(seed, player_count=None, engine=None):
+    """Simulate one random tournament, in a new tournament of its own.
+
+    Args:
+      seed: the seed for the tournament's player count and results.
+      player_count: the number of players, or None for a random number
+        between 2 and 99.
+      engine: the pairing engine passed to swissPairings().
+
+    Returns:
+      A tuple of (player_count, error), where error is None if the
+      tournament passed every check, and the reason it failed otherwise.
+    """
+    rng = random.Random(seed)
+    if player_count is None:
+        player_count = rng.randint(2, 99)
+    t = tournament.createTournament("Simulation %d" % seed)
+    try:
+        tournament_test.simTournament(player_count, engine, t, rng)
+        error = None
+    except ValueError as e:
+        # The simTournament() checks, and the pairing rules, raise
+        # ValueError when they fail.
+        error = str(e)
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        tournament.deleteTournament(t)
+    return player_count, error
+
+
+def runSubmissions(player_count=64, rounds=3, copies=3, processes=None,
+                   seed=0, speculative=False):
+    """Submit every result of some rounds many times over, from a pool of
+    worker processes at once, to check that submitResult() records each
+    result exactly once under contention.
+
+    Each result of a round is submitted copies times, with the players in
+    a random order each time, mixed in with pairings of the tournament,
+    and the submissions are shared out among the workers. The database
+    is used, since the workers have to share the tournament.
+
+    Args:
+      player_count: the number of players.
+      rounds: the number of rounds to play.
+      copies: the number of times each result is submitted.
+      processes: the number of worker processes, defaults to the number
+        of CPUs.
+      seed: the seed for the results, and the order they are submitted in.
+      speculative: whether the workers pair the tournament through
+        speculative pairing, see enableSpeculativePairing().
+
+    Returns:
+      A dictionary of the results, containing:
+        submissions: the number of results submitted
+        results: the number of different results
+        recorded: the number of submissions that recorded a result
+        lost: the number of results not recorded, or recorded wrongly
+        errors: a list of the errors raised by the submissions
+        stats_differences: the players whose stats do not agree with the
+          match history, as returned by checkPlayerStats()
+        seconds: the time taken to submit the results
+        submissions_per_second: the number of results submitted per second
+    """
+    rng = random.Random(seed)
+    t = tournament.createTournament("Submissions %d" % seed)
+    pool = multiprocessing.Pool(processes, _startWorker,
+                                ("postgresql", speculative))
+    counts = {"submissions": 0, "results": 0, "recorded": 0, "lost": 0}
+    errors = []
+    seconds = 0.0
+    try:
+        tournament.registerPlayers(
+            ["Player%d" % x for x in range(1, player_count + 1)], t)
+        for round in range(rounds):
+            results = [(id1, id2, id1 if id1 == id2 else
+                        rng.choice((id1, id2, None)))
+                       for (id1, name1, id2, name2)
+                       in tournament.swissPairings(tournament=t)]
+            jobs = [(t, (id2, id1, winner) if rng.random() < 0.5
+                     else (id1, id2, winner))
+                    for (id1, id2, winner) in results
+                    for copy in range(copies)]
+            # Pairings read the standings while the results come in.
+            jobs.extend((t, None) for copy in range(copies))
+            rng.shuffle(jobs)
+
+            started = time.time()
+            outcomes = pool.map(_submitJob, jobs)
+            seconds += time.time() - started
+
+            counts["submissions"] += len(jobs) - copies
+            counts["results"] += len(results)
+            counts["recorded"] += outcomes.count(True)
+            errors.extend(outcome for outcome in outcomes
+                          if outcome not in (True, False, None))
+            expected = dict(((min(id1, id2), max(id1, id2)), winner)
+                            for (id1, id2, winner) in results)
+            with tournament.session(t) as s:
+                winners = s.matchWinners(list(expected))
+            counts["lost"] += sum(
+                1 for (pair, winner) in expected.items()
+                if pair not in winners or winners[pair] != winner)
+            tournament.closeRound(t)
+        stats_differences = tournament.checkPlayerStats(t)
+    finally:
+        pool.close()
+        pool.join()
+        tournament.deleteTournament(t)
+
+    counts.update(
+        errors=errors,
+        stats_differences=stats_differences,
+        seconds=seconds,
+        submissions_per_second=(
+            counts["submissions"] / seconds if seconds else None))
+    return counts
+
+
+def _submitJob(job):
+    """Submits one result, or pairs the tournament if the result is None,
+    in a worker process.
+
+    Returns:
+      What submitResult() returns, None for a pairing, or the error raised.
+    """
+    (t, result) = job
+    try:
+        if result is None:
+            try:
+                tournament.swissPairings(tournament=t)
+            except ValueError:
+                # Part way through a round, there may be no way to pair
+                # every player.
+                pass
+            return None
+        return tournament.submitResult(*result, tournament=t)
+    except Exception:
+        return traceback.format_exc()
+
+
+def _startWorker(backend, speculative=False):
+    """Set up a worker process with a backend of its own."""
+    logging.getLogger().setLevel(logging.WARNING)
+    tournament.useBackend(backend)
+    if speculative:
+        tournament.enableSpeculativePairing()
+
+
+def _runJob(job):
+    """Runs one tournament in a worker process."""
+    (seed, player_count, engine) = job
+    player_count, error = runSimulation(seed, player_count, engine)
+    return seed, player_count, error
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Simulate random tournaments across a process pool.")
+    parser.add_argument("count", type=int,
+                        help="the number of tournaments to play")
+    parser.add_argument("--processes", type=int,
+                        help="the number of worker processes")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="the seed of the first tournament")
+    parser.add_argument("--players", type=int,
+                        help="the number of players in each tournament")
+    parser.add_argument("--engine", choices=("backtrack", "matching"))
+    parser.add_argument("--backend", choices=("memory", "postgresql"),
+                        default="memory")
+    parser.add_argument("--submissions", action="store_true",
+                        help="instead, submit count rounds of results many "
+                        "times over to the database, from every process")
+    parser.add_argument("--speculative", action="store_true",
+                        help="with --submissions, pair the tournament "
+                        "through speculative pairing in every process")
+    args = parser.parse_args()
+
+    if args.submissions:
+        results = runSubmissions(args.players or 64, args.count, 3,
+                                 args.processes, args.seed,
+                                 args.speculative)
+        for error in results["errors"]:
+            print error
+        print ("%d of %d results recorded once each, %d lost, from %d "
+               "submissions in %.1f seconds, %.1f per second" % (
+                   results["recorded"], results["results"], results["lost"],
+                   results["submissions"], results["seconds"],
+                   results["submissions_per_second"]))
+        sys.exit(1 if results["lost"] or results["errors"] or
+                 results["recorded"] != results["results"] or
+                 results["stats_differences"] else 0)
+
+    results = runSimulations(args.count, args.processes, args.seed,
+                             args.players, args.engine, args.backend)
+    for (seed, player_count, error) in results["failures"]:
+        print "Seed %d with %d players failed: %s" % (
+            seed, player_count, error)
+    print "%d of %d tournaments passed in %.1f seconds, %.1f per second" % (
+        results["passed"], results["tournaments"], results["seconds"],
+        results["tournaments_per_second"])
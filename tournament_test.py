@@ -5,7 +5,12 @@
 
 import logging
 import math
-from random import randint
+import random
+from StringIO import StringIO
+import threading
+import time
+import tournament
+import tournament_tiebreaks
 from tournament import *
 
 
@@ -188,7 +193,761 @@ def testOpponentWins():
            "has a win or an opponent win.")
 
 
-def simTournament(player_count=None):
+def testReportMatchesBatch():
+    deleteMatches()
+    deletePlayers()
+    registerPlayer("Kirk")
+    registerPlayer("Spock")
+    registerPlayer("McCoy")
+    registerPlayer("Scotty")
+    registerPlayer("Uhura")
+    standings = playerStandings()
+    [id1, id2, id3, id4, id5] = [row[0] for row in standings]
+    errors = reportMatches([(id1, id2, id1), (id3, id4), (id5, id5, id5)])
+    if errors:
+        raise ValueError("A valid round of results should all be recorded.")
+    errors = reportMatches(
+        [(id1, id3, id3), (id1, id2, id2), (id2, id5, id2), (id4, id4, id4)])
+    if len(errors) != 1 or errors[0][0] != 1:
+        raise ValueError(
+            "reportMatches should return the result that was a rematch.")
+    standings = playerStandings()
+    for (i, n, w, d, o, m, b, r) in standings:
+        if m != 2:
+            raise ValueError("Each player should have two matches recorded.")
+        if i == id4 and (b != 1 or d != 1):
+            raise ValueError("Byes and draws should be recorded in a batch.")
+    print ("12. A round of results can be reported at once, and bad results "
+           "are returned without losing the rest.")
+
+
+def testRegisterPlayers():
+    deleteMatches()
+    deletePlayers()
+    names = ["Player%d" % x for x in range(1, 11)]
+    ids = registerPlayers(names)
+    if len(ids) != len(names):
+        raise ValueError("registerPlayers should return an id for each name.")
+    registered = dict((row[0], row[1]) for row in playerStandings())
+    if [registered.get(i) for i in ids] != names:
+        raise ValueError(
+            "registerPlayers should return the ids in the order of the names.")
+    if registerPlayer("Player11") in ids:
+        raise ValueError("registerPlayer should return a new unique id.")
+    print ("13. A list of players can be registered at once, "
+           "returning their ids in order.")
+
+
+def testPlayerStats():
+    deleteMatches()
+    deletePlayers()
+    registerPlayers(["Player%d" % x for x in range(1, 8)])
+    for x in range(3):
+        simRound()
+    if checkPlayerStats():
+        raise ValueError(
+            "Player stats should agree with the full standings recompute.")
+    deleteMatches()
+    if checkPlayerStats():
+        raise ValueError(
+            "Player stats should agree with the full standings recompute "
+            "after matches are deleted.")
+    for (i, n, w, d, o, m, b, r) in playerStandings():
+        if w or d or o or m or b or r:
+            raise ValueError("After deleting, player stats should be zero.")
+    print ("14. Player stats are kept up to date as matches are reported "
+           "and deleted.")
+
+
+def testPairingCandidates():
+    deleteMatches()
+    deletePlayers()
+    registerPlayers(["Player%d" % x for x in range(1, 12)])
+    for x in range(3):
+        simRound()
+        if swissPairings(candidates="memory") != swissPairings(
+                candidates="view"):
+            raise ValueError(
+                "Pairings worked out in memory should match the pairings "
+                "from the possible_pairings view.")
+    print ("15. Pairings worked out in memory match the pairings from "
+           "the database view.")
+
+
+def testMatchingEngine():
+    deleteMatches()
+    deletePlayers()
+    registerPlayers(["Player%d" % x for x in range(1, 10)])
+    for x in range(4):
+        pairings = swissPairings(engine="matching")
+        for (id1, name1, id2, name2) in pairings:
+            if id1 != id2 and (min(id1, id2), max(id1, id2)) in playedPairs():
+                raise ValueError("The matching engine should not rematch.")
+        if len(set(p[0] for p in pairings) | set(p[2] for p in pairings)) != 9:
+            raise ValueError("The matching engine should pair every player.")
+        simRound(engine="matching")
+    for (i, n, w, d, o, m, b, r) in playerStandings():
+        if b > 1:
+            raise ValueError("A player should not have more than 1 bye.")
+    simTournament(33, engine="matching")
+    print ("16. The matching engine pairs every player, without rematches "
+           "or second byes.")
+
+
+def testSpeculativePairing():
+    deleteMatches()
+    deletePlayers()
+    registerPlayers(["Player%d" % x for x in range(1, 10)])
+    simRound()
+    enableSpeculativePairing(max_outstanding=2)
+    try:
+        pairings = swissPairings()
+        for (id1, name1, id2, name2) in pairings:
+            reportMatch(id1, id2, id1)
+            tournament._speculator.settle()
+        speculative = swissPairings()
+        if tournament._speculator.hits != 1:
+            raise ValueError(
+                "swissPairings should use the pairings worked out while "
+                "the results came in.")
+        with session() as s:
+            if speculative != s.swissPairings():
+                raise ValueError("Speculative pairings should match the "
+                                 "pairings worked out after the round.")
+
+        # Change the earlier results behind the speculation's back, with
+        # the same number of matches.
+        pairings = swissPairings()
+        for (id1, name1, id2, name2) in pairings[:-1]:
+            reportMatch(id1, id2, id1)
+            tournament._speculator.settle()
+        (id1, name1, id2, name2) = pairings[-1]
+        with session() as s:
+            results = [(p1, p2, p1 if w == p2 else p2 if w == p1 else w)
+                       for (p1, p2, w) in s.matchResults()]
+            s.deleteMatches()
+            s.reportMatches(results + [(id1, id2, id1)])
+            expected = s.swissPairings()
+        if swissPairings() != expected:
+            raise ValueError("Speculative pairings should not be used once "
+                             "the results they were worked out from change.")
+        if tournament._speculator.hits != 1:
+            raise ValueError("A speculation should only be used if the "
+                             "results it was worked out from still hold.")
+    finally:
+        disableSpeculativePairing()
+    print ("17. The next round can be paired while the results of the "
+           "round come in.")
+
+
+def testTournaments():
+    deleteMatches()
+    deletePlayers()
+    t1 = createTournament("Tournament 1")
+    t2 = createTournament("Tournament 2")
+    try:
+        [a1, a2] = registerPlayers(["Kirk", "Spock"], tournament=t1)
+        [b1, b2, b3, b4] = registerPlayers(
+            ["McCoy", "Scotty", "Uhura", "Sulu"], tournament=t2)
+        if countPlayers(t1) != 2 or countPlayers(t2) != 4 or countPlayers():
+            raise ValueError(
+                "Each tournament should only count its own players.")
+        reportMatch(a1, a2, a1, tournament=t1)
+        reportMatches([(b1, b2, b1), (b3, b4, b3)], tournament=t2)
+        pairings = swissPairings(tournament=t2)
+        ids = set(p[0] for p in pairings) | set(p[2] for p in pairings)
+        if ids != set([b1, b2, b3, b4]):
+            raise ValueError(
+                "A tournament should only pair its own players.")
+        deleteMatches(t2)
+        if [row[2] for row in playerStandings(t1)] != [1, 0]:
+            raise ValueError(
+                "Deleting one tournament's matches should not affect "
+                "another tournament.")
+        try:
+            reportMatch(a1, b1, a1, tournament=t1)
+        except Exception:
+            pass
+        else:
+            raise ValueError(
+                "Players from different tournaments should not be matched.")
+    finally:
+        deleteTournament(t1)
+        deleteTournament(t2)
+    print ("18. Several tournaments can be run at once, "
+           "without affecting each other.")
+
+
+def planNodes(plan):
+    """Generate the nodes of a query plan, from standingsPlan()."""
+    yield plan
+    for child in plan.get("Plans", []):
+        for node in planNodes(child):
+            yield node
+
+
+def testStandingsPlanScales():
+    tournaments = []
+    costs = []
+    try:
+        for player_count in (50, 200):
+            t = createTournament("Plan %d" % player_count)
+            tournaments.append(t)
+            ids = registerPlayers(
+                ["Player%d" % x for x in range(player_count)], tournament=t)
+            reportMatches(
+                [(ids[i], ids[(i + r) % player_count], ids[i])
+                 for r in range(1, 5) for i in range(player_count)],
+                tournament=t)
+        for t in tournaments:
+            plan = standingsPlan(t, analyze=True)
+            for node in planNodes(plan):
+                if " OR " in node.get("Join Filter", ""):
+                    raise ValueError(
+                        "The standings should not be computed with OR joins.")
+            costs.append(plan["Total Cost"])
+    finally:
+        for t in tournaments:
+            deleteTournament(t)
+    if costs[1] > costs[0] * 8:
+        raise ValueError(
+            "The cost of the standings should grow in line with the number "
+            "of matches, but grew from %s to %s for 4 times the matches."
+            % (costs[0], costs[1]))
+    print ("19. The cost of recomputing the standings grows in line with "
+           "the number of matches.")
+
+
+def testMetrics():
+    deleteMatches()
+    deletePlayers()
+    if getStats() is not None:
+        raise ValueError("Metrics should be off until they are enabled.")
+    enableMetrics()
+    try:
+        registerPlayers(["Player%d" % x for x in range(1, 8)])
+        simRound("backtrack")
+        stats = getStats()
+    finally:
+        disableMetrics()
+    for name in ("registerPlayers", "swissPairings", "reportMatches"):
+        if stats["functions"].get(name, {}).get("count") != 1:
+            raise ValueError("Each call to %s should be timed." % name)
+    if tournament.BACKEND == "postgresql" and not stats["queries"]:
+        raise ValueError("The SQL statements should be timed.")
+    pairing = stats["pairing"]
+    if pairing["searches"] != 1 or pairing["max_depth"] != 4:
+        raise ValueError(
+            "The pairing search should be counted, and hold 3 pairs "
+            "and a bye at most.")
+    if pairing["nodes"] - pairing["backtracks"] != 3:
+        raise ValueError(
+            "Every pair the search adds, less the pairs it removes again, "
+            "should be in the round.")
+    if getStats() is not None:
+        raise ValueError("Metrics should be off once they are disabled.")
+    print "20. Function, query and pairing search metrics are recorded."
+
+
+def testStandingsCache():
+    deleteMatches()
+    deletePlayers()
+    [id1, id2, id3, id4] = registerPlayers(["Kirk", "Spock", "McCoy", "Scotty"])
+    enableStandingsCache()
+    try:
+        cache = tournament._cache
+        playerStandings()
+        standings = playerStandings()
+        if cache.hits != 1:
+            raise ValueError(
+                "Reading the standings again should be served from the cache.")
+        reportMatch(id1, id2, id1)
+        if playerStandings() == standings:
+            raise ValueError("Reporting a match should update the standings.")
+        # Write from another connection, as another process would.
+        conn = connect()
+        c = conn.cursor()
+        c.execute("INSERT INTO matches (player1, player2, winner) "
+                  "VALUES (%s, %s, %s);", (id3, id4, id4))
+        conn.commit()
+        conn.close()
+        if [row[0] for row in playerStandings()[:2]] != [id1, id4]:
+            raise ValueError(
+                "Results reported by another process should update "
+                "the cached standings.")
+        hits = cache.hits
+        swissPairings()
+        swissPairings(candidates="view")
+        swissPairings(candidates="view")
+        # The standings are read from the cache each time,
+        # and the possible pairings the second time.
+        if cache.hits != hits + 4:
+            raise ValueError(
+                "Pairing a round again should read the standings and "
+                "possible pairings from the cache.")
+    finally:
+        disableStandingsCache()
+    print "21. Standings are cached until the tournament changes."
+
+
+def testPairingWindow():
+    deleteMatches()
+    deletePlayers()
+    registerPlayers(["Player%d" % x for x in range(1, 18)])
+    for x in range(4):
+        standings = playerStandings()
+        position = dict((row[0], i) for (i, row) in enumerate(standings))
+        if possiblePairings(window=2) != [
+                p for p in possiblePairings()
+                if abs(position[p[0]] - position[p[2]]) <= 2]:
+            raise ValueError(
+                "The possible pairings within a window should be the "
+                "possible pairings of players that many places apart.")
+        for engine in ("backtrack", "matching"):
+            pairings = swissPairings(engine=engine)
+            window = max(abs(position[id1] - position[id2])
+                         for (id1, name1, id2, name2) in pairings) or 1
+            for candidates in ("memory", "view"):
+                if swissPairings(candidates, engine,
+                                 window=window) != pairings:
+                    raise ValueError(
+                        "Pairings within a window wide enough for them "
+                        "should match the pairings from every possible "
+                        "pairing.")
+                narrow = swissPairings(candidates, engine, window=1)
+                if len(set(p[0] for p in narrow) |
+                       set(p[2] for p in narrow)) != 17:
+                    raise ValueError(
+                        "The window should widen until every player "
+                        "can be paired.")
+        simRound()
+    # Odd fields where the lowest ranked possible bye player can only be
+    # paired outside the window: the bye must not pass to someone else.
+    for (engine, window, played, byes) in (
+            ("backtrack", 1, set(), set([5])),
+            ("matching", 1, set([(1, 5), (3, 4)]), set([2, 3])),
+            ("backtrack", 2, set([(1, 3), (2, 4), (2, 5), (3, 4)]),
+             set([1, 2, 4]))):
+        standings = [(x, "Player%d" % x, 0, 0, 0, 0, int(x in byes), 0)
+                     for x in range(1, 6)]
+        bye = [p[0] for p in pairStandings(standings, played, engine)
+               if p[0] == p[2]]
+        if [p[0] for p in pairStandings(standings, played, engine, window)
+                if p[0] == p[2]] != bye:
+            raise ValueError(
+                "The bye within a window should go to the same player as "
+                "without one.")
+    print ("22. Pairing within a window of the standings widens until "
+           "every player is paired.")
+
+
+def testStandingsPages():
+    deleteMatches()
+    deletePlayers()
+    registerPlayers(["Player%d" % x for x in range(1, 26)])
+    simRound()
+    simRound()
+    standings = playerStandings()
+    if list(iterStandings(fetch_size=4)) != standings:
+        raise ValueError(
+            "Streamed standings should match the standings.")
+    rows = []
+    pages = 0
+    page = standingsPage(10)
+    while page:
+        pages += 1
+        rows.extend(page)
+        page = standingsPage(10, after=page[-1])
+    if rows != standings or pages != 3:
+        raise ValueError(
+            "Reading the standings a page at a time should give every "
+            "player once, in order.")
+    objects = list(iterStandings(row_class=StandingsRow))
+    if ([tuple(row) for row in objects] != standings or
+            objects[0].name != standings[0][1]):
+        raise ValueError(
+            "Standings rows should have the same fields as the tuples.")
+    rows = iterStandings()
+    next(rows)
+    rows.close()
+    if countPlayers() != 25:
+        raise ValueError(
+            "Closing a standings iterator early should end its session.")
+    print "23. Standings can be streamed, or read a page at a time."
+
+
+def testPreparedStatements():
+    deleteMatches()
+    deletePlayers()
+    [id1, id2, id3, id4] = registerPlayers(["Kirk", "Spock", "McCoy", "Scotty"])
+    with session() as s:
+        standings = s.playerStandings()
+        if "player_standings" not in s.conn.prepared:
+            raise ValueError("The standings query should be prepared.")
+        s.rollback()
+        # A prepared statement outlives the transaction that prepared it.
+        if s.playerStandings() != standings:
+            raise ValueError(
+                "The prepared standings query should be reused.")
+        s.reportMatch(id1, id2, id1)
+        s.reportMatch(id3, id4, None)
+    if playerStandings()[0][0] != id1 or len(playedPairs()) != 2:
+        raise ValueError("Prepared match inserts should be recorded.")
+    print "24. The hot statements are prepared once on each connection."
+
+
+def testRounds():
+    deleteMatches()
+    deletePlayers()
+    registerPlayers(["Player%d" % x for x in range(1, 9)])
+    if currentRound() != 1:
+        raise ValueError("A new tournament should start in round 1.")
+    simRound()
+    if closeRound() != 1 or currentRound() != 2:
+        raise ValueError("Closing round 1 should start round 2.")
+    after_one = playerStandings()
+    simRound()
+    closeRound()
+    simRound()
+    if playerStandings(as_of_round=1) != after_one:
+        raise ValueError(
+            "The standings as of a round should not change after it.")
+    if sum(row[5] for row in playerStandings(as_of_round=2)) != 16:
+        raise ValueError(
+            "The standings as of a round should count its matches.")
+    places = dict((row[0], place) for (place, row) in enumerate(after_one, 1))
+    for (place, row) in enumerate(roundDeltas(2), 1):
+        (id, name, new_place, previous_place) = row[:4]
+        if new_place != place or previous_place != places[id]:
+            raise ValueError(
+                "Round deltas should give each player's places.")
+        if row[7] != 1:
+            raise ValueError(
+                "Round deltas should count one match for each player.")
+    try:
+        playerStandings(as_of_round=3)
+        raise ValueError("Round 3 has not been closed.")
+    except ValueError as e:
+        if str(e) != "Round 3 has not been closed":
+            raise
+    deleteMatches()
+    if currentRound() != 1:
+        raise ValueError("Deleting the matches should delete the rounds.")
+    print "25. The standings are kept as of each closed round."
+
+
+def testTiebreaks():
+    deleteMatches()
+    deletePlayers()
+    (a, b, c, d) = registerPlayers(["Ann", "Bob", "Cat", "Dan"])
+    reportMatches([(a, b, a), (c, d)])
+    closeRound()
+    reportMatches([(a, c), (b, d, b)])
+    standings = playerStandings(tiebreaks=("sonneborn_berger",))
+    if [row[0] for row in standings] != [a, c, b, d]:
+        raise ValueError(
+            "Players of the same rank should be ordered by the tiebreaks.")
+    values = tournament_tiebreaks.computeTiebreaks(
+        standings, matchResults(),
+        ("buchholz", "sonneborn_berger", "opponents_opponents_score"))
+    if (list(values["buchholz"]) != [2, 2, 2, 2] or
+            list(values["sonneborn_berger"]) != [1.5, 1, 0.5, 0.5] or
+            list(values["opponents_opponents_score"]) != [4, 4, 4, 4]):
+        raise ValueError("The tiebreaks should count draws as half a win.")
+    if len(matchResults(through_round=1)) != 2:
+        raise ValueError(
+            "The results through a round should only count its matches.")
+
+    simTournament(37)
+    standings = playerStandings(tiebreaks=("opponent_wins",))
+    results = matchResults()
+    if tournament_tiebreaks.orderStandings(
+            standings, results, ("opponent_wins",)) != standings:
+        raise ValueError(
+            "Ordering by opponent wins should give the usual standings.")
+    numpy = tournament_tiebreaks.numpy
+    try:
+        with_numpy = tournament_tiebreaks.computeTiebreaks(standings, results)
+        tournament_tiebreaks.numpy = None
+        without_numpy = tournament_tiebreaks.computeTiebreaks(
+            standings, results)
+    finally:
+        tournament_tiebreaks.numpy = numpy
+    for name in tournament_tiebreaks.TIEBREAKS:
+        if list(with_numpy[name]) != list(without_numpy[name]):
+            raise ValueError(
+                "The %s tiebreak should not depend on NumPy." % name)
+
+    tiebreaks = tournament.TIEBREAKS
+    tournament.TIEBREAKS = ("buchholz", "sonneborn_berger")
+    try:
+        for engine in ("backtrack", "matching"):
+            if (swissPairings("memory", engine) !=
+                    swissPairings("view", engine)):
+                raise ValueError(
+                    "Both pairing candidates should follow the tiebreaks.")
+    finally:
+        tournament.TIEBREAKS = tiebreaks
+    print "26. Players of the same rank are ordered by a list of tiebreaks."
+
+
+def testImportExport():
+    deleteMatches()
+    deletePlayers()
+    registerPlayers(["Player%d" % x for x in range(1, 12)])
+    for x in range(3):
+        simRound()
+        closeRound()
+    simRound()
+    players, matches = StringIO(), StringIO()
+    exportTournament(players, matches)
+
+    t = createTournament("Imported")
+    try:
+        players.seek(0)
+        matches.seek(0)
+        if importTournament(players, matches, t) != (11, 24):
+            raise ValueError(
+                "Importing should return the number of players and matches.")
+        if currentRound(t) != currentRound():
+            raise ValueError("Importing should keep the current round.")
+
+        def byName(standings):
+            return sorted((row[1],) + tuple(row[2:]) for row in standings)
+        for round in (1, 2, 3, None):
+            if (byName(playerStandings(t, as_of_round=round)) !=
+                    byName(playerStandings(as_of_round=round))):
+                raise ValueError(
+                    "An imported tournament should have the same standings "
+                    "in each round.")
+        if checkPlayerStats(t):
+            raise ValueError(
+                "The player stats of an imported tournament should agree "
+                "with the match history.")
+
+        players.seek(0)
+        bad = StringIO(matches.getvalue() + "1,2,3,1\n")
+        try:
+            importTournament(players, bad, t)
+            raise ValueError("A tournament with players cannot be imported.")
+        except ValueError as e:
+            if "already has players" not in str(e):
+                raise
+        deleteMatches(t)
+        deletePlayers(t)
+        players.seek(0)
+        try:
+            importTournament(players, bad, t)
+            raise ValueError("A match of unknown players cannot be imported.")
+        except ValueError as e:
+            if "unknown player" not in str(e):
+                raise
+        if countPlayers(t) != 0:
+            raise ValueError("A failed import should leave no players.")
+    finally:
+        deleteTournament(t)
+    print "27. Tournaments can be exported and imported in bulk."
+
+
+def testSubmitResult():
+    deleteMatches()
+    deletePlayers()
+    (a, b, c, d) = registerPlayers(["Ann", "Bob", "Cat", "Dan"])
+    if not submitResult(a, b, a):
+        raise ValueError("A new result should be recorded.")
+    if submitResult(a, b, a) or submitResult(b, a, a):
+        raise ValueError(
+            "A result submitted again, either way round, should not be "
+            "recorded again.")
+    try:
+        submitResult(b, a, b)
+        raise ValueError("A different result for a match should fail.")
+    except ValueError as e:
+        if "different result" not in str(e):
+            raise
+    try:
+        reportMatch(b, a, b)
+        reported = True
+    except Exception:
+        # The database raises its own error for the duplicate.
+        reported = False
+    if reported:
+        raise ValueError("A match cannot be reported both ways round.")
+    if not submitResult(c, d) or submitResult(d, c):
+        raise ValueError("A draw should only be recorded once.")
+    standings = playerStandings()
+    if sum(row[5] for row in standings) != 4:
+        raise ValueError("Each submitted result should be recorded once.")
+    print "28. Results can be submitted more than once, in either order."
+
+
+def testConcurrentSubmissions():
+    # Results reported while the tournament is being paired wait for it.
+    deleteMatches()
+    deletePlayers()
+    [id1, id2, id3, id4] = registerPlayers(
+        ["Kirk", "Spock", "McCoy", "Uhura"])
+    writers = [threading.Thread(target=reportMatch, args=(id1, id2, id1)),
+               threading.Thread(target=reportMatches,
+                                args=([(id3, id4, id3)],))]
+    with session() as s:
+        s.lockPairing()
+        for writer in writers:
+            writer.start()
+        time.sleep(0.2)
+        if any(not writer.is_alive() for writer in writers):
+            raise ValueError("Reported results should wait while the "
+                             "tournament is being paired.")
+    for writer in writers:
+        writer.join(5)
+    with session() as s:
+        if s.countMatches() != 2:
+            raise ValueError(
+                "The results should be recorded once pairing ends.")
+
+    # A round is only closed once the results being written are committed.
+    closer = threading.Thread(target=closeRound)
+    with session() as s:
+        s.reportMatch(id1, id3, id1)
+        closer.start()
+        time.sleep(0.2)
+        if not closer.is_alive():
+            raise ValueError("Closing a round should wait for the results "
+                             "being written.")
+    closer.join(5)
+    with session() as s:
+        if len(s.matchResults(1)) != 3:
+            raise ValueError("A result written while the round was being "
+                             "closed should be in that round.")
+
+    # Results written at once to one tournament do not wait for each other.
+    writer = threading.Thread(target=reportMatch, args=(id2, id3, id2))
+    with session() as s:
+        s.reportMatch(id1, id4, id1)
+        writer.start()
+        writer.join(5)
+        if writer.is_alive():
+            raise ValueError("Results written at once to one tournament "
+                             "should not wait for each other.")
+
+    import tournament_sim
+    for speculative in (False, True):
+        results = tournament_sim.runSubmissions(
+            32, rounds=3, copies=4, processes=8, speculative=speculative)
+        if results["errors"]:
+            raise ValueError(results["errors"][0])
+        if results["lost"] or results["recorded"] != results["results"]:
+            raise ValueError(
+                "Each result submitted at once from many processes should "
+                "be recorded exactly once.")
+        if results["stats_differences"]:
+            raise ValueError(
+                "The player stats should agree with the submitted results.")
+        logging.info("%.1f submissions per second",
+                     results["submissions_per_second"])
+    print ("29. Results submitted at once from many processes are each "
+           "recorded once.")
+
+
+def testReadRouting():
+    deleteMatches()
+    deletePlayers()
+    # The tournament database stands in for a read database of its own.
+    # It is not a replica, so it has no replay position to wait for.
+    tournament.configure(read_dsn=tournament.DSN)
+    try:
+        registerPlayer("Kirk")
+        with session(read_only=True, consistent=False) as s:
+            if s.source is not tournament.getReadPool():
+                raise ValueError("Reads should go to the read database.")
+            if s.countPlayers() != 1:
+                raise ValueError("The read database should be read.")
+        with session(read_only=True) as s:
+            if s.source is not tournament.getPool():
+                raise ValueError(
+                    "Reads that must see this process's writes should go "
+                    "to the tournament database until the read database "
+                    "has caught up.")
+        if tournament.getReadPool().replica is not False:
+            raise ValueError("A read database that is not a replica should "
+                             "be noted as such.")
+        tournament.READ_WAIT, read_wait = 5, tournament.READ_WAIT
+        try:
+            started = time.time()
+            with session(read_only=True) as s:
+                s.countPlayers()
+            if time.time() - started >= 5:
+                raise ValueError("Reads should not wait for a read database "
+                                 "that is not a replica.")
+        finally:
+            tournament.READ_WAIT = read_wait
+        with session() as s:
+            if s.source is not tournament.getPool():
+                raise ValueError("Writes should go to the tournament "
+                                 "database.")
+        if countPlayers() != 1:
+            raise ValueError("Reads should see this process's writes.")
+    finally:
+        tournament.configure(read_dsn="")
+    print "30. Reads can be sent to a read database, and see earlier writes."
+
+
+def testConnectionPool():
+    pool = tournament.ConnectionPool(tournament.DSN, 1, 2, 0)
+    try:
+        # A connection that went bad while it was idle is replaced.
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.close()
+        time.sleep(0.01)
+        replacement = pool.getconn()
+        if replacement is conn or replacement.closed:
+            raise ValueError("A broken idle connection should be replaced "
+                             "before it is handed out.")
+
+        # Taking a connection waits while every connection is in use.
+        second = pool.getconn()
+        taken = []
+        waiter = threading.Thread(target=lambda: taken.append(pool.getconn()))
+        waiter.start()
+        waiter.join(0.2)
+        if taken:
+            raise ValueError("Taking a connection should block while all "
+                             "of the pool's connections are in use.")
+        pool.putconn(second)
+        waiter.join(5)
+        if not taken:
+            raise ValueError("A blocked caller should get the connection "
+                             "that is returned.")
+        pool.putconn(taken[0])
+
+        # A retired pool closes once its last connection is returned.
+        pool.retire()
+        if replacement.closed:
+            raise ValueError("Retiring a pool should not close the "
+                             "connections still in use.")
+        pool.putconn(replacement)
+        if not replacement.closed or not pool._pool.closed:
+            raise ValueError("A retired pool should close once its last "
+                             "connection is returned.")
+    finally:
+        if not pool._pool.closed:
+            pool.closeall()
+
+    # Changing the settings does not break the sessions already open.
+    old = tournament.getPool()
+    with session() as s:
+        tournament.configure()
+        if tournament.getPool() is old:
+            raise ValueError("configure() should replace the pool.")
+        s.countPlayers()
+    if not old._pool.closed:
+        raise ValueError("The old pool should close once its sessions end.")
+    print ("31. Pooled connections are checked before reuse, and a pool is "
+           "only closed once its connections are returned.")
+
+
+def simTournament(player_count=None, engine=None, tournament=None, rng=None):
     """Simulate playing a complete tournament of log2(player count) rounds.
 
     Args:
@@ -196,34 +955,41 @@ def simTournament(player_count=None):
         2 to 999 starts a tournament with that number of players.
         None starts a tournament with a random number of players
         between 2 and 99
+        engine: the pairing engine passed to swissPairings().
+        tournament: the id of the tournament to play in, defaults to
+        DEFAULT_TOURNAMENT. Its players and matches are deleted first.
+        rng: the random.Random used for the player count and results,
+        so that a tournament can be replayed from a seed.
+        Defaults to the random module.
     """
+    if rng is None:
+        rng = random
     if player_count is None:
-        player_count = randint(2, 99)
+        player_count = rng.randint(2, 99)
 
     if player_count < 2 or player_count > 999:
         raise ValueError("Player count should be between 2 and 999")
 
     logging.info("Simulating a tournament with %s players..." % player_count)
 
-    deleteMatches()
-    deletePlayers()
+    deleteMatches(tournament)
+    deletePlayers(tournament)
 
     # Create a list of player names whose length equals player_count
     players = ["Player{0:03d}".format(x) for x in range(1, player_count+1)]
 
-    for player in players:
-        registerPlayer(player)
+    registerPlayers(players, tournament)
 
     # play log2(player count) rounds
     rounds = int(math.ceil(math.log(len(players), 2)))
 
     for x in range(rounds):
         logging.info("Playing round %d" % (x+1,))
-        simRound()
+        simRound(engine, tournament, rng)
 
     total_byes = 0
 
-    standings = playerStandings()
+    standings = playerStandings(tournament)
     for i, (id, n, wins, draws, omw, matches, byes, r) in enumerate(standings):
         total_byes += byes
         if matches != rounds:
@@ -257,31 +1023,44 @@ def simTournament(player_count=None):
         logging.info("After %d rounds, tournament tied" % rounds)
 
 
-def simRound():
+def simRound(engine=None, tournament=None, rng=None):
     """Simulate playing a single round of a tournament,
         with random match results.
+
+    Args:
+        engine: the pairing engine passed to swissPairings().
+        tournament: the id of the tournament, defaults to DEFAULT_TOURNAMENT.
+        rng: the random.Random used for the results,
+        defaults to the random module.
     """
-    pairings = swissPairings()
+    if rng is None:
+        rng = random
+    pairings = swissPairings(engine=engine, tournament=tournament)
+    results = []
     for (id1, name1, id2, name2) in pairings:
         if id1 == id2:
             # bye, so just report it
-            reportMatch(id1, id2, id1)
+            results.append((id1, id2, id1))
             logging.debug("%s got a bye" % name1)
         else:
             # randomly select winner or draw
-            x = randint(0, 9)
+            x = rng.randint(0, 9)
             if x < 4:
                 # id1 wins
-                reportMatch(id1, id2, id1)
+                results.append((id1, id2, id1))
                 logging.debug("%s beats %s" % (name1, name2))
             elif x > 4:
                 # id2 wins
-                reportMatch(id1, id2, id2)
+                results.append((id1, id2, id2))
                 logging.debug("%s beats %s" % (name2, name1))
             else:
                 # draw
-                reportMatch(id1, id2)
+                results.append((id1, id2, None))
                 logging.debug("%s draws with %s" % (name1, name2))
+    # report the whole round at once
+    errors = reportMatches(results, tournament)
+    if errors:
+        raise ValueError("%d match results were not recorded" % len(errors))
 
 
 def simTournaments():
@@ -307,4 +1086,26 @@ if __name__ == '__main__':
     testByes()
     testDraws()
     testOpponentWins()
+    testReportMatchesBatch()
+    testRegisterPlayers()
+    testPlayerStats()
+    testPairingCandidates()
+    testMatchingEngine()
+    testSpeculativePairing()
+    testTournaments()
+    testPairingWindow()
+    testStandingsPages()
+    testRounds()
+    testTiebreaks()
+    testImportExport()
+    testSubmitResult()
+    if tournament.BACKEND == "postgresql":
+        # Only the database has query plans.
+        testStandingsPlanScales()
+        testStandingsCache()
+        testPreparedStatements()
+        testConcurrentSubmissions()
+        testReadRouting()
+        testConnectionPool()
+    testMetrics()
     print "Success!  All tests pass!"
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# tournament_tiebreaks.py -- tiebreaks for players with the same rank
+#
+
+try:
+    import numpy
+except ImportError:
+    # The tiebreaks are worked out in pure Python instead, which is
+    # fast enough for all but the largest fields.
+    numpy = None
+
+
+# The tiebreaks that can be used to order players with the same rank.
+# For each of them, a higher value is better.
+# "opponent_wins": the number of matches the player's opponents have won.
+# "wins": the number of matches the player has won, byes included.
+# "buchholz": the total score of the player's opponents, where a win
+#   scores 1 and a draw 1/2.
+# "median_buchholz": the Buchholz score without the highest and the
+#   lowest scoring opponent, for players with more than 2 opponents.
+# "sonneborn_berger": the total score of the opponents the player beat,
+#   and half the total score of the opponents the player drew with.
+# "opponents_opponents_score": the total Buchholz score of the player's
+#   opponents.
+TIEBREAKS = ("opponent_wins", "wins", "buchholz", "median_buchholz",
+             "sonneborn_berger", "opponents_opponents_score")
+
+
+def computeTiebreaks(standings, results, tiebreaks=TIEBREAKS):
+    """Work out tiebreak values for each player in the standings.
+
+    The results are loaded once into integer arrays of the players of
+    each match, as positions in the standings. Each match is an edge in
+    both directions of a sparse opponent graph, and each tiebreak is a
+    sum over the edges, so all of them are worked out with a few batched
+    sparse matrix-vector products, rather than player by player. NumPy is
+    used if it is installed.
+
+    Byes count towards a player's score, but a bye is not an opponent.
+
+    Args:
+      standings: the player standings, as returned by playerStandings().
+      results: a list of (player1, player2, winner) tuples of every match
+        the standings count, byes included.
+      tiebreaks: the names of the tiebreaks to work out, from TIEBREAKS.
+
+    Returns:
+      A dictionary of the values of each tiebreak, keyed by name, each of
+      which is a sequence of one value for each row of the standings.
+    """
+    for name in tiebreaks:
+        if name not in TIEBREAKS:
+            raise ValueError("Unknown tiebreak %r" % (name,))
+    if numpy is not None:
+        return _numpyTiebreaks(standings, results, tiebreaks)
+    return _pythonTiebreaks(standings, results, tiebreaks)
+
+
+def orderStandings(standings, results, tiebreaks=TIEBREAKS):
+    """Order the players with the same rank by a list of tiebreaks.
+
+    Players are sorted by rank, then by each tiebreak in turn, best
+    first, then by id, with a single sort over all the keys.
+
+    Args:
+      standings: the player standings, as returned by playerStandings().
+      results: a list of (player1, player2, winner) tuples of every match
+        the standings count, byes included.
+      tiebreaks: the names of the tiebreaks, from TIEBREAKS, most
+        important first.
+
+    Returns:
+      The rows of the standings in their new order.
+    """
+    values = computeTiebreaks(standings, results, tiebreaks)
+    if numpy is not None:
+        # lexsort sorts by the last key first.
+        keys = [numpy.array([row[0] for row in standings])]
+        keys.extend(-values[name] for name in reversed(tiebreaks))
+        keys.append(numpy.array([row[7] for row in standings]))
+        return [standings[i] for i in numpy.lexsort(keys)]
+    order = sorted(
+        range(len(standings)),
+        key=lambda i: ((standings[i][7],) +
+                       tuple(-values[name][i] for name in tiebreaks) +
+                       (standings[i][0],)))
+    return [standings[i] for i in order]
+
+
+def _numpyTiebreaks(standings, results, tiebreaks):
+    """computeTiebreaks() with NumPy arrays."""
+    n = len(standings)
+    ids = numpy.array([row[0] for row in standings], dtype=numpy.int64)
+    score = numpy.array([row[2] + row[3] / 2.0 for row in standings])
+    values = {
+        "opponent_wins": numpy.array([row[4] for row in standings],
+                                     dtype=float),
+        "wins": numpy.array([row[2] for row in standings], dtype=float),
+    }
+
+    # The players of each match, and the winner, with 0 for a draw.
+    matches = numpy.array(
+        [(p1, p2, 0 if w is None else w) for (p1, p2, w) in results],
+        dtype=numpy.int64).reshape(-1, 3)
+    matches = matches[matches[:, 0] != matches[:, 1]]
+    by_id = numpy.argsort(ids)
+    player = by_id[numpy.searchsorted(ids, matches[:, 0], sorter=by_id)]
+    opponent = by_id[numpy.searchsorted(ids, matches[:, 1], sorter=by_id)]
+    result = numpy.where(matches[:, 2] == matches[:, 0], 1.0,
+                         numpy.where(matches[:, 2] == 0, 0.5, 0.0))
+
+    # Each match as an edge from each of its players to the other.
+    src = numpy.concatenate((player, opponent))
+    dst = numpy.concatenate((opponent, player))
+    result = numpy.concatenate((result, 1.0 - result))
+
+    def total(weights):
+        return numpy.bincount(src, weights=weights, minlength=n)
+
+    buchholz = total(score[dst])
+    values["buchholz"] = buchholz
+    if "median_buchholz" in tiebreaks:
+        opponents = numpy.bincount(src, minlength=n)
+        highest = numpy.zeros(n)
+        lowest = numpy.full(n, numpy.inf)
+        numpy.maximum.at(highest, src, score[dst])
+        numpy.minimum.at(lowest, src, score[dst])
+        values["median_buchholz"] = numpy.where(
+            opponents > 2, buchholz - highest - lowest, buchholz)
+    if "sonneborn_berger" in tiebreaks:
+        values["sonneborn_berger"] = total(result * score[dst])
+    if "opponents_opponents_score" in tiebreaks:
+        values["opponents_opponents_score"] = total(buchholz[dst])
+    return dict((name, values[name]) for name in tiebreaks)
+
+
+def _pythonTiebreaks(standings, results, tiebreaks):
+    """computeTiebreaks() without NumPy."""
+    position = dict((row[0], i) for (i, row) in enumerate(standings))
+    score = [row[2] + row[3] / 2.0 for row in standings]
+    values = {
+        "opponent_wins": [row[4] for row in standings],
+        "wins": [row[2] for row in standings],
+    }
+
+    # Each player's opponents, as positions, and the player's result
+    # against each of them.
+    opponents = [[] for row in standings]
+    for (p1, p2, w) in results:
+        if p1 != p2:
+            result = 1.0 if w == p1 else 0.5 if w is None else 0.0
+            opponents[position[p1]].append((position[p2], result))
+            opponents[position[p2]].append((position[p1], 1.0 - result))
+
+    buchholz = [sum(score[j] for (j, result) in games) for games in opponents]
+    values["buchholz"] = buchholz
+    if "median_buchholz" in tiebreaks:
+        values["median_buchholz"] = [
+            buchholz[i] - max(score[j] for (j, result) in games) -
+            min(score[j] for (j, result) in games)
+            if len(games) > 2 else buchholz[i]
+            for (i, games) in enumerate(opponents)]
+    if "sonneborn_berger" in tiebreaks:
+        values["sonneborn_berger"] = [
+            sum(result * score[j] for (j, result) in games)
+            for games in opponents]
+    if "opponents_opponents_score" in tiebreaks:
+        values["opponents_opponents_score"] = [
+            sum(buchholz[j] for (j, result) in games) for games in opponents]
+    return dict((name, values[name]) for name in tiebreaks)